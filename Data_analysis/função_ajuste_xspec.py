@@ -3,20 +3,41 @@ import re
 import os
 import numpy as np
 import pickle
+try:
+    from lib.instrumentation import stage
+    from lib.fit_results import FitResultTable, load_start_values
+except ImportError:  # executado fora do repositório (ambiente do HEASoft): salva apenas os pickles
+    from contextlib import nullcontext
+    stage = lambda name: nullcontext()
+    FitResultTable = None
+    load_start_values = lambda path, n_annuli: None
 #from função_extrair_espectros import extrair_espectros  
 
-def ajuste_apec_xspec(spec_dir,reg_path,AllData,AllModels):
+def ajuste_apec_xspec(spec_dir,reg_path,AllData,AllModels,redshift=0.032,nH=0.04,abundance=0.4,output_dir=None,
+                      warm_start=False,previous_results=None,parallel_errors=False):
+    '''Ajusta phabs*apec em cada anel e salva a tabela FITS de resultados (ajuste_apec.fits) em output_dir
+
+    warm_start: cada anel parte do kT e da abundância ajustados no anel anterior (ordem do arquivo de regiões)
+    previous_results: tabela ajuste_apec.fits de uma rodada anterior com as mesmas regiões; cada anel parte do seu ajuste anterior
+    parallel_errors: Fit.error busca o intervalo de cada parâmetro (kT, abundância, norm) em um processo próprio
+    '''
     with open(reg_path, 'r') as file:
         regions = file.readlines()
     print(regions)
     home = os.path.expanduser('~') #pega o home do usuário
-    
+
+    valores_iniciais = load_start_values(previous_results, len(regions))
+    vizinho = None # (kT, abundância) do último anel que convergiu
+    if parallel_errors:
+        # o XSPEC distribui os parâmetros do comando error entre os processos, todos partindo do melhor ajuste
+        Xset.parallel.error = 3
+
     temperature = []
     normalização = []
+    abundancia = []
+    current = os.getcwd()
     for i in range(len(regions)):
         spec_file = f"{spec_dir}/spec_espectro_{i}_grp.pi"
-        print(2)
-        current = os.getcwd()
         os.chdir(spec_dir) # muda o diretorio de trabalho
 
         try:
@@ -26,19 +47,27 @@ def ajuste_apec_xspec(spec_dir,reg_path,AllData,AllModels):
             AllData.ignore("bad")
             AllModels += "phabs*apec"
             m = AllModels(1) 
-            m.phabs.nH = 0.04
+            m.phabs.nH = nH
             m.phabs.nH.frozen = True
-            m.apec.Abundanc=0.4,0.01    
-            m.apec.kT= 3.0,0.1
+            kT_inicial, abund_inicial, norm_inicial = 3.0, abundance, None
+            if valores_iniciais is not None and np.all(np.isfinite(valores_iniciais[i])):
+                kT_inicial, abund_inicial, norm_inicial = valores_iniciais[i]
+            elif warm_start and vizinho is not None:
+                kT_inicial, abund_inicial = vizinho
+            m.apec.Abundanc=float(abund_inicial),0.01
+            m.apec.kT= float(kT_inicial),0.1
+            if norm_inicial is not None:
+                m.apec.norm = float(norm_inicial)
             m.apec.Abundanc.frozen = False
             m.apec.kT.frozen = False 
-            m.apec.Redshift = 0.032
-            Fit.perform()
+            m.apec.Redshift = redshift
+            with stage('Fit.perform'):
+                Fit.perform()
 
             kT_valor_ajustado = m.apec.kT.values[0]
             norm_valor_ajustado = m.apec.norm.values[0]
-            print(25)
-            Fit.error("1. 2,3,5")
+            with stage('Fit.error'):
+                Fit.error("1. 2,3,5")
             par2 = AllModels(1)(2) # Temperatura
             par3 = AllModels(1)(3) # Abundância
             par5 = AllModels(1)(5) # Noramlização
@@ -59,9 +88,16 @@ def ajuste_apec_xspec(spec_dir,reg_path,AllData,AllModels):
             norm_erro_negativo = norm_erro_0 - norm_valor_ajustado
 
 
+            # Erros abundância
+            abund_valor_ajustado = par3.values[0]
+            abund_erro_positivo = par3.error[1] - abund_valor_ajustado
+            abund_erro_negativo = par3.error[0] - abund_valor_ajustado
+
             # Listas com os valores dos parâmetros e seus erros
             temperature.append([kT_valor_ajustado, kT_erro_positivo, kT_erro_negativo])
             normalização.append([norm_valor_ajustado,norm_erro_positivo,norm_erro_negativo])
+            abundancia.append([abund_valor_ajustado,abund_erro_positivo,abund_erro_negativo])
+            vizinho = (kT_valor_ajustado, abund_valor_ajustado)
             
             
             AllData.clear()
@@ -71,29 +107,42 @@ def ajuste_apec_xspec(spec_dir,reg_path,AllData,AllModels):
             print(f"Error processing {spec_file} in XSPEC: {e}")
             temperature.append([None, None, None])
             normalização.append([None,None,None])
+            abundancia.append([None,None,None])
             pass  # Continue para a próxima iteração
     
+    os.chdir(current) # volta ao diretório de trabalho original
+
     temperature = np.array(temperature)
     normalização = np.array(normalização)
     print(temperature)
     print(normalização)
  
     
-    diretorio_script = os.path.dirname(__file__)
+    # Por padrão salva ao lado do script; o batch runner passa o diretório do aglomerado
+    diretorio_script = output_dir if output_dir is not None else os.path.dirname(__file__)
 
-    # Ao salvar os arquivos
+    # Os pickles continuam sendo escritos: variables.py e os scripts (mass_calc.py, ...) leem deles
     with open(os.path.join(diretorio_script, 'temp_teste_1.pkl'), 'wb') as arquivo1:
         pickle.dump(temperature, arquivo1)
 
     with open(os.path.join(diretorio_script, 'normalizacao_teste_1.pkl'), 'wb') as arquivo2:
         pickle.dump(normalização, arquivo2)
 
+    # Tabela FITS ao lado dos pickles (lida pelo batch e pelo pipeline)
+    if FitResultTable is not None:
+        provenance = {'MODEL': 'phabs*apec', 'NH': nH, 'REDSHIFT': redshift, 'ABUNDINI': abundance,
+                      'SPECDIR': os.path.basename(os.path.normpath(spec_dir)), 'REGFILE': os.path.basename(reg_path)}
+        tabela = FitResultTable.from_rows(temperature, normalização, abundancia, provenance=provenance)
+        tabela.write(os.path.join(diretorio_script, 'ajuste_apec.fits'))
+        return os.path.join(diretorio_script, 'ajuste_apec.fits')
+
 
 
-spec_dir = '/home/vitorfermiano/Documentos/4976/repro/extract_bin_20_ultimos'
-reg_path = '/home/vitorfermiano/Documentos/4976/repro/region.reg'
-AllData = AllData
-AllModels = AllModels
+if __name__ == '__main__':
+    spec_dir = '/home/vitorfermiano/Documentos/4976/repro/extract_bin_20_ultimos'
+    reg_path = '/home/vitorfermiano/Documentos/4976/repro/region.reg'
+    AllData = AllData
+    AllModels = AllModels
 
 
-ajuste_apec_xspec(spec_dir,reg_path,AllData,AllModels)
\ No newline at end of file
+    ajuste_apec_xspec(spec_dir,reg_path,AllData,AllModels)
\ No newline at end of file
@@ -1,12 +1,16 @@
 import subprocess
 import os
+try:
+    from lib.instrumentation import stage
+except ImportError:  # executado fora do repositório (ambiente do CIAO)
+    from contextlib import nullcontext
+    stage = lambda name: nullcontext()
 
 # Para utilizar essa função precisa estar no ambiente virtual do CIAO - "conda activate ciao"
 
-def extrair_espectros(diretorio_trabalho, reg_path, input_file, background_file, extract_folder_name):
+def extrair_espectros(diretorio_trabalho, reg_path, input_file, background_file, extract_folder_name, conda_env_path='/home/vitorfermiano/anaconda3/envs/ciao-4.16'):
 
-    # Caminho para o ambiente Conda do CIAO
-    conda_env_path = '/home/vitorfermiano/anaconda3/envs/ciao-4.16'
+    # Caminho para o ambiente Conda do CIAO (conda_env_path)
     #CALDB_path = '/home/rick/caldb_certo'
     
     # Defina a variável de ambiente CALDB
@@ -29,19 +33,23 @@ def extrair_espectros(diretorio_trabalho, reg_path, input_file, background_file,
         input_path = os.path.join(diretorio_trabalho, input_file)
         output_path = os.path.join(extract_dir, f'spec_{outroot}')
 
-        # Comando specextract
-        specextract_command = f'{conda_env_path}/bin/specextract "{input_path}[sky={region}]" {output_path} bkgfile="{diretorio_trabalho}/{background_file}[sky={region}]" bkgresp=no binspec=20 mode=h clobber=yes'
+        # Comando specextract (sem background_file, os espectros saem sem fundo)
+        # background_file pode ser um caminho absoluto (fundo fora do diretório dos eventos)
+        bkg_option = '' if background_file is None else f'bkgfile="{os.path.join(diretorio_trabalho, background_file)}[sky={region}]" '
+        specextract_command = f'{conda_env_path}/bin/specextract "{input_path}[sky={region}]" {output_path} {bkg_option}bkgresp=no binspec=20 mode=h clobber=yes'
 
         # Execute o comando specextract
-        subprocess.run(specextract_command, shell=True, check=True)
+        with stage('specextract'):
+            subprocess.run(specextract_command, shell=True, check=True)
 
 
 
-diretorio_trabalho = '/home/vitorfermiano/Documentos/4976/repro'
-reg_path = '/home/vitorfermiano/Documentos/4976/repro/region.reg'
-input_file = '4976_c7_clean.fits'
-background_file = 'bkg_c7_clean.fits'
-extract_folder_name = 'extract_bin_20_ultimos'
+if __name__ == '__main__':
+    diretorio_trabalho = '/home/vitorfermiano/Documentos/4976/repro'
+    reg_path = '/home/vitorfermiano/Documentos/4976/repro/region.reg'
+    input_file = '4976_c7_clean.fits'
+    background_file = 'bkg_c7_clean.fits'
+    extract_folder_name = 'extract_bin_20_ultimos'
 
 
-extrair_espectros(diretorio_trabalho, reg_path, input_file, background_file, extract_folder_name)
+    extrair_espectros(diretorio_trabalho, reg_path, input_file, background_file, extract_folder_name)
@@ -0,0 +1,23 @@
+import sys
+import numpy as np
+from lib.mcmc import JointHydrostaticLikelihood, JointHydrostaticFit
+from variables import reg_path, pkl_temp_path, redshift
+
+# Ajuste conjunto (MCMC) do perfil de temperatura e do perfil de brilho superficial
+# Uso: python ajuste_conjunto.py surface_brighness.fits [n_passos] [saida.csv]
+# Escreve os percentis (16, 50, 84) da massa hidrostática a posteriori em cada raio
+r_profile_fits_path = sys.argv[1]
+n_passos = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+saida = sys.argv[3] if len(sys.argv) > 3 else 'massa_mcmc.csv'
+
+verossimilhanca = JointHydrostaticLikelihood.from_files(reg_path, pkl_temp_path, r_profile_fits_path, redshift)
+ajuste = JointHydrostaticFit(verossimilhanca).run(n_passos, seed=0)
+descarte = n_passos // 2  # metade inicial como aquecimento (burn-in)
+
+print(f"Fração de aceitação: {ajuste.sampler.acceptance_fraction.mean():.2f}")
+for nome, (mediana, mais, menos) in ajuste.parameter_summary(descarte).items():
+    print(f"{nome} = {mediana:.4g} +{mais:.2g} {menos:.2g}")
+
+R_values = np.geomspace(verossimilhanca.radius.min(), verossimilhanca.radius.max(), 50)
+ajuste.mass_posterior(R_values, descarte).to_csv(saida, index=False)
+print(f"{saida} escrito")
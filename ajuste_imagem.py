@@ -0,0 +1,26 @@
+import sys
+import numpy as np
+from lib.image_fit import ImageBetaFit, PSFKernel
+from lib.source_detection import DetectedSources
+from lib.converte import UnitConverter
+from variables import redshift
+
+# Ajuste 2D do modelo beta elíptico + fundo à imagem de contagens (estatística de Cash, PSF por FFT)
+# Uso: python ajuste_imagem.py contagens.img [expmap.fits] [psf.fits | sigma_psf_pixels] [fontes.reg]
+# Sem PSF em arquivo, usa uma gaussiana de largura sigma (1 pixel por padrão)
+# fontes.reg (escrito por detecta_fontes.py): os círculos das fontes pontuais ficam fora do ajuste
+image_path = sys.argv[1]
+expmap_path = sys.argv[2] if len(sys.argv) > 2 else None
+psf_arg = sys.argv[3] if len(sys.argv) > 3 else '1.0'
+psf = PSFKernel.from_fits(psf_arg) if psf_arg.endswith(('.fits', '.fits.gz')) else PSFKernel.gaussian(float(psf_arg))
+fontes = DetectedSources.read(sys.argv[4]) if len(sys.argv) > 4 else DetectedSources([], [], [])
+
+ajuste = ImageBetaFit.from_files(image_path, expmap_path, psf=psf, exclude=zip(fontes.x, fontes.y, fontes.radius))
+print(f"{len(fontes)} fontes pontuais excluídas")
+params, _ = ajuste.fit()
+erros = ajuste.get_param_errors()
+for nome, valor, erro in zip(ImageBetaFit.PARAMETERS, params, erros):
+    print(f"{nome} = {valor:.5g} ± {erro:.2g}")
+print(f"theta = {np.degrees(params[6]):.1f} graus")
+print(f"rc = {UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(ajuste.get_r0()), redshift):.4g} kpc")
+print(f"Cash = {ajuste.cash:.6g}")
@@ -0,0 +1,15 @@
+import os
+import sys
+from lib.spectral_fit import ajuste_apec_nativo
+from variables import reg_path, redshift, nH, abundance
+
+# Ajuste phabs*apec de todos os anéis sem o XSPEC, a partir de uma tabela do apec (atable)
+# Uso: python ajuste_nativo.py diretorio_espectros tabela_apec.fits [diretorio_saida]
+# Cada anel parte do anel vizinho e, se existir, do ajuste_apec.fits anterior no diretório de saída
+spec_dir, table_path = sys.argv[1:3]
+output_dir = sys.argv[3] if len(sys.argv) > 3 else spec_dir
+
+caminho = ajuste_apec_nativo(spec_dir, reg_path, table_path, redshift=redshift, nH=nH, abundance=abundance,
+                             output_dir=output_dir, warm_start=True,
+                             previous_results=os.path.join(output_dir, 'ajuste_apec.fits'))
+print(f"{caminho} escrito")
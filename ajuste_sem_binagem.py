@@ -0,0 +1,24 @@
+import sys
+from lib.unbinned_fit import UnbinnedBetaFit, flux_normalization
+from lib.converte import UnitConverter
+from variables import reg_path, redshift
+
+# Ajuste do modelo beta + fundo aos raios dos fótons (estatística de Cash, sem binagem)
+# Uso: python ajuste_sem_binagem.py evento.fits [surface_brighness.fits] [n_bootstrap]
+# Centro e raio máximo vêm do arquivo de regiões; o perfil do dmextract dá a normalização em SUR_BRI
+evt_path = sys.argv[1]
+r_profile_fits_path = sys.argv[2] if len(sys.argv) > 2 else None
+n_bootstrap = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+ajuste = UnbinnedBetaFit.from_events(evt_path, reg_path, energy_range=(500, 7000))
+params, _ = ajuste.fit()
+erros = ajuste.get_param_errors()
+print(f"Fótons: {len(ajuste.photons)}")
+for nome, valor, erro in zip(UnbinnedBetaFit.PARAMETERS, params, erros):
+    print(f"{nome} = {valor:.5g} ± {erro:.2g}")
+print(f"rc = {UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(ajuste.get_r0()), redshift):.4g} kpc")
+if r_profile_fits_path is not None:
+    print(f"ampl (SUR_BRI) = {flux_normalization(r_profile_fits_path, ajuste.get_r0(), ajuste.get_beta()):.5g}")
+if n_bootstrap:
+    amostras = ajuste.bootstrap(n_bootstrap, seed=0)
+    print("Desvio padrão bootstrap:", dict(zip(UnbinnedBetaFit.PARAMETERS, amostras.std(axis=0))))
@@ -0,0 +1,14 @@
+import sys
+import logging
+from lib.batch import run_batch
+
+# Uso: python batch_analysis.py catalogo.yaml diretorio_saida [n_processos]
+catalogue_path = sys.argv[1]
+output_root = sys.argv[2]
+max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+# progresso de cada aglomerado (lib.batch) no terminal
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+summary = run_batch(catalogue_path, output_root, max_workers=max_workers)
+print(summary)
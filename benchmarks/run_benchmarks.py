@@ -0,0 +1,488 @@
+"""
+Benchmark suite of the analysis stages on synthetic clusters.
+
+Runs fully offline (no CIAO or XSPEC): every input is generated by
+``benchmarks.synthetic``. The benchmarks of optional packages (sherpa, for
+``beta_model_fit``) are reported as skipped when the package is missing. Each run appends one line per benchmark to
+``benchmarks/results.jsonl`` together with the git commit, so timings can be
+tracked across commits, and reports the benchmarks that got slower than the
+previous run of the same scale.
+
+Uso:
+    python -m benchmarks.run_benchmarks --scale 1 --repeat 5
+    python -m benchmarks.run_benchmarks --only density pressure --no-save
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import SyntheticCluster
+
+RESULTS_PATH = os.path.join(ROOT, 'benchmarks', 'results.jsonl')
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. The decorated function receives the synthetic
+    cluster and returns the zero-argument callable that is timed, so the
+    setup is not measured.
+    """
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+@benchmark('region_parsing')
+def bench_region_parsing(cluster):
+    from lib.regions import RegionProcessor
+    return lambda: RegionProcessor(cluster.reg_path).kpc_Radius(cluster.redshift)
+
+
+@benchmark('unit_conversions')
+def bench_unit_conversions(cluster):
+    from lib.converte import UnitConverter
+    pixels = cluster.edges[1:]
+
+    def run():
+        for pixel in pixels:
+            UnitConverter.mpc_to_cm(UnitConverter.arcsec_to_mpc(UnitConverter.pixel_to_arcsec(pixel), cluster.redshift))
+    return run
+
+
+@benchmark('temperature_load')
+def bench_temperature_load(cluster):
+    from lib.temperaturas import Temperature_Processor
+
+    def run():
+        Temperature_Processor(cluster.pkl_temp_path).Temp_estimator()
+    return run
+
+
+@benchmark('fit_table_load')
+def bench_fit_table_load(cluster):
+    from lib.fit_results import FitResultTable
+    from lib.temperaturas import Temperature_Processor
+    table_path = os.path.join(cluster.directory, 'ajuste_apec.fits')
+    FitResultTable.from_pickles(cluster.pkl_temp_path, cluster.pkl_norm_path).write(table_path)
+
+    def run():
+        Temperature_Processor(table_path).Temp_estimator()
+    return run
+
+
+@benchmark('density')
+def bench_density(cluster):
+    from lib.classe_densidade import Density_Processor
+
+    def run():
+        Density_Processor(cluster.pkl_norm_path, cluster.reg_path).density_estimator(cluster.redshift, 1.2)
+    return run
+
+
+def _profiles(cluster):
+    from lib.classe_densidade import Density_Processor
+    from lib.temperaturas import Temperature_Processor
+    density = Density_Processor(cluster.pkl_norm_path, cluster.reg_path)
+    density.density_estimator(cluster.redshift, 1.2)
+    temperature = Temperature_Processor(cluster.pkl_temp_path)
+    temperature.Temp_estimator()
+    return density.densidades, temperature.temperature
+
+
+@benchmark('pressure')
+def bench_pressure(cluster):
+    from lib.classe_pressao import pressao
+    densidades, temperature = _profiles(cluster)
+    return lambda: pressao(densidades, temperature).build_pressure_array()
+
+
+@benchmark('entropy')
+def bench_entropy(cluster):
+    from lib.classe_entropia import Entropia
+    densidades, temperature = _profiles(cluster)
+    return lambda: [Entropia(densidades[i], temperature[i]).calcula_Entropia() for i in range(len(densidades))]
+
+
+@benchmark('cooling_time')
+def bench_cooling_time(cluster):
+    from lib.classe_pressao import pressao
+    from lib.classe_cooling_time import cooling_time
+    densidades, temperature = _profiles(cluster)
+    pressure = pressao(densidades, temperature)
+    pressure.build_pressure_array()
+    return lambda: cooling_time(densidades, pressure.pressure_array, 3e-23).build_cooling_time_array()
+
+
+@benchmark('profile_container')
+def bench_profile_container(cluster):
+    from lib.radial_profile import Profile
+
+    def run():
+        profile = Profile.from_fit_results(cluster.reg_path, cluster.pkl_temp_path, cluster.pkl_norm_path,
+                                           cluster.redshift, 1.2)
+        profile.add_thermodynamics(3e-23).compress()
+    return run
+
+
+@benchmark('curve_fit')
+def bench_curve_fit(cluster):
+    from lib.temperaturas import CurveFitter
+    radius = cluster.radius_kpc()
+    temperature = cluster.temperature_model(radius) * (1 + 0.03 * np.random.default_rng(1).normal(size=radius.size))
+    error = 0.05 * temperature
+    return lambda: CurveFitter(radius, temperature, np.zeros_like(radius), error).fit_curve()
+
+
+@benchmark('beta_model_fit')
+def bench_beta_model_fit(cluster):
+    from lib.superficie_de_brilho import Make_surface_brightness_plot
+    return lambda: Make_surface_brightness_plot(cluster.sb_fits_path).plot_process()
+
+
+@benchmark('mass_evaluation')
+def bench_mass_evaluation(cluster):
+    from astropy import units as u
+    from astropy import constants as const
+    from scipy.special import gamma
+    from lib.teste_classe_massa import Mass_Calculator
+    k = const.k_B.value
+    G = const.G.to((u.kpc * u.m**2) / (u.kg * u.s**2)).value
+    a, b, c, d = cluster.temperature_params
+    beta = cluster.beta
+    R_values = np.logspace(1, 3, 100)
+    return lambda: Mass_Calculator(R_values, k, G, 0.6, const.m_p.value, c, d, beta, 70.0, a, b, cluster.ampl,
+                                   gamma(3 * beta), gamma(3 * beta - 0.5)).calculate_mass()
+
+
+@benchmark('symbolic_mass')
+def bench_symbolic_mass(cluster):
+    from lib.symbolic_mass import SymbolicMassModel
+    a, b, c, d = cluster.temperature_params
+    model = SymbolicMassModel.from_names('exponential', 'beta')
+    R_values = np.logspace(1, 3, 100)
+    samples = 1 + 0.02 * np.random.default_rng(0).standard_normal((1000, 1))
+    params = {'a': a * samples, 'b': b, 'c': c, 'd': d, 'n0': 1e-2, 'rc': 70.0, 'beta': cluster.beta * samples}
+    return lambda: model.mass_profile(R_values, mu=0.6, **params)
+
+
+@benchmark('gas_mass')
+def bench_gas_mass(cluster):
+    from lib.gas_mass import GasMassProfile, beta_model_gas_mass, overdensity_radius
+    rng = np.random.default_rng(0)
+    n_samples = 1000
+    R_values = np.logspace(0, 3.5, 400)
+    n0 = 1e-2 * (1 + 0.05 * rng.standard_normal(n_samples))
+    rc = 70.0 * (1 + 0.05 * rng.standard_normal(n_samples))
+    beta = cluster.beta * (1 + 0.02 * rng.standard_normal(n_samples))
+    # massa hidrostática negativa nos raios internos, como num cool core: R_delta deve continuar definido
+    total_scale = 8 * (1 - 2 * np.exp(-R_values / 20.0))
+    radius = overdensity_radius(R_values, total_scale * beta_model_gas_mass(R_values, 1e-2, 70.0, cluster.beta),
+                                2500, cluster.redshift)[0]
+    if not np.isfinite(radius):
+        raise RuntimeError("R2500 undefined for a profile with negative inner mass")
+
+    def run():
+        gas_mass = beta_model_gas_mass(R_values, n0, rc, beta)
+        return GasMassProfile(R_values, gas_mass, total_scale * gas_mass).summary([2500, 500], cluster.redshift)
+    return run
+
+
+@benchmark('sensitivity_sweep')
+def bench_sensitivity_sweep(cluster):
+    from lib.sensitivity_sweep import SensitivitySweep
+    sweep = SensitivitySweep.from_fit_results(cluster.reg_path, cluster.pkl_temp_path, cluster.pkl_norm_path,
+                                              cluster.redshift, rc=70.0, beta=cluster.beta)
+    axes = {'mu': np.linspace(1.1, 1.3, 21), 'mu_mass': np.linspace(0.55, 0.65, 21),
+            'cooling_function': np.geomspace(2e-23, 4e-23, 21), 'H0': [67.7, 70.0, 73.0]}
+    return lambda: sweep.run(axes)
+
+
+@benchmark('bootstrap')
+def bench_bootstrap(cluster):
+    from lib.bootstrap import ProfileBootstrap
+    from lib.temperaturas import CurveFitter
+    rng = np.random.default_rng(0)
+    radius = np.linspace(20, 400, 12)
+    temperature = CurveFitter.model_function(radius, *cluster.temperature_params)
+    temperature_err = 0.05 * np.abs(temperature)
+    sb_radius = np.geomspace(2, 300, 40)
+    sb = cluster.ampl * (1 + (sb_radius / 60.0)**2)**(0.5 - 3 * cluster.beta)
+    sb_err = 0.05 * sb
+    data = (radius, temperature + temperature_err * rng.standard_normal(radius.size), temperature_err,
+            sb_radius, sb + sb_err * rng.standard_normal(sb.size), sb_err)
+    # reamostragem de pares: sem o menor raio, o extremo da grade em c zerava exp(-c R) (matriz singular)
+    pairs = ProfileBootstrap(*data, kpc_per_pixel=0.32, method='pairs').fit().run(200, seed=0)
+    if not pairs.valid.any():
+        raise RuntimeError("No valid pairs bootstrap resample")
+    bootstrap = ProfileBootstrap(*data, kpc_per_pixel=0.32).fit()
+    return lambda: bootstrap.run(1000, seed=0)
+
+
+@benchmark('mass_model_fit')
+def bench_mass_model_fit(cluster):
+    from lib.mass_models import HydrostaticKernel, MassModelFit, NFW
+    r_out = np.geomspace(30, 800, cluster.n_annuli)
+    r_in = np.concatenate([[0.0], r_out[:-1]])
+    kernel = HydrostaticKernel.from_beta_model(r_in, r_out, 70.0, cluster.beta)
+    temperature = kernel.projected_temperature(NFW.mass(kernel.r, [400.0, 6.4]), 3.0)
+    return lambda: MassModelFit(kernel, NFW, temperature, 0.05 * temperature).fit()
+
+
+@benchmark('joint_mcmc')
+def bench_joint_mcmc(cluster):
+    from lib.mcmc import JointHydrostaticLikelihood, JointHydrostaticFit
+    from lib.temperaturas import CurveFitter
+    rng = np.random.default_rng(0)
+    radius = np.linspace(20, 400, 12)
+    temperature = CurveFitter.model_function(radius, *cluster.temperature_params)
+    temperature_err = 0.05 * np.abs(temperature)
+    sb_radius = np.geomspace(2, 300, 40)
+    sb = cluster.ampl * (1 + (sb_radius / 60.0)**2)**(0.5 - 3 * cluster.beta)
+    sb_err = 0.05 * sb
+    likelihood = JointHydrostaticLikelihood(radius, temperature + temperature_err * rng.standard_normal(radius.size),
+                                            temperature_err, sb_radius, sb + sb_err * rng.standard_normal(sb.size),
+                                            sb_err, kpc_per_pixel=0.32)
+    start = np.array([*cluster.temperature_params, cluster.ampl, 60.0, cluster.beta])
+    return lambda: JointHydrostaticFit(likelihood, n_walkers=32).run(200, start=start, seed=0)
+
+
+@benchmark('event_radii')
+def bench_event_radii(cluster):
+    import astropy.io.fits as fits
+
+    def run():
+        with fits.open(cluster.evt_path, memmap=True) as hdulist:
+            events = hdulist['EVENTS'].data
+            r = np.hypot(events['x'] - cluster.center[0], events['y'] - cluster.center[1])
+            np.histogram(r, bins=cluster.edges)
+    return run
+
+
+@benchmark('unbinned_beta_fit')
+def bench_unbinned_beta_fit(cluster):
+    from lib.unbinned_fit import PhotonRadii, UnbinnedBetaFit
+    photons = PhotonRadii.from_events(cluster.evt_path, cluster.center, cluster.r_max_pixel)
+    return lambda: UnbinnedBetaFit(photons).fit()
+
+
+@benchmark('image_beta_fit')
+def bench_image_beta_fit(cluster):
+    from lib.image_fit import ImageBetaFit, PSFKernel
+    fit = ImageBetaFit.from_files(cluster.image_path, cluster.expmap_path, cluster.bkg_image_path,
+                                  psf=PSFKernel.gaussian(1.0))
+    return fit.fit
+
+
+@benchmark('source_detection')
+def bench_source_detection(cluster):
+    from lib.source_detection import SourceDetector
+
+    def run():
+        SourceDetector.from_images(cluster.image_path, cluster.expmap_path).detect()
+    return run
+
+
+@benchmark('image_profile')
+def bench_image_profile(cluster):
+    from lib.image_profile import ImageProfileBuilder
+    builder = ImageProfileBuilder(cluster.image_path, cluster.expmap_path, cluster.bkg_image_path)
+    builder.profile(cluster.reg_path)
+    return lambda: builder.profile(cluster.reg_path)
+
+
+@benchmark('centroid')
+def bench_centroid(cluster):
+    from lib.centroid import CentroidFinder
+    finder = CentroidFinder.from_events(cluster.evt_path)
+    start = (cluster.center[0] + 15, cluster.center[1] - 15)
+    return lambda: finder.centroid(start, [cluster.r_max_pixel, cluster.r_max_pixel / 4, 20.0])
+
+
+@benchmark('adaptive_annuli')
+def bench_adaptive_annuli(cluster):
+    from lib.adaptive_annuli import AdaptiveBinner
+
+    def run():
+        binner = AdaptiveBinner.from_events(cluster.evt_path, cluster.center)
+        binner.edges(cluster.n_events / (2 * cluster.n_annuli), r_max=cluster.r_max_pixel)
+    return run
+
+
+@benchmark('voronoi_binning')
+def bench_voronoi_binning(cluster):
+    from lib.image_profile import load_image, physical_transform
+    from lib.voronoi_binning import VoronoiBinning
+    counts, header = load_image(cluster.image_path)
+    ny, nx = counts.shape
+    # recorte central de 256x256 pixels
+    cutout = counts[ny // 2 - 128:ny // 2 + 128, nx // 2 - 128:nx // 2 + 128]
+    binning = VoronoiBinning(cutout, physical_transform(header))
+    return lambda: binning.bin(20)
+
+
+@benchmark('sector_profiles')
+def bench_sector_profiles(cluster):
+    from benchmarks.synthetic import SyntheticCluster
+    from lib.sector_profiles import SectorProfiles
+    sectors = SyntheticCluster(os.path.join(cluster.directory, 'sectors'), n_annuli=cluster.n_annuli, n_sectors=8,
+                               n_events=cluster.n_events).write_all()
+
+    def run():
+        profiles = SectorProfiles.from_fit_results(sectors.reg_path, sectors.pkl_temp_path, sectors.pkl_norm_path,
+                                                   sectors.redshift, 1.2)
+        profiles.add_thermodynamics(3e-23).count_events(sectors.evt_path)
+        profiles.deviation('entropy')
+    return run
+
+
+@benchmark('native_spectral_fit')
+def bench_native_spectral_fit(cluster):
+    from lib.spectral_fit import fit_spectra
+    spec_dir = cluster.write_spectra()
+    paths = [os.path.join(spec_dir, f'spec_espectro_{i}_grp.pi') for i in range(cluster.n_annuli)]
+    return lambda: fit_spectra(paths, cluster.table_path, cluster.redshift, 0.04, max_workers=1)
+
+
+@benchmark('native_spectral_fit_warm')
+def bench_native_spectral_fit_warm(cluster):
+    from lib.spectral_fit import fit_spectra
+    spec_dir = cluster.write_spectra()
+    paths = [os.path.join(spec_dir, f'spec_espectro_{i}_grp.pi') for i in range(cluster.n_annuli)]
+    return lambda: fit_spectra(paths, cluster.table_path, cluster.redshift, 0.04, max_workers=1, warm_start=True)
+
+
+@benchmark('joint_spectral_fit')
+def bench_joint_spectral_fit(cluster):
+    from lib.spectral_fit import fit_spectra
+    spec_dir = cluster.write_spectra()
+    # três ObsIDs do mesmo anel (os mesmos espectros): custo do ajuste conjunto
+    paths = [[os.path.join(spec_dir, f'spec_espectro_{i}_grp.pi')] * 3 for i in range(cluster.n_annuli)]
+    return lambda: fit_spectra(paths, cluster.table_path, cluster.redshift, 0.04, max_workers=1, warm_start=True)
+
+
+@benchmark('response_fold')
+def bench_response_fold(cluster):
+    from lib.response import Response
+    spec_dir = cluster.write_spectra()
+    response = Response.from_files(os.path.join(spec_dir, 'spec.rmf'), os.path.join(spec_dir, 'spec.arf'))
+    flux = np.random.default_rng(0).random((40, 7, response.energ_lo.size))
+    return lambda: response.fold(flux)
+
+
+def time_callable(func, repeat, min_time=0.05):
+    """
+    Returns (best, median) seconds per call over ``repeat`` rounds; fast
+    callables are looped inside each round until it lasts ``min_time``.
+    """
+    func()
+    start = time.perf_counter()
+    func()
+    single = time.perf_counter() - start
+    number = max(1, int(min_time / single)) if single > 0 else 1000
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return min(timings), float(np.median(timings)), number
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_results(path, scale):
+    """
+    Latest stored result of every benchmark at the given scale.
+    """
+    previous = {}
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            for line in file:
+                entry = json.loads(line)
+                if entry['scale'] == scale:
+                    previous[entry['benchmark']] = entry
+    return previous
+
+
+def run(scale=1, repeat=5, only=None, save=True, results_path=RESULTS_PATH, threshold=1.2):
+    """
+    Runs the benchmarks and returns their results.
+
+    Parameters:
+    -----------
+    scale : int
+        Multiplies the size of the synthetic dataset (annuli, profile bins and events).
+    repeat : int
+        Timing rounds per benchmark; the best round is reported.
+    only : list of str, optional
+        Names of the benchmarks to run.
+    save : bool
+        Append the results to ``results_path``.
+    threshold : float
+        Ratio to the previous best time above which a benchmark is flagged as a regression.
+    """
+    names = only or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f"Unknown benchmarks: {sorted(unknown)}")
+    previous = previous_results(results_path, scale)
+    commit = git_commit()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        cluster = SyntheticCluster(directory, n_annuli=20 * scale, n_events=100000 * scale,
+                                   n_sb_bins=60 * scale).write_all()
+        for name in names:
+            try:
+                best, median, number = time_callable(BENCHMARKS[name](cluster), repeat)
+            except ModuleNotFoundError as e:
+                print(f"{name:<20} skipped ({e.name} not installed)")
+                continue
+            entry = {'benchmark': name, 'scale': scale, 'best_s': best, 'median_s': median, 'number': number,
+                     'commit': commit, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': platform.python_version(), 'numpy': np.__version__}
+            results.append(entry)
+            line = f"{name:<20} {best * 1e3:12.4f} ms"
+            if name in previous:
+                ratio = best / previous[name]['best_s']
+                line += f"   x{ratio:5.2f} vs {previous[name]['commit']}"
+                if ratio > threshold:
+                    line += '   REGRESSION'
+            print(line)
+    if save:
+        with open(results_path, 'a') as file:
+            for entry in results:
+                file.write(json.dumps(entry) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+')
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--results', default=RESULTS_PATH)
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = parser.parse_args()
+    run(scale=args.scale, repeat=args.repeat, only=args.only, save=not args.no_save,
+        results_path=args.results, threshold=args.threshold)
@@ -0,0 +1,292 @@
+import os
+import pickle
+
+import numpy as np
+import astropy.io.fits as fits
+
+
+class SyntheticCluster:
+    """
+    Synthetic inputs of one cluster, written in the same formats produced by
+    CIAO and XSPEC, so every stage can be benchmarked offline.
+
+    Parameters:
+    -----------
+    directory : str
+        Where the files are written.
+    n_annuli : int
+        Number of annuli (or radial bins per sector when ``n_sectors`` > 1).
+    n_sectors : int
+        Number of ``pie`` sectors. ``1`` writes ``annulus`` regions.
+    n_events : int
+        Number of source events in the event list (a uniform background of
+        10% is added).
+    n_sb_bins : int
+        Number of bins of the surface brightness profile.
+    fail_fraction : float
+        Fraction of annuli whose spectral fit "failed" (``[None, None, None]`` rows).
+    seed : int
+        Seed of the random generator, so datasets are reproducible.
+    """
+
+    center = (4096.5, 4096.5)
+    redshift = 0.032
+    rc_pixel = 105.0
+    beta = 0.6
+    ampl = 0.00993448
+    temperature_params = (6.503, -4.626, 0.014, 0.002)
+
+    def __init__(self, directory, n_annuli=20, n_sectors=1, n_events=100000, n_sb_bins=60,
+                 fail_fraction=0.0, r_max_pixel=600.0, seed=0):
+        self.directory = directory
+        self.n_annuli = n_annuli
+        self.n_sectors = n_sectors
+        self.n_events = n_events
+        self.n_sb_bins = n_sb_bins
+        self.fail_fraction = fail_fraction
+        self.r_max_pixel = r_max_pixel
+        self.rng = np.random.default_rng(seed)
+        self.reg_path = os.path.join(directory, 'region.reg')
+        self.pkl_temp_path = os.path.join(directory, 'temp_teste_1.pkl')
+        self.pkl_norm_path = os.path.join(directory, 'normalizacao_teste_1.pkl')
+        self.sb_fits_path = os.path.join(directory, 'surface_brighness.fits')
+        self.evt_path = os.path.join(directory, 'events.fits')
+        self.image_path = os.path.join(directory, 'counts.img')
+        self.expmap_path = os.path.join(directory, 'expmap.fits')
+        self.bkg_image_path = os.path.join(directory, 'bkg.img')
+
+    def write_all(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.write_regions()
+        self.write_fit_pickles()
+        self.write_surface_brightness()
+        self.write_events()
+        self.write_images()
+        return self
+
+    @property
+    def edges(self):
+        return np.linspace(0.0, self.r_max_pixel, self.n_annuli + 1)
+
+    def radius_kpc(self):
+        # 0.492"/pixel e ~0.65 kpc/" em z = 0.032
+        edges = self.edges
+        return 0.5 * (edges[1:] + edges[:-1]) * 0.492 * 0.65
+
+    def write_regions(self):
+        edges = self.edges
+        x, y = self.center
+        with open(self.reg_path, 'w') as file:
+            if self.n_sectors == 1:
+                for i in range(self.n_annuli):
+                    file.write(f"annulus({x},{y},{edges[i]:.4f},{edges[i + 1]:.4f})\n")
+            else:
+                angles = np.linspace(0.0, 360.0, self.n_sectors + 1)
+                for j in range(self.n_sectors):
+                    for i in range(self.n_annuli):
+                        file.write(f"pie({x},{y},{edges[i]:.4f},{edges[i + 1]:.4f},{angles[j]:.4f},{angles[j + 1]:.4f})\n")
+
+    def temperature_model(self, radius_kpc):
+        a, b, c, d = self.temperature_params
+        return a + b * np.exp(-c * radius_kpc) - d * radius_kpc
+
+    def write_fit_pickles(self):
+        n_rows = self.n_annuli * self.n_sectors
+        radius = np.tile(self.radius_kpc(), self.n_sectors)
+        temperature = self.temperature_model(radius) * (1 + 0.03 * self.rng.normal(size=n_rows))
+        temperature_error = 0.05 * temperature
+        norm = 1e-3 * (1 + (radius / 70.0)**2)**(1 - 3 * self.beta) / self.n_sectors
+        norm = norm * (1 + 0.02 * self.rng.normal(size=n_rows))
+        temperature_rows = np.empty((n_rows, 3), dtype=object)
+        norm_rows = np.empty((n_rows, 3), dtype=object)
+        temperature_rows[:] = np.column_stack([temperature, temperature_error, -temperature_error])
+        norm_rows[:] = np.column_stack([norm, 0.02 * norm, -0.02 * norm])
+        failed = self.rng.random(n_rows) < self.fail_fraction
+        temperature_rows[failed] = None
+        norm_rows[failed] = None
+        with open(self.pkl_temp_path, 'wb') as file:
+            pickle.dump(temperature_rows, file)
+        with open(self.pkl_norm_path, 'wb') as file:
+            pickle.dump(norm_rows, file)
+
+    def beta_model(self, r):
+        return self.ampl * (1 + (r / self.rc_pixel)**2)**(-3 * self.beta + 0.5)
+
+    def write_surface_brightness(self):
+        edges = np.linspace(0.0, self.r_max_pixel, self.n_sb_bins + 1)
+        r_in, r_out = edges[:-1], edges[1:]
+        rmid = 0.5 * (r_in + r_out)
+        sur_bri = self.beta_model(rmid)
+        sur_bri_err = 0.05 * sur_bri
+        sur_bri = sur_bri + sur_bri_err * self.rng.normal(size=rmid.size)
+        columns = [
+            fits.Column(name='R', format='2D', array=np.column_stack([r_in, r_out])),
+            fits.Column(name='RMID', format='D', array=rmid),
+            fits.Column(name='SUR_BRI', format='D', array=sur_bri),
+            fits.Column(name='SUR_BRI_ERR', format='D', array=sur_bri_err),
+        ]
+        fits.BinTableHDU.from_columns(columns, name='HISTOGRAM').writeto(self.sb_fits_path, overwrite=True)
+
+    def sample_beta_radii(self, n):
+        """
+        Draws radii (pixel) from the projected beta model, truncated at ``r_max_pixel``,
+        by inverting its cumulative counts.
+        """
+        exponent = 1.5 - 3 * self.beta
+        u_max = 1 - (1 + (self.r_max_pixel / self.rc_pixel)**2)**exponent
+        u = self.rng.random(n) * u_max
+        return self.rc_pixel * np.sqrt((1 - u)**(1 / exponent) - 1)
+
+    def write_events(self):
+        n_background = self.n_events // 10
+        r = np.concatenate([self.sample_beta_radii(self.n_events),
+                            self.r_max_pixel * np.sqrt(self.rng.random(n_background))])
+        theta = self.rng.random(r.size) * 2 * np.pi
+        x = self.center[0] + r * np.cos(theta)
+        y = self.center[1] + r * np.sin(theta)
+        energy = self.rng.exponential(2000.0, r.size) + 300.0
+        columns = [
+            fits.Column(name='time', format='D', array=np.sort(self.rng.random(r.size)) * 1e5),
+            fits.Column(name='x', format='E', array=x),
+            fits.Column(name='y', format='E', array=y),
+            fits.Column(name='energy', format='E', array=energy),
+            fits.Column(name='pi', format='J', array=np.clip((energy / 14.6).astype(int) + 1, 1, 1024)),
+        ]
+        hdu = fits.BinTableHDU.from_columns(columns, name='EVENTS')
+        hdu.header['EXPOSURE'] = 1e5
+        hdu.writeto(self.evt_path, overwrite=True)
+        self.events = (x, y, energy)
+
+    def image_header(self):
+        """
+        Header of the binned images: sky=1 binning of a square of side
+        2 * r_max_pixel around the center, with the CIAO LTV/LTM keywords.
+        """
+        header = fits.Header()
+        header['LTM1_1'] = header['LTM2_2'] = 1.0
+        header['LTV1'] = -(np.floor(self.center[0] - self.r_max_pixel) - 0.5)
+        header['LTV2'] = -(np.floor(self.center[1] - self.r_max_pixel) - 0.5)
+        return header
+
+    def write_images(self):
+        size = int(2 * self.r_max_pixel)
+        header = self.image_header()
+        x0, y0 = 0.5 - header['LTV1'], 0.5 - header['LTV2']
+        x, y, _ = self.events
+        counts, _, _ = np.histogram2d(y, x, bins=size, range=[[y0, y0 + size], [x0, x0 + size]])
+        fits.PrimaryHDU(counts.astype(np.float32), header=header).writeto(self.image_path, overwrite=True)
+        background = self.rng.poisson(0.01, counts.shape).astype(np.float32)
+        fits.PrimaryHDU(background, header=header).writeto(self.bkg_image_path, overwrite=True)
+        expmap = np.full(counts.shape, 400.0 * 1e5, dtype=np.float32)
+        expmap[:, : size // 10] *= 0.5
+        fits.PrimaryHDU(expmap, header=header).writeto(self.expmap_path, overwrite=True)
+
+    def thermal_spectrum(self, kT, abundance, energ_lo, energ_hi):
+        """
+        Rough rest-frame thermal spectrum (photons/cm^2/s per bin, norm = 1):
+        bremsstrahlung continuum plus Gaussian Fe-L, Si, S and Fe-K lines whose
+        strength scales with the abundance. Only meant to give the native
+        fitter realistic shapes, not apec fluxes.
+        """
+        kT = np.asarray(kT, dtype=float)[..., np.newaxis, np.newaxis]
+        abundance = np.asarray(abundance, dtype=float)[np.newaxis, ..., np.newaxis]
+        energy = 0.5 * (energ_lo + energ_hi)
+        width = energ_hi - energ_lo
+        spectrum = 0.5 * kT**-0.5 * energy**-1.0 * np.exp(-energy / kT) * width
+        lines = ((0.95, 0.08, 1.0), (1.86, 0.01, 2.0), (2.45, 0.01, 3.0), (6.70, 0.03, 6.0))
+        for center, sigma, kT_peak in lines:
+            # linha mais forte perto de kT_peak, como as emissividades de cada íon
+            strength = 0.02 * abundance * np.exp(-0.5 * np.log(kT / kT_peak)**2)
+            spectrum = spectrum + strength * np.exp(-0.5 * ((energy - center) / sigma)**2) * width / (
+                np.sqrt(2 * np.pi) * sigma)
+        return spectrum
+
+    def write_table_model(self, path):
+        from lib.spectral_fit import TableModel
+        energ_lo = np.arange(0.05, 15.0, 0.005)
+        energ_hi = energ_lo + 0.005
+        kT = np.geomspace(0.5, 16.0, 40)
+        abundance = np.linspace(0.0, 1.5, 7)
+        TableModel(kT, abundance, energ_lo, energ_hi, self.thermal_spectrum(kT, abundance, energ_lo, energ_hi)).write(path)
+        return path
+
+    def write_response(self, rmf_path, arf_path, n_channels=1024):
+        """
+        Gaussian-redistribution RMF (one channel group per energy) and a
+        smooth ARF, on the ACIS 14.6 eV channel grid. The first and last
+        energy rows have no groups (N_GRP = 0), as in real RMFs.
+        """
+        energ_lo = np.arange(0.25, 11.05, 0.01)
+        energ_hi = energ_lo + 0.01
+        energy = 0.5 * (energ_lo + energ_hi)
+        e_min = np.arange(n_channels) * 0.0146
+        e_max = e_min + 0.0146
+        sigma = 0.03 + 0.04 * np.sqrt(energy)
+        n_grp = ((energ_lo >= 0.3 - 1e-9) & (energ_hi <= 11.0 + 1e-9)).astype(int)
+        first = np.where(n_grp > 0, np.clip(((energy - 4 * sigma) / 0.0146).astype(int), 0, n_channels - 1), 0)
+        last = np.where(n_grp > 0, np.clip(((energy + 4 * sigma) / 0.0146).astype(int) + 1, 1, n_channels), 0)
+        n_chan = last - first
+        rows = []
+        for i in range(energy.size):
+            centers = 0.5 * (e_min[first[i]:last[i]] + e_max[first[i]:last[i]])
+            row = np.exp(-0.5 * ((centers - energy[i]) / sigma[i])**2)
+            rows.append((row / max(row.sum(), 1e-300)).astype(np.float32))
+        matrix = fits.BinTableHDU.from_columns([
+            fits.Column(name='ENERG_LO', format='E', array=energ_lo),
+            fits.Column(name='ENERG_HI', format='E', array=energ_hi),
+            fits.Column(name='N_GRP', format='I', array=n_grp),
+            fits.Column(name='F_CHAN', format='J', array=first + 1),
+            fits.Column(name='N_CHAN', format='J', array=n_chan),
+            fits.Column(name='MATRIX', format='PE()', array=np.array(rows, dtype=object)),
+        ], name='MATRIX')
+        matrix.header['TLMIN4'] = 1
+        matrix.header['DETCHANS'] = n_channels
+        ebounds = fits.BinTableHDU.from_columns([
+            fits.Column(name='CHANNEL', format='J', array=np.arange(1, n_channels + 1)),
+            fits.Column(name='E_MIN', format='E', array=e_min),
+            fits.Column(name='E_MAX', format='E', array=e_max),
+        ], name='EBOUNDS')
+        fits.HDUList([fits.PrimaryHDU(), matrix, ebounds]).writeto(rmf_path, overwrite=True)
+        area = 600.0 * np.exp(-0.5 * (np.log(energy / 1.5) / 0.7)**2)
+        fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns([
+            fits.Column(name='ENERG_LO', format='E', array=energ_lo),
+            fits.Column(name='ENERG_HI', format='E', array=energ_hi),
+            fits.Column(name='SPECRESP', format='E', array=area),
+        ], name='SPECRESP')]).writeto(arf_path, overwrite=True)
+
+    def write_spectra(self, exposure=5e4, nH=0.04, abundance=0.4, norm_scale=1.0):
+        """
+        Writes ``extract/spec_espectro_{i}_grp.pi`` (and background) for every
+        annulus, drawn from the synthetic table folded through the synthetic
+        response with the temperature and normalization of the fit pickles.
+        Returns the directory.
+        """
+        from lib.response import Response
+        from lib.spectral_fit import TableModel, ModelGrid
+        spec_dir = os.path.join(self.directory, 'extract')
+        os.makedirs(spec_dir, exist_ok=True)
+        self.table_path = self.write_table_model(os.path.join(self.directory, 'apec_table.fits'))
+        rmf_path, arf_path = os.path.join(spec_dir, 'spec.rmf'), os.path.join(spec_dir, 'spec.arf')
+        self.write_response(rmf_path, arf_path)
+        grid = ModelGrid(TableModel.read(self.table_path), Response.from_files(rmf_path, arf_path), self.redshift, nH)
+        radius = np.tile(self.radius_kpc(), self.n_sectors)
+        temperature = self.temperature_model(radius)
+        norm = norm_scale * 1e-3 * (1 + (radius / 70.0)**2)**(1 - 3 * self.beta) / self.n_sectors
+        rates = grid.evaluate(temperature, np.full(temperature.size, abundance))
+        channels = np.arange(1, rates.shape[-1] + 1)
+        for i in range(temperature.size):
+            background_rate = 1e-5 * np.ones(channels.size)
+            source = self.rng.poisson(exposure * (norm[i] * rates[i] + background_rate))
+            background = self.rng.poisson(exposure * background_rate)
+            for name, counts, backfile in ((f'spec_espectro_{i}_grp.pi', source, f'spec_espectro_{i}_bkg.pi'),
+                                           (f'spec_espectro_{i}_bkg.pi', background, 'none')):
+                hdu = fits.BinTableHDU.from_columns([fits.Column(name='CHANNEL', format='J', array=channels),
+                                                     fits.Column(name='COUNTS', format='J', array=counts)],
+                                                    name='SPECTRUM')
+                for key, value in (('EXPOSURE', exposure), ('BACKSCAL', 1.0), ('RESPFILE', 'spec.rmf'),
+                                   ('ANCRFILE', 'spec.arf'), ('BACKFILE', backfile), ('HDUCLASS', 'OGIP'),
+                                   ('HDUCLAS1', 'SPECTRUM'), ('CHANTYPE', 'PI'), ('POISSERR', True)):
+                    hdu.header[key] = value
+                fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(os.path.join(spec_dir, name), overwrite=True)
+        self.spectra_truth = (temperature, norm)
+        return spec_dir
@@ -0,0 +1,21 @@
+import sys
+from lib.bootstrap import ProfileBootstrap
+from variables import reg_path, pkl_temp_path, redshift, cooling_function
+
+# Bootstrap dos ajustes de T(r) e do modelo beta, com as distribuições de massa, R_cool e R_Δ
+# Uso: python bootstrap_perfis.py surface_brighness.fits [n_reamostragens] [processos] [residuals|pairs]
+# Mesma semente, mesmo resultado (independente do número de processos)
+r_profile_fits_path = sys.argv[1]
+n_reamostragens = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+processos = int(sys.argv[3]) if len(sys.argv) > 3 else None
+metodo = sys.argv[4] if len(sys.argv) > 4 else 'residuals'
+
+bootstrap = ProfileBootstrap.from_files(reg_path, pkl_temp_path, r_profile_fits_path, redshift, method=metodo)
+resultado = bootstrap.run(n_reamostragens, seed=0, max_workers=processos)
+
+print(f"Reamostragens válidas: {resultado.valid.sum()} de {n_reamostragens}")
+print(resultado.parameter_summary())
+for nome, (p16, p50, p84) in resultado.derived_summary([2500, 500], redshift, cooling_function).items():
+    print(f"{nome} = {p50:.4g} +{p84 - p50:.2g} -{p50 - p16:.2g}")
+resultado.samples.to_csv('bootstrap_parametros.csv', index=False)
+print("bootstrap_parametros.csv escrito")
@@ -0,0 +1,12 @@
+import sys
+from lib.fit_results import FitResultTable
+
+# Converte os pickles antigos do XSPEC para a tabela FITS de resultados
+# Uso: python converte_resultados.py temp_teste_1.pkl normalizacao_teste_1.pkl ajuste_apec.fits [redshift nH]
+pkl_temp_path, pkl_norm_path, output_path = sys.argv[1:4]
+provenance = {'MODEL': 'phabs*apec'}
+if len(sys.argv) > 5:
+    provenance.update({'REDSHIFT': float(sys.argv[4]), 'NH': float(sys.argv[5])})
+
+FitResultTable.from_pickles(pkl_temp_path, pkl_norm_path, provenance=provenance).write(output_path)
+print(f"{output_path} escrito")
@@ -4,14 +4,14 @@ from variables import *
 from lib import *
 import numpy as np
 
-processor = Density_Processor(pkl_norm_path)
-processor.density_estimator(0.032, 1.2)
+processor = Density_Processor(pkl_norm_path, reg_path)
+processor.density_estimator(redshift, mu)
 Raio = RegionProcessor(reg_path).kpc_Radius(redshift)
 
 processor_2 = RegionProcessor(reg_path)
 processor_2.erro_region()
 erro_region = np.array(processor_2.list_erro_region)
-erro_region = (UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(erro_region),0.032))/2
+erro_region = (UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(erro_region),redshift))/2
 densidades = processor.densidades
 
 print(erro_region)
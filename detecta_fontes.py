@@ -0,0 +1,21 @@
+import sys
+from lib.source_detection import SourceDetector
+from lib.regions import write_excluded_region_file
+from variables import reg_path
+
+# Detecção de fontes pontuais (wavelet chapéu mexicano em várias escalas, por FFT) na imagem de contagens
+# Uso: python detecta_fontes.py contagens.img [expmap.fits] [limiar_sigma]
+# Escreve fontes.reg e region_fontes.reg (os anéis de reg_path com as fontes que os cruzam excluídas);
+# as detecções dentro do anel mais interno são o núcleo do aglomerado e não são excluídas
+image_path = sys.argv[1]
+expmap_path = sys.argv[2] if len(sys.argv) > 2 else None
+limiar = float(sys.argv[3]) if len(sys.argv) > 3 else 5.0
+
+detector = SourceDetector.from_images(image_path, expmap_path, threshold=limiar)
+deteccoes = detector.detect()
+fontes = deteccoes.outside_core(reg_path)
+print(fontes.to_dataframe().to_string(index=False))
+print(f"{len(fontes)} fontes ({len(deteccoes) - len(fontes)} detecções no núcleo descartadas)")
+
+fontes.write('fontes.reg')
+write_excluded_region_file(reg_path, fontes.circles(), 'region_fontes.reg')
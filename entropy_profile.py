@@ -3,8 +3,8 @@ from variables import *
 
 #Densidades
 
-processor_3 = Density_Processor(pkl_norm_path)
-processor_3.density_estimator(0.032, 1.2)
+processor_3 = Density_Processor(pkl_norm_path, reg_path)
+processor_3.density_estimator(redshift, mu)
 densidades = processor_3.densidades
 
 # Temperatura
@@ -20,7 +20,7 @@ mean_errors = processor.erro
 processor_2 = RegionProcessor(reg_path)
 processor_2.erro_region()
 erro_region = np.array(processor_2.list_erro_region)
-erro_region = (UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(erro_region),0.032))/2
+erro_region = (UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(erro_region),redshift))/2
 
 Entropy = []
 
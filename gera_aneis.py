@@ -0,0 +1,21 @@
+import sys
+from lib.adaptive_annuli import AdaptiveBinner
+
+# Gera anéis adaptativos com contagens líquidas (ou S/N) mínimas por anel
+# Uso: python gera_aneis.py evt.fits region.reg x_centro y_centro r_max alvo [contagens|snr] [bkg_evt.fits escala]
+evt_path, output_path = sys.argv[1:3]
+center = (float(sys.argv[3]), float(sys.argv[4]))
+r_max = float(sys.argv[5])
+target = float(sys.argv[6])
+mode = sys.argv[7] if len(sys.argv) > 7 else 'contagens'
+bkg_path = sys.argv[8] if len(sys.argv) > 8 else None
+bkg_scale = float(sys.argv[9]) if len(sys.argv) > 9 else 1.0
+
+binner = AdaptiveBinner.from_events(evt_path, center, energy_range=(500, 7000), bkg_path=bkg_path,
+                                    bkg_scale=bkg_scale)
+edges = binner.edges(target, mode='snr' if mode == 'snr' else 'counts', r_max=r_max)
+binner.write_regions(output_path, edges)
+net, error, snr = binner.bin_counts(edges)
+for r_in, r_out, n, s in zip(edges[:-1], edges[1:], net, snr):
+    print(f"{r_in:8.1f} {r_out:8.1f} {n:10.0f} {s:8.1f}")
+print(f"{output_path} escrito")
@@ -8,4 +8,26 @@ from .classe_pressao import *
 from .classe_cooling_time import *
 #from .Classe_massa import *
 from .superficie_de_brilho import *
-from .teste_classe_massa import *
\ No newline at end of file
+from .teste_classe_massa import *
+from .batch import *
+from .pipeline import *
+from .instrumentation import *
+from .fit_results import *
+from .radial_profile import *
+from .image_profile import *
+from .centroid import *
+from .adaptive_annuli import *
+from .voronoi_binning import *
+from .sector_profiles import *
+from .response import *
+from .spectral_fit import *
+from .gas_mass import *
+from .symbolic_mass import *
+from .mcmc import *
+from .mass_models import *
+from .bootstrap import *
+from .sensitivity_sweep import *
+from .unbinned_fit import *
+from .image_fit import *
+from .source_detection import *
+from .multi_obs import *
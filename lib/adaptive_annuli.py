@@ -0,0 +1,201 @@
+import numpy as np
+import astropy.io.fits as fits
+
+from lib.image_profile import load_image, physical_transform, physical_grid
+from lib.regions import write_annulus_region_file
+from lib.instrumentation import instrument
+
+
+def _sorted_radii(x, y, center, weights=None):
+    """
+    Radii of the events/pixels around ``center``, sorted, with the cumulative
+    counts at each of them.
+    """
+    r = np.hypot(np.asarray(x, dtype=float) - center[0], np.asarray(y, dtype=float) - center[1])
+    order = np.argsort(r, kind='stable')
+    if weights is None:
+        cumulative = np.arange(1, r.size + 1, dtype=float)
+    else:
+        cumulative = np.cumsum(np.asarray(weights, dtype=float)[order])
+    return r[order], cumulative
+
+
+def _read_events(evt_path, energy_range=None):
+    with fits.open(evt_path, memmap=True) as hdulist:
+        events = hdulist['EVENTS'].data
+        keep = slice(None)
+        if energy_range is not None:
+            keep = (events['energy'] >= energy_range[0]) & (events['energy'] < energy_range[1])
+        return np.array(events['x'][keep]), np.array(events['y'][keep]), None
+
+
+def _read_image(image_path):
+    image, header = load_image(image_path)
+    x, y = physical_grid(image.shape, physical_transform(header))
+    rows, columns = np.nonzero(image)
+    return x[columns], y[rows], np.asarray(image[rows, columns], dtype=float)
+
+
+class AdaptiveBinner:
+    """
+    Chooses annulus edges so that every bin reaches a target of net counts
+    or signal-to-noise ratio.
+
+    The source (and background) counts are sorted by radius once; the
+    cumulative counts on a grid of candidate radii then give the counts of
+    any annulus as a difference, and each outer edge is found with
+    ``np.searchsorted`` on the (monotonic) cumulative target quantity.
+
+    Parameters:
+    -----------
+    center : tuple
+        (x, y) center in physical pixels.
+    radii, cumulative : numpy.ndarray
+        Sorted source radii and the cumulative counts at each of them.
+    bkg_radii, bkg_cumulative : numpy.ndarray, optional
+        The same for a background events file or image (e.g. blank sky)
+        reprojected to the observation.
+    bkg_scale : float
+        Factor applied to the background counts (ratio of exposures/areas).
+    bkg_density : float, optional
+        Uniform background in counts per pixel^2, used instead of a
+        background file (e.g. measured in an outer source-free annulus).
+    """
+
+    def __init__(self, center, radii, cumulative, bkg_radii=None, bkg_cumulative=None, bkg_scale=1.0,
+                 bkg_density=None):
+        self.center = center
+        self.radii = radii
+        self.cumulative = cumulative
+        self.bkg_radii = bkg_radii
+        self.bkg_cumulative = bkg_cumulative
+        self.bkg_scale = bkg_scale
+        self.bkg_density = bkg_density
+
+    @classmethod
+    def from_events(cls, evt_path, center, energy_range=None, bkg_path=None, bkg_scale=1.0, bkg_density=None):
+        """
+        Uses the events of ``evt_path`` (energy range in eV) and, optionally,
+        of a background events file.
+        """
+        x, y, _ = _read_events(evt_path, energy_range)
+        bkg = (None, None)
+        if bkg_path is not None:
+            bx, by, _ = _read_events(bkg_path, energy_range)
+            bkg = _sorted_radii(bx, by, center)
+        return cls(center, *_sorted_radii(x, y, center), *bkg, bkg_scale=bkg_scale, bkg_density=bkg_density)
+
+    @classmethod
+    def from_image(cls, image_path, center, bkg_path=None, bkg_scale=1.0, bkg_density=None):
+        """
+        Uses the pixels of a counts image (and of a background image), in
+        physical coordinates.
+        """
+        x, y, weights = _read_image(image_path)
+        bkg = (None, None)
+        if bkg_path is not None:
+            bx, by, bkg_weights = _read_image(bkg_path)
+            bkg = _sorted_radii(bx, by, center, bkg_weights)
+        return cls(center, *_sorted_radii(x, y, center, weights), *bkg, bkg_scale=bkg_scale,
+                   bkg_density=bkg_density)
+
+    @staticmethod
+    def _counts_within(radii, cumulative, grid):
+        index = np.searchsorted(radii, grid, side='left')
+        return np.concatenate([[0.0], cumulative])[index]
+
+    def cumulative_counts(self, grid):
+        """
+        Net counts and their variance inside each radius of ``grid``.
+        """
+        source = self._counts_within(self.radii, self.cumulative, grid)
+        if self.bkg_radii is not None:
+            bkg = self._counts_within(self.bkg_radii, self.bkg_cumulative, grid)
+            return source - self.bkg_scale * bkg, source + self.bkg_scale**2 * bkg
+        if self.bkg_density is not None:
+            return source - self.bkg_density * np.pi * grid**2, source
+        return source, source
+
+    @instrument('adaptive_edges')
+    def edges(self, target, mode='counts', r_min=0.0, r_max=None, step=0.1, min_width=1.0, max_bins=None,
+              merge_last=True):
+        """
+        Annulus edges (physical pixels) with at least ``target`` net counts
+        (``mode='counts'``) or signal-to-noise ratio (``mode='snr'``) per bin.
+
+        Parameters:
+        -----------
+        r_min, r_max : float
+            Inner radius of the first bin and largest outer radius (the
+            farthest source count by default).
+        step : float
+            Resolution of the candidate radii, in pixels.
+        min_width : float
+            Minimum width of a bin, in pixels.
+        max_bins : int, optional
+            Stop after this many bins.
+        merge_last : bool
+            The counts left beyond the last complete bin are merged into it;
+            otherwise they are dropped.
+
+        Returns:
+        --------
+        numpy.ndarray
+            The edges, from ``r_min`` to the outer radius of the last bin.
+            Raises ValueError when not even one bin reaches ``target``.
+        """
+        if mode not in ('counts', 'snr'):
+            raise ValueError("mode must be 'counts' or 'snr'")
+        r_max = self.radii[-1] if r_max is None else r_max
+        grid = np.arange(r_min, r_max + step, step)
+        grid = grid[grid <= r_max + 1e-9]
+        net, variance = self.cumulative_counts(grid)
+
+        edges_index = [0]
+        while max_bins is None or len(edges_index) <= max_bins:
+            start = edges_index[-1]
+            first = start + max(1, int(np.ceil(min_width / step - 1e-9)))
+            if first >= grid.size:
+                break
+            bin_net = net[first:] - net[start]
+            if mode == 'counts':
+                achieved = bin_net
+            else:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    achieved = np.nan_to_num(bin_net / np.sqrt(variance[first:] - variance[start]))
+            # o fundo pode fazer as contagens líquidas oscilarem: o máximo acumulado é monotônico
+            position = np.searchsorted(np.maximum.accumulate(achieved), target, side='left')
+            if position >= achieved.size:
+                break
+            edges_index.append(first + position)
+
+        if len(edges_index) == 1:
+            total = net[-1] - net[0]
+            if mode == 'counts':
+                reached = f"{total:.1f} net counts"
+            else:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    reached = f"S/N {np.nan_to_num(total / np.sqrt(variance[-1] - variance[0])):.1f}"
+            raise ValueError(f"no bin reaches the target {target:g} between r = {r_min:g} and {r_max:g} pixels "
+                             f"(the whole range has {reached})")
+
+        edges = grid[edges_index]
+        if merge_last and edges.size > 1 and edges[-1] < r_max:
+            edges[-1] = r_max
+        return edges
+
+    def bin_counts(self, edges):
+        """
+        Net counts, their error and the signal-to-noise ratio of each annulus.
+        """
+        net, variance = self.cumulative_counts(np.asarray(edges, dtype=float))
+        net, variance = np.diff(net), np.diff(variance)
+        error = np.sqrt(variance)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return net, error, net / error
+
+    def write_regions(self, reg_path, edges):
+        """
+        Writes the annuli in the ``annulus(...)`` format parsed by RegionProcessor.
+        """
+        write_annulus_region_file(reg_path, self.center[0], self.center[1], edges)
@@ -0,0 +1,591 @@
+import os
+import json
+import logging
+import importlib.util
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import yaml
+from astropy import units as u
+from astropy import constants as const
+from scipy.special import gamma
+
+from lib.converte import UnitConverter
+from lib.temperaturas import CurveFitter
+from lib.radial_profile import Profile
+from lib.superficie_de_brilho import Make_surface_brightness_plot
+from lib.teste_classe_massa import Mass_Calculator
+from lib.gas_mass import GasMassProfile, beta_model_gas_mass
+from lib.mass_models import HydrostaticKernel, MassModelFit
+from lib.unbinned_fit import UnbinnedBetaFit, flux_normalization
+from lib.regions import RegionProcessor, write_excluded_region_file
+from lib.source_detection import SourceDetector
+from lib.instrumentation import profiler, stage
+
+
+logger = logging.getLogger(__name__)
+
+DATA_ANALYSIS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Data_analysis')
+
+
+class ClusterConfig:
+    """
+    Configuration of a single cluster for the batch analysis.
+
+    Attributes:
+    ----------
+    name : str
+        Cluster name, also used as the name of its output directory.
+    reg_path : str
+        Path to the region file with the annuli.
+    pkl_temp_path : str
+        Path to the XSPEC temperature results: a FIT_RESULTS FITS table
+        (see ``lib.fit_results``) or a legacy pickle.
+    pkl_norm_path : str
+        Path to the XSPEC normalization results; same file as
+        ``pkl_temp_path`` when it is a FIT_RESULTS table.
+    r_profile_fits_path : str
+        Path to the dmextract surface brightness FITS file.
+    redshift : float
+        Cluster redshift.
+    mu : float
+        Mean molecular weight used in the density estimate.
+    mu_mass : float
+        Mean molecular weight used in the hydrostatic mass.
+    nH : float
+        Galactic absorption (10^22 cm^-2) used in the spectral fit.
+    abundance : float
+        Initial metal abundance used in the spectral fit.
+    cooling_function : float
+        Cooling function used in the cooling time.
+    exclude_bins : list of int
+        Annuli removed by hand before the T(r) fit.
+    r_delta_kpc : float, optional
+        Radius (kpc) at which the mass is reported in the summary.
+    overdensities : list of float
+        Overdensities (relative to the critical density) whose radius, total
+        and gas mass and gas fraction are reported in the summary.
+    spec_dir : str or list of str, optional
+        Directory with the grouped spectra. When given and the pickles are
+        missing, the XSPEC fit is run first. A list (one directory per
+        ObsID, same regions) is fitted jointly.
+    evt_path : str, optional
+        Clean event file, used by the extraction stages of the pipeline.
+    bkg_path : str, optional
+        Background event file, used by the extraction stages of the pipeline.
+    conda_ciao_env_path : str, optional
+        Conda environment where CIAO is installed.
+    apec_table : str, optional
+        XSPEC table model of apec over (kT, abundance). When given, the
+        spectra are fitted with the native fitter (``lib.spectral_fit``)
+        instead of PyXSPEC.
+    warm_start : bool
+        Seed every fit from earlier results: each annulus from its inner
+        neighbour, and the spectral, T(r) and beta model fits from the
+        results of a previous run in the same output directory.
+    parallel_errors : bool
+        Run the confidence search of each fitted parameter in its own
+        process (XSPEC and native fits, and the sherpa fit when
+        ``sb_error_method`` is ``'confidence'``).
+    sb_error_method : str
+        Sherpa error estimator of the binned beta model fit:
+        ``'covariance'`` (default) or ``'confidence'`` (profile likelihood,
+        asymmetric intervals, slower).
+    sb_method : str
+        ``'binned'`` fits the dmextract profile with sherpa (chi-square);
+        ``'unbinned'`` fits the beta model shape to the photon radii of
+        ``evt_path`` (Cash likelihood with a background term, see
+        ``lib.unbinned_fit``) and takes only the normalization from the profile.
+    mass_model : str, optional
+        Parametric total mass model (``'nfw'``, ``'gnfw'`` or ``'einasto'``,
+        see ``lib.mass_models``) fitted to the projected temperatures,
+        reported next to the direct hydrostatic mass.
+    detect_sources : bool
+        Detect the point sources in ``evt_path`` (``lib.source_detection``)
+        and exclude them from the annuli: the region file with the
+        exclusions replaces ``reg_path`` in the extraction and photon fits.
+    observations : list of dict, optional
+        Several ObsIDs (``obsid``, ``evt_path``, ``bkg_path``) analysed
+        jointly by the pipeline (``lib.multi_obs``), instead of
+        ``evt_path``/``bkg_path``; ``reg_path`` is drawn on the sky frame of
+        the first one. Requires ``apec_table``.
+    """
+
+    DEFAULTS = {
+        'r_profile_fits_path': None,
+        'mu': 1.2,
+        'mu_mass': 0.6,
+        'nH': 0.04,
+        'abundance': 0.4,
+        'cooling_function': 3e-23,
+        'exclude_bins': [],
+        'r_delta_kpc': None,
+        'overdensities': [2500, 500],
+        'spec_dir': None,
+        'evt_path': None,
+        'bkg_path': None,
+        'conda_ciao_env_path': None,
+        'apec_table': None,
+        'warm_start': False,
+        'parallel_errors': False,
+        'sb_error_method': 'covariance',
+        'sb_method': 'binned',
+        'mass_model': None,
+        'detect_sources': False,
+        'observations': None,
+    }
+
+    def __init__(self, name, reg_path, pkl_temp_path, pkl_norm_path, redshift, **kwargs):
+        unknown = set(kwargs) - set(self.DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown cluster config keys for {name}: {sorted(unknown)}")
+        self.name = str(name)
+        self.reg_path = reg_path
+        self.pkl_temp_path = pkl_temp_path
+        self.pkl_norm_path = pkl_norm_path
+        self.redshift = float(redshift)
+        for key, default in self.DEFAULTS.items():
+            setattr(self, key, kwargs.get(key, default))
+        self.exclude_bins = [int(i) for i in (self.exclude_bins or [])]
+
+    @classmethod
+    def from_dict(cls, entry):
+        entry = {key: value for key, value in entry.items() if not _is_missing(value)}
+        if isinstance(entry.get('exclude_bins'), str):
+            entry['exclude_bins'] = [int(i) for i in entry['exclude_bins'].replace(';', ',').split(',') if i.strip()]
+        return cls(**entry)
+
+    PATH_KEYS = ('reg_path', 'pkl_temp_path', 'pkl_norm_path', 'r_profile_fits_path', 'spec_dir', 'evt_path',
+                 'bkg_path', 'conda_ciao_env_path', 'apec_table')
+
+    def resolve_paths(self):
+        """
+        Makes every path of the config absolute (relative to the current
+        directory), so a stage that changes the working directory (the
+        PyXSPEC fit) does not change where the others read and write.
+        """
+        for key in self.PATH_KEYS:
+            setattr(self, key, _absolute_path(getattr(self, key)))
+        if self.observations:
+            self.observations = [{**entry, **{key: _absolute_path(entry[key]) for key in ('evt_path', 'bkg_path')
+                                              if key in entry}} for entry in self.observations]
+        return self
+
+    def to_dict(self):
+        keys = ['name', 'reg_path', 'pkl_temp_path', 'pkl_norm_path', 'redshift'] + list(self.DEFAULTS)
+        return {key: getattr(self, key) for key in keys}
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value)) or value == ''
+
+
+def _absolute_path(path):
+    if path is None:
+        return None
+    if isinstance(path, (list, tuple)):
+        return [_absolute_path(item) for item in path]
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def load_catalogue(path):
+    """
+    Reads a catalogue of cluster configurations.
+
+    Parameters:
+    -----------
+    path : str
+        YAML/JSON file (a list of mappings, or a mapping with a ``clusters``
+        list and optional ``defaults``) or a CSV file with one cluster per row.
+
+    Returns:
+    --------
+    list of ClusterConfig
+        With every path made absolute (see ``ClusterConfig.resolve_paths``).
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        entries = pd.read_csv(path).to_dict(orient='records')
+        defaults = {}
+    else:
+        with open(path, 'r') as file:
+            content = yaml.safe_load(file)
+        if isinstance(content, dict):
+            defaults = content.get('defaults', {})
+            entries = content['clusters']
+        else:
+            defaults = {}
+            entries = content
+    configs = [ClusterConfig.from_dict({**defaults, **entry}).resolve_paths() for entry in entries]
+    names = [config.name for config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError("Cluster names in the catalogue must be unique")
+    return configs
+
+
+def _load_data_analysis(module_file, function_name):
+    # Os scripts de Data_analysis não formam um pacote (e dependem do CIAO/XSPEC), por isso são carregados sob demanda
+    spec = importlib.util.spec_from_file_location(os.path.splitext(module_file)[0], os.path.join(DATA_ANALYSIS_DIR, module_file))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, getattr(module, function_name)
+
+
+def run_spectral_fit(config, output_dir, spec_dir=None):
+    """
+    Runs the phabs*apec fit for every annulus using the cluster's nH,
+    abundance and redshift. The native fitter is used when
+    ``config.apec_table`` is set, PyXSPEC otherwise. With
+    ``config.warm_start`` the annuli are seeded from their neighbours and
+    from the table of a previous run, if any. ``spec_dir`` replaces
+    ``config.spec_dir``; a list (one directory per ObsID) is fitted
+    jointly, with the native fitter only. ``config`` is not modified.
+
+    Returns:
+    --------
+    str
+        Path of the fit result table (``ajuste_apec.fits`` in ``output_dir``).
+    """
+    spec_dir = config.spec_dir if spec_dir is None else spec_dir
+    if not isinstance(spec_dir, str) and config.apec_table is None:
+        raise ValueError(f"{config.name}: the joint fit of several observations requires apec_table")
+    previous_results = os.path.join(output_dir, 'ajuste_apec.fits') if config.warm_start else None
+    if config.apec_table is not None:
+        from lib.spectral_fit import ajuste_apec_nativo
+        results_path = ajuste_apec_nativo(spec_dir, config.reg_path, config.apec_table,
+                                          redshift=config.redshift, nH=config.nH, abundance=config.abundance,
+                                          output_dir=output_dir, max_workers=1, warm_start=config.warm_start,
+                                          previous_results=previous_results,
+                                          error_workers=3 if config.parallel_errors else None)
+    else:
+        module, ajuste_apec_xspec = _load_data_analysis('função_ajuste_xspec.py', 'ajuste_apec_xspec')
+        results_path = ajuste_apec_xspec(spec_dir, config.reg_path, module.AllData, module.AllModels,
+                                         redshift=config.redshift, nH=config.nH, abundance=config.abundance,
+                                         output_dir=output_dir, warm_start=config.warm_start,
+                                         previous_results=previous_results, parallel_errors=config.parallel_errors)
+    return results_path
+
+
+def build_profiles(config, pkl_temp_path=None, pkl_norm_path=None):
+    """
+    Builds the radial temperature, density, pressure, entropy and cooling time
+    profiles of one cluster, from ``pkl_temp_path``/``pkl_norm_path`` (e.g.
+    the table of ``run_spectral_fit``) or else from those of the config.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        One row per annulus; annuli whose spectral fit failed are NaN.
+    """
+    profile = Profile.from_fit_results(config.reg_path, pkl_temp_path or config.pkl_temp_path,
+                                       pkl_norm_path or config.pkl_norm_path, config.redshift, config.mu)
+    profile.add_thermodynamics(config.cooling_function)
+    return pd.DataFrame({
+        'radius_kpc': profile.radius,
+        'radius_err_kpc': profile.half_width,
+        'temperature_keV': profile.value('temperature'),
+        'temperature_err_keV': profile.error('temperature'),
+        'density': profile.value('density'),
+        'pressure': profile.value('pressure'),
+        'entropy': profile.value('entropy'),
+        'cooling_time_yr': profile.value('cooling_time'),
+    })
+
+
+def fit_temperature_profile(config, profiles, previous=None):
+    """
+    Fits the T(r) model of ``CurveFitter`` to the temperature profile.
+
+    Bins listed in ``config.exclude_bins`` and bins whose XSPEC fit failed are
+    left out of the fit. ``previous`` (a result of this function) gives the
+    starting parameters.
+
+    Returns:
+    --------
+    dict
+        Parameters a, b, c, d, their errors and the number of fitted bins.
+    """
+    keep = np.isfinite(profiles['temperature_keV'].to_numpy()) & np.isfinite(profiles['temperature_err_keV'].to_numpy())
+    keep[[i for i in config.exclude_bins if i < len(keep)]] = False
+    fit_profiles = profiles[keep]
+
+    fitter = CurveFitter(fit_profiles['radius_kpc'].to_numpy(), fit_profiles['temperature_keV'].to_numpy(),
+                         fit_profiles['radius_err_kpc'].to_numpy(), fit_profiles['temperature_err_keV'].to_numpy())
+    initial_guess = [previous[key] for key in 'abcd'] if previous is not None else None
+    params, params_covariance = fitter.fit_curve(initial_guess)
+    param_errors = fitter.get_param_errors()
+    result = dict(zip(['a', 'b', 'c', 'd'], params))
+    result.update(zip(['a_err', 'b_err', 'c_err', 'd_err'], param_errors))
+    result['n_bins_fit'] = int(keep.sum())
+    return {key: float(value) for key, value in result.items()}
+
+
+def fit_surface_brightness(config, previous=None, reg_path=None, sb_fits_path=None):
+    """
+    Fits the Beta1D model to the dmextract surface brightness profile, or
+    the unbinned beta model to the events when ``config.sb_method`` is
+    ``'unbinned'``; ``previous`` (a result of this function) gives the
+    starting parameters. ``reg_path`` and ``sb_fits_path`` replace
+    ``config.reg_path`` and ``config.r_profile_fits_path`` (e.g. the annuli
+    with the point sources excluded), leaving ``config`` untouched.
+
+    Returns:
+    --------
+    dict
+        beta, r0 (pixel), rc (kpc) and the amplitude (SUR_BRI units), plus
+        the amplitude and background in counts/pixel^2 for the unbinned fit.
+    """
+    reg_path = config.reg_path if reg_path is None else reg_path
+    sb_fits_path = config.r_profile_fits_path if sb_fits_path is None else sb_fits_path
+    if sb_fits_path is None:
+        raise ValueError(f"{config.name}: r_profile_fits_path is required for the mass analysis")
+    if config.sb_method == 'unbinned':
+        return _fit_surface_brightness_unbinned(config, reg_path, sb_fits_path, previous)
+    plotter = Make_surface_brightness_plot(sb_fits_path)
+    plotter.plot_process(None if previous is None else (previous['r0_pixel'], previous['beta'], previous['ampl']),
+                         error_method=config.sb_error_method, parallel_errors=config.parallel_errors)
+    rc = UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(plotter.get_r0()), config.redshift)
+    return {'beta': float(plotter.get_beta()), 'r0_pixel': float(plotter.get_r0()), 'rc_kpc': float(rc),
+            'ampl': float(plotter.get_ampl())}
+
+
+def detect_point_sources(evt_path, reg_path, output_dir):
+    """
+    Detects the point sources in the 0.5-7 keV events over the annuli of
+    ``reg_path``, writes them to ``output_dir/sources.reg`` and the annuli
+    with the overlapping sources excluded to ``output_dir/region_sources.reg``.
+    Detections inside the innermost annulus are the cluster core: they are
+    dropped from the sources, so the core is not excluded from the annuli.
+
+    Returns:
+    --------
+    str
+        Path of the region file with the exclusions.
+    """
+    processor = RegionProcessor(reg_path)
+    processor.parse_file()
+    center = (processor.regions[0].x_center, processor.regions[0].y_center)
+    r_max = max(region.outer_radius for region in processor.regions)
+    detector = SourceDetector.from_events(evt_path, center, r_max, energy_range=(500, 7000))
+    sources = detector.detect().outside_core(reg_path)
+    sources.write(os.path.join(output_dir, 'sources.reg'))
+    output_path = os.path.join(output_dir, 'region_sources.reg')
+    write_excluded_region_file(reg_path, sources.circles(), output_path)
+    return output_path
+
+
+def _fit_surface_brightness_unbinned(config, reg_path, sb_fits_path, previous=None):
+    if config.evt_path is None:
+        raise ValueError(f"{config.name}: evt_path is required for sb_method 'unbinned'")
+    fitter = UnbinnedBetaFit.from_events(config.evt_path, reg_path)
+    start = None
+    if previous is not None and 'ampl_counts' in previous:
+        start = (previous['ampl_counts'], previous['r0_pixel'], previous['beta'], previous['bkg_counts'])
+    fitter.fit(start)
+    rc = UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(fitter.get_r0()), config.redshift)
+    r0_err, beta_err = fitter.get_param_errors()[1:3]
+    return {'beta': float(fitter.get_beta()), 'r0_pixel': float(fitter.get_r0()), 'rc_kpc': float(rc),
+            'ampl': flux_normalization(sb_fits_path, fitter.get_r0(), fitter.get_beta()),
+            'beta_err': float(beta_err), 'r0_pixel_err': float(r0_err),
+            'ampl_counts': float(fitter.get_ampl()), 'bkg_counts': float(fitter.params[3])}
+
+
+def _mass_calculator(config, temperature_fit, sb_fit, R_values):
+    k = const.k_B.value
+    G = const.G.to((u.kpc * u.m**2) / (u.kg * u.s**2)).value
+    mp = const.m_p.value
+    beta = sb_fit['beta']
+    gamma1 = np.float64(gamma(3 * beta))
+    gamma2 = np.float64(gamma(3 * beta - 0.5))
+    return Mass_Calculator(R_values, k, G, config.mu_mass, mp, temperature_fit['c'], temperature_fit['d'],
+                           beta, sb_fit['rc_kpc'], temperature_fit['a'], temperature_fit['b'],
+                           sb_fit['ampl'], gamma1, gamma2)
+
+
+def evaluate_mass(config, temperature_fit, sb_fit, R_values):
+    """
+    Evaluates the hydrostatic mass (M_sun) of ``Mass_Calculator`` at ``R_values`` (kpc).
+    """
+    mass_calculator = _mass_calculator(config, temperature_fit, sb_fit, R_values)
+    return ((mass_calculator.calculate_mass() * u.kg).to(u.solMass)).value
+
+
+def evaluate_gas_mass(config, temperature_fit, sb_fit, R_values):
+    """
+    Evaluates the gas mass (M_sun) within ``R_values`` (kpc) of the beta model
+    density, with the central density of ``Mass_Calculator.calcula_n0``.
+    """
+    mass_calculator = _mass_calculator(config, temperature_fit, sb_fit, R_values)
+    n0 = mass_calculator.calcula_n0(config.cooling_function)
+    return beta_model_gas_mass(R_values, n0, sb_fit['rc_kpc'], sb_fit['beta'])
+
+
+def fit_mass_model(config, profiles, sb_fit, previous=None):
+    """
+    Fits ``config.mass_model`` to the projected temperature profile, with
+    the hydrostatic kernel of the fitted beta model density. Excluded and
+    failed bins are left out, as in ``fit_temperature_profile``.
+
+    Returns:
+    --------
+    MassModelFit
+    """
+    keep = np.isfinite(profiles['temperature_keV'].to_numpy()) & np.isfinite(profiles['temperature_err_keV'].to_numpy())
+    keep[[i for i in config.exclude_bins if i < len(keep)]] = False
+    fit_profiles = profiles[keep]
+    radius = fit_profiles['radius_kpc'].to_numpy()
+    half_width = fit_profiles['radius_err_kpc'].to_numpy()
+    kernel = HydrostaticKernel.from_beta_model(radius - half_width, radius + half_width,
+                                               sb_fit['rc_kpc'], sb_fit['beta'])
+    fit = MassModelFit(kernel, config.mass_model, fit_profiles['temperature_keV'].to_numpy(),
+                       fit_profiles['temperature_err_keV'].to_numpy(), mu=config.mu_mass)
+    prefix = f"{fit.model.name}_"
+    start = None
+    if previous is not None and all(prefix + name in previous for name in fit.parameter_names):
+        start = [previous[prefix + name] for name in fit.parameter_names]
+    fit.fit(start)
+    return fit
+
+
+def build_mass_profile(config, profiles, R_values=None, previous=None, reg_path=None):
+    """
+    Fits T(r) and the beta model and evaluates the hydrostatic mass, as in
+    ``mass_calc.py``, and the gas mass and gas fraction, plus the
+    parametric mass model of ``config.mass_model`` when set. ``previous``
+    (the fit parameters of an earlier run) warm-starts the fits and
+    ``reg_path`` replaces ``config.reg_path`` in the beta model fit (see
+    ``fit_surface_brightness``).
+
+    Returns:
+    --------
+    tuple
+        (DataFrame with R_kpc, M_Msun, Mgas_Msun, f_gas and M_<model>_Msun, dict with the
+        fitted parameters and the values at ``config.overdensities``)
+    """
+    if R_values is None:
+        R_values = np.logspace(1, 3, 100)
+    with stage('temperature_fit'):
+        temperature_fit = fit_temperature_profile(config, profiles, previous)
+    with stage('sb_fit'):
+        sb_fit = fit_surface_brightness(config, previous, reg_path=reg_path)
+    with stage('evaluate_mass'):
+        M_values = evaluate_mass(config, temperature_fit, sb_fit, R_values)
+    with stage('evaluate_gas_mass'):
+        gas = GasMassProfile(R_values, evaluate_gas_mass(config, temperature_fit, sb_fit, R_values), M_values)
+
+    fit_parameters = {**temperature_fit, **sb_fit}
+    if config.r_delta_kpc is not None:
+        fit_parameters['M_delta_Msun'] = float(evaluate_mass(config, temperature_fit, sb_fit, config.r_delta_kpc))
+    fit_parameters.update(gas.summary(config.overdensities, config.redshift))
+    mass_profile = pd.DataFrame({'R_kpc': R_values, 'M_Msun': M_values, 'Mgas_Msun': gas.gas_mass,
+                                 'f_gas': gas.fraction})
+    if config.mass_model is not None:
+        with stage('mass_model_fit'):
+            model_fit = fit_mass_model(config, profiles, sb_fit, previous)
+        mass_profile[f'M_{model_fit.model.name}_Msun'] = model_fit.mass_profile(R_values)
+        fit_parameters.update(model_fit.summary(config.overdensities, config.redshift))
+    return mass_profile, fit_parameters
+
+
+def analyse_cluster(config, output_root):
+    """
+    Runs the full profile and mass analysis of one cluster and writes its
+    results to ``output_root/<name>``.
+
+    When profiling is enabled, the instrumentation report of the cluster is
+    written to ``profile.json``/``profile.folded`` in its output directory.
+
+    Returns:
+    --------
+    dict
+        Row of the summary table. Failures are reported in the ``status``
+        column instead of interrupting the batch.
+    """
+    output_dir = os.path.join(output_root, config.name)
+    os.makedirs(output_dir, exist_ok=True)
+    summary = {'name': config.name, 'redshift': config.redshift, 'status': 'ok'}
+    profiler.reset()
+    try:
+        # anéis com as fontes excluídas, usados no ajuste aos fótons; config continua com os originais
+        reg_path = config.reg_path
+        if config.detect_sources and config.evt_path is not None:
+            with stage('detect_sources'):
+                reg_path = detect_point_sources(config.evt_path, config.reg_path, output_dir)
+
+        pkl_temp_path, pkl_norm_path = config.pkl_temp_path, config.pkl_norm_path
+        if config.spec_dir is not None and not (os.path.exists(pkl_temp_path) and os.path.exists(pkl_norm_path)):
+            with stage('fit_spectra'):
+                pkl_temp_path = pkl_norm_path = run_spectral_fit(config, output_dir)
+            summary['fit_results_path'] = pkl_temp_path
+
+        with stage('profiles'):
+            profiles = build_profiles(config, pkl_temp_path, pkl_norm_path)
+        profiles.to_csv(os.path.join(output_dir, 'profiles.csv'), index=False)
+        summary['n_bins'] = len(profiles)
+        summary['T_mean_keV'] = float(np.nanmean(profiles['temperature_keV']))
+
+        if config.r_profile_fits_path is not None:
+            parameters_path = os.path.join(output_dir, 'fit_parameters.json')
+            previous = None
+            if config.warm_start and os.path.exists(parameters_path):
+                with open(parameters_path, 'r') as file:
+                    previous = json.load(file)
+            with stage('mass'):
+                mass_profile, fit_parameters = build_mass_profile(config, profiles, previous=previous,
+                                                                  reg_path=reg_path)
+            mass_profile.to_csv(os.path.join(output_dir, 'mass_profile.csv'), index=False)
+            with open(parameters_path, 'w') as file:
+                json.dump(fit_parameters, file, indent=2)
+            summary.update(fit_parameters)
+
+        with open(os.path.join(output_dir, 'config.json'), 'w') as file:
+            json.dump(config.to_dict(), file, indent=2)
+    except Exception as e:
+        summary['status'] = f"failed: {type(e).__name__}: {e}"
+        with open(os.path.join(output_dir, 'error.log'), 'w') as file:
+            file.write(traceback.format_exc())
+    if profiler.enabled:
+        profiler.write_report(os.path.join(output_dir, 'profile.json'))
+        summary['wall_s'] = sum(entry['wall_s'] for entry in profiler.report()['entries'] if len(entry['stack']) == 1)
+    return summary
+
+
+def run_batch(configs, output_root, max_workers=None):
+    """
+    Analyses every cluster of the catalogue across a process pool and writes
+    ``output_root/summary.csv``.
+
+    Parameters:
+    -----------
+    configs : list of ClusterConfig or str
+        Cluster configurations, or the path of a catalogue file.
+    output_root : str
+        Directory where the per-cluster results and the summary are written.
+    max_workers : int, optional
+        Number of worker processes. ``1`` runs serially in this process.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        The summary table, in catalogue order.
+    """
+    if isinstance(configs, str):
+        configs = load_catalogue(configs)
+    os.makedirs(output_root, exist_ok=True)
+
+    if max_workers == 1:
+        rows = [analyse_cluster(config, output_root) for config in configs]
+    else:
+        rows_by_name = {}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(analyse_cluster, config, output_root): config.name for config in configs}
+            for future in as_completed(futures):
+                rows_by_name[futures[future]] = future.result()
+                logger.info("%s: %s", futures[future], rows_by_name[futures[future]]['status'])
+        rows = [rows_by_name[config.name] for config in configs]
+
+    summary = pd.DataFrame(rows)
+    summary.to_csv(os.path.join(output_root, 'summary.csv'), index=False)
+    return summary
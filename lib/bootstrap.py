@@ -0,0 +1,422 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.special import gamma
+
+from lib.converte import UnitConverter
+from lib.temperaturas import CurveFitter
+from lib.symbolic_mass import SymbolicMassModel
+from lib.gas_mass import overdensity_radius
+from lib.mcmc import load_joint_profiles
+from lib.instrumentation import instrument
+
+
+def temperature_model(R, params):
+    """
+    T(R) of ``CurveFitter.model_function`` for rows of ``params`` (a, b, c, d).
+    """
+    a, b, c, d = (params[:, [i]] for i in range(4))
+    return a + b * np.exp(-c * R) - d * R
+
+
+def _temperature_linear_fit(R, y, sigma, c):
+    # com c fixo, a, b e d entram linearmente: mínimos quadrados ponderados de todas as linhas de uma vez
+    R = np.broadcast_to(R, y.shape)
+    design = np.stack([np.ones_like(R), np.exp(-c[:, np.newaxis] * R), -R], axis=-1) / sigma[..., np.newaxis]
+    target = y / sigma
+    with np.errstate(all='ignore'):
+        normal = np.einsum('mni,mnj->mij', design, design)
+        # linhas singulares (exp(-c R) nulo em todos os raios, ou menos de três raios distintos numa
+        # reamostragem de pares) não determinam a, b e d: resolvidas com a identidade e chi2 infinito
+        singular = ~(np.abs(np.linalg.det(normal)) > 0)
+        normal[singular] = np.eye(3)
+        coefficients = np.linalg.solve(normal, np.einsum('mni,mn->mi', design, target)[..., np.newaxis])[..., 0]
+        chi2 = np.sum((target - np.einsum('mni,mi->mn', design, coefficients))**2, axis=-1)
+    return coefficients, np.where(np.isfinite(chi2) & ~singular, chi2, np.inf)
+
+
+def fit_temperature_batch(R, y, sigma, c_guess, span=3.0, n_grid=91, n_refine=60):
+    """
+    Fits T(R) = a + b exp(-c R) - d R to every row of ``y`` at once by
+    variable projection: a, b and d are solved in closed form for each c,
+    and c is located on a grid around ``c_guess`` (``span`` decades either
+    side, same sign) and refined by golden-section search. This avoids the
+    slow crawl of gradient methods along the a-b-c valley of the model.
+
+    Parameters:
+    -----------
+    R : numpy.ndarray
+        (n,) shared or (m, n) per-row radii.
+    y, sigma : numpy.ndarray
+        (m, n) temperatures and errors.
+
+    Returns:
+    --------
+    tuple
+        (params (m, 4) as a, b, c, d, chi2 (m,))
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), y.shape)
+    m = y.shape[0]
+    grid = c_guess * np.logspace(-span, span, n_grid)
+    # acima de c_max, exp(-c R_min) deixa de ser representável e a coluna de b zera em todas as linhas
+    R_min = np.min(np.abs(R)[np.abs(R) > 0]) if np.any(np.abs(R) > 0) else 1.0
+    c_max = -np.log(np.finfo(float).tiny) / R_min
+    grid = np.clip(grid, -c_max, c_max)
+    profile = np.column_stack([_temperature_linear_fit(R, y, sigma, np.full(m, c))[1] for c in grid])
+    best = np.argmin(profile, axis=1)
+    lower = grid[np.clip(best - 1, 0, n_grid - 1)]
+    upper = grid[np.clip(best + 1, 0, n_grid - 1)]
+    ratio = (np.sqrt(5) - 1) / 2
+    left, right = upper - ratio * (upper - lower), lower + ratio * (upper - lower)
+    chi2_left = _temperature_linear_fit(R, y, sigma, left)[1]
+    chi2_right = _temperature_linear_fit(R, y, sigma, right)[1]
+    for _ in range(n_refine):
+        # mínimo à esquerda: o intervalo vira [lower, right]; senão [left, upper]
+        move = chi2_left < chi2_right
+        upper = np.where(move, right, upper)
+        lower = np.where(move, lower, left)
+        new_left = np.where(move, upper - ratio * (upper - lower), right)
+        new_right = np.where(move, left, lower + ratio * (upper - lower))
+        known = np.where(move, chi2_left, chi2_right)
+        chi2_new = _temperature_linear_fit(R, y, sigma, np.where(move, new_left, new_right))[1]
+        chi2_left = np.where(move, chi2_new, known)
+        chi2_right = np.where(move, known, chi2_new)
+        left, right = new_left, new_right
+    c = 0.5 * (lower + upper)
+    coefficients, chi2 = _temperature_linear_fit(R, y, sigma, c)
+    return np.column_stack([coefficients[:, 0], coefficients[:, 1], c, coefficients[:, 2]]), chi2
+
+
+def beta_model(r, params):
+    """
+    Surface brightness ampl (1 + (r/r0)^2)^(0.5 - 3 beta) of the sherpa
+    Beta1D model (xpos = 0) for rows of ``params`` (ampl, r0, beta).
+    """
+    ampl, r0, beta = (params[:, [i]] for i in range(3))
+    return ampl * (1 + (r / r0)**2)**(0.5 - 3 * beta)
+
+
+def beta_jacobian(r, params):
+    ampl, r0, beta = (params[:, [i]] for i in range(3))
+    u = 1 + (r / r0)**2
+    f = ampl * u**(0.5 - 3 * beta)
+    return np.stack([f / ampl, f * (0.5 - 3 * beta) * (-2 * r**2 / r0**3) / u, -3 * f * np.log(u)], axis=-1)
+
+
+def batch_least_squares(model, jacobian, x, y, sigma, p0, n_iter=100, tol=1e-10):
+    """
+    Levenberg-Marquardt fit of many independent data sets at once: every
+    iteration evaluates the model and Jacobian of all rows in one array
+    call and solves their damped normal equations together.
+
+    Parameters:
+    -----------
+    model, jacobian : callable
+        ``model(x, params)`` -> (m, n) and ``jacobian(x, params)`` -> (m, n, p)
+        for rows of ``params`` (m, p).
+    x : numpy.ndarray
+        (n,) shared or (m, n) per-row abscissae.
+    y, sigma : numpy.ndarray
+        (m, n) data and errors.
+    p0 : numpy.ndarray
+        (p,) or (m, p) starting parameters.
+
+    Returns:
+    --------
+    tuple
+        (params (m, p), chi2 (m,))
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), y.shape)
+    params = np.array(np.broadcast_to(p0, (y.shape[0], np.shape(p0)[-1])), dtype=float)
+
+    def chi2_of(p):
+        with np.errstate(all='ignore'):
+            residual = (y - model(x, p)) / sigma
+            chi2 = np.sum(residual**2, axis=-1)
+        return np.where(np.isfinite(chi2), chi2, np.inf), residual
+
+    chi2, residual = chi2_of(params)
+    damping = np.full(y.shape[0], 1e-3)
+    growth = np.full(y.shape[0], 2.0)
+    active = np.isfinite(chi2)
+    for _ in range(n_iter):
+        if not active.any():
+            break
+        with np.errstate(all='ignore'):
+            J = jacobian(x, params) / sigma[..., np.newaxis]
+            A = np.einsum('mni,mnj->mij', J, J)
+            g = np.einsum('mni,mn->mi', J, residual)
+        diagonal = np.einsum('mii->mi', A)
+        # Marquardt: amortecimento proporcional à diagonal, um por conjunto de dados
+        A_damped = A + (damping[:, np.newaxis] * np.where(diagonal > 0, diagonal, 1.0))[..., np.newaxis] * np.eye(A.shape[-1])
+        step = np.zeros_like(params)
+        solvable = active & np.all(np.isfinite(A_damped), axis=(1, 2)) & np.all(np.isfinite(g), axis=1)
+        if solvable.any():
+            step[solvable] = np.linalg.solve(A_damped[solvable], g[solvable][..., np.newaxis])[..., 0]
+        new_params = params + step
+        new_chi2, new_residual = chi2_of(new_params)
+        better = solvable & (new_chi2 < chi2)
+        converged = better & (chi2 - new_chi2 <= tol * (1 + chi2))
+        # razão entre a redução obtida e a prevista pelo modelo linear (atualização de Nielsen)
+        predicted = np.einsum('mi,mi->m', step, 2 * g - np.einsum('mij,mj->mi', A, step))
+        with np.errstate(all='ignore'):
+            rho = (chi2 - new_chi2) / predicted
+        params[better] = new_params[better]
+        residual[better] = new_residual[better]
+        chi2[better] = new_chi2[better]
+        factor = np.where(better, np.maximum(1 / 3, 1 - (2 * np.nan_to_num(rho) - 1)**3), growth)
+        growth = np.where(better, 2.0, growth * 2)
+        damping = np.where(active, damping * factor, damping)
+        active &= ~converged & (damping < 1e12)
+    return params, chi2
+
+
+def _crossing_radius(R, values, threshold):
+    # primeiro raio em que cada linha de ``values`` (crescente para fora) atinge ``threshold``, interpolado em log
+    above = values >= threshold
+    index = np.argmax(above, axis=-1)
+    crossed = above.any(axis=-1) & (index > 0)
+    index = np.clip(index, 1, R.size - 1)
+    lower = np.take_along_axis(values, index[:, np.newaxis] - 1, axis=-1)[:, 0]
+    upper = np.take_along_axis(values, index[:, np.newaxis], axis=-1)[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.clip((threshold - lower) / (upper - lower), 0.0, 1.0)
+    log_R = np.log(R)
+    radius = np.exp(log_R[index - 1] + weight * (log_R[index] - log_R[index - 1]))
+    return np.where(crossed, radius, np.nan)
+
+
+def _bootstrap_task(bootstrap, seeds):
+    # executado nos processos do pool: um bloco de reamostragens ajustado de forma vetorizada
+    return bootstrap.fit_resamples(seeds)
+
+
+class ProfileBootstrap:
+    """
+    Bootstrap of the T(r) (``CurveFitter``) and beta model fits, and of the
+    profiles derived from them (hydrostatic mass, cooling radius and
+    overdensity radii).
+
+    Every resample draws its own generator from a ``SeedSequence`` child of
+    ``seed``, so the result depends only on the seed, not on how the
+    resamples are split across processes. Each process refits its block of
+    resamples together with ``batch_least_squares``, started from the fit
+    to the full data.
+
+    Parameters:
+    -----------
+    radius, temperature, temperature_err : numpy.ndarray
+        Temperature profile (kpc, keV).
+    sb_radius, sb, sb_err : numpy.ndarray
+        Surface brightness profile (radius in pixels).
+    kpc_per_pixel : float
+        Physical size of one pixel at the cluster redshift.
+    method : str
+        ``'residuals'`` resamples the normalized residuals of the best fit
+        (radii fixed) and ``'pairs'`` resamples the bins with replacement.
+    mu : float
+        Mean molecular weight of the mass.
+    """
+
+    TEMPERATURE_PARAMETERS = ('a', 'b', 'c', 'd')
+    SB_PARAMETERS = ('ampl', 'r0', 'beta')
+
+    def __init__(self, radius, temperature, temperature_err, sb_radius, sb, sb_err, kpc_per_pixel,
+                 method='residuals', mu=0.6):
+        if method not in ('residuals', 'pairs'):
+            raise ValueError(f"Unknown bootstrap method: {method}")
+        self.radius = np.asarray(radius, dtype=float)
+        self.temperature = np.asarray(temperature, dtype=float)
+        self.temperature_err = np.asarray(temperature_err, dtype=float)
+        self.sb_radius = np.asarray(sb_radius, dtype=float)
+        self.sb = np.asarray(sb, dtype=float)
+        self.sb_err = np.asarray(sb_err, dtype=float)
+        self.kpc_per_pixel = kpc_per_pixel
+        self.method = method
+        self.mu = mu
+        self.temperature_params = None
+        self.sb_params = None
+
+    @classmethod
+    def from_files(cls, reg_path, pkl_temp_path, r_profile_fits_path, redshift, exclude_bins=(), **kwargs):
+        """
+        Bootstrap of the profiles read by ``lib.mcmc.load_joint_profiles``.
+        """
+        return cls(*load_joint_profiles(reg_path, pkl_temp_path, r_profile_fits_path, redshift, exclude_bins), **kwargs)
+
+    def fit(self, temperature_guess=None, sb_guess=None):
+        """
+        Fits of the full data: ``CurveFitter`` for T(r) and the beta model.
+        """
+        self.temperature_params, _ = CurveFitter(self.radius, self.temperature, None,
+                                                 self.temperature_err).fit_curve(temperature_guess)
+        if sb_guess is None:
+            sb_guess = (self.sb[0], np.median(self.sb_radius), 0.7)
+        self.sb_params = batch_least_squares(beta_model, beta_jacobian, self.sb_radius, self.sb, self.sb_err,
+                                             np.asarray(sb_guess, dtype=float), n_iter=1000)[0][0]
+        # o modelo só depende de r0^2
+        self.sb_params[1] = abs(self.sb_params[1])
+        return self
+
+    def _resample(self, rng, x, y, sigma, model, params):
+        n = y.size
+        index = rng.integers(n, size=n)
+        if self.method == 'pairs':
+            return x[index], y[index], sigma[index]
+        best = model(x, params[np.newaxis, :])[0]
+        return x, best + sigma * ((y - best) / sigma)[index], sigma
+
+    def fit_resamples(self, seeds):
+        """
+        Draws and fits the resamples of the given ``SeedSequence`` children.
+
+        Returns:
+        --------
+        numpy.ndarray
+            (len(seeds), 7) parameters a, b, c, d, ampl, r0, beta.
+        """
+        resamples = []
+        for seed in seeds:
+            rng = np.random.default_rng(seed)
+            resamples.append((self._resample(rng, self.radius, self.temperature, self.temperature_err,
+                                             temperature_model, self.temperature_params),
+                              self._resample(rng, self.sb_radius, self.sb, self.sb_err, beta_model, self.sb_params)))
+        temperature_data = [np.array(column) for column in zip(*(t for t, _ in resamples))]
+        sb_data = [np.array(column) for column in zip(*(s for _, s in resamples))]
+        if self.method == 'residuals':
+            # raios fixos: uma abscissa comum a todas as linhas
+            temperature_data[0] = self.radius
+            sb_data[0] = self.sb_radius
+        temperature_params, _ = fit_temperature_batch(*temperature_data, self.temperature_params[2])
+        sb_params, _ = batch_least_squares(beta_model, beta_jacobian, *sb_data, self.sb_params)
+        sb_params[:, 1] = np.abs(sb_params[:, 1])
+        return np.hstack([temperature_params, sb_params])
+
+    @instrument('bootstrap')
+    def run(self, n_resamples=1000, seed=None, max_workers=None, chunk_size=250):
+        """
+        Fits ``n_resamples`` resamples, across a process pool when
+        ``max_workers`` > 1.
+
+        Returns:
+        --------
+        BootstrapResult
+        """
+        if self.temperature_params is None:
+            self.fit()
+        seeds = np.random.SeedSequence(seed).spawn(n_resamples)
+        chunks = [seeds[i:i + chunk_size] for i in range(0, n_resamples, chunk_size)]
+        if max_workers and max_workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                params = list(executor.map(_bootstrap_task, [self] * len(chunks), chunks))
+        else:
+            params = [self.fit_resamples(chunk) for chunk in chunks]
+        best = np.concatenate([self.temperature_params, self.sb_params])
+        return BootstrapResult(self, best, np.vstack(params))
+
+
+class BootstrapResult:
+    """
+    Parameters of every bootstrap resample and the distributions of the
+    derived profiles, all evaluated on the resamples at once.
+
+    Attributes:
+    ----------
+    best : numpy.ndarray
+        Parameters of the fit to the full data.
+    samples : pandas.DataFrame
+        One row per resample, columns a, b, c, d, ampl, r0, beta.
+    """
+
+    def __init__(self, bootstrap, best, samples):
+        self.bootstrap = bootstrap
+        self.best = best
+        parameters = ProfileBootstrap.TEMPERATURE_PARAMETERS + ProfileBootstrap.SB_PARAMETERS
+        self.samples = pd.DataFrame(samples, columns=parameters)
+
+    @property
+    def valid(self):
+        """
+        Resamples whose fits converged to finite, physical parameters (r0, beta > 0).
+        """
+        values = self.samples.to_numpy()
+        return np.all(np.isfinite(values), axis=1) & (self.samples['r0'].to_numpy() > 0) & (self.samples['beta'].to_numpy() > 0)
+
+    def parameter_summary(self, percentiles=(16, 50, 84)):
+        """
+        Best fit and percentiles of every parameter over the valid resamples.
+        """
+        table = self.samples[self.valid].quantile(np.asarray(percentiles) / 100).T
+        table.columns = [f'p{q:g}' for q in percentiles]
+        table.insert(0, 'best', self.best)
+        table['std'] = self.samples[self.valid].std()
+        return table
+
+    def _model_parameters(self):
+        values = self.samples[self.valid]
+        return {'a': values['a'].to_numpy()[:, np.newaxis], 'b': values['b'].to_numpy()[:, np.newaxis],
+                'c': values['c'].to_numpy()[:, np.newaxis], 'd': values['d'].to_numpy()[:, np.newaxis], 'n0': 1.0,
+                'rc': values['r0'].to_numpy()[:, np.newaxis] * self.bootstrap.kpc_per_pixel,
+                'beta': values['beta'].to_numpy()[:, np.newaxis]}
+
+    def mass_profiles(self, R_values):
+        """
+        Hydrostatic mass (M_sun) at ``R_values`` (kpc) of every valid resample.
+        """
+        model = SymbolicMassModel.from_names('exponential', 'beta')
+        return model.mass_profile(np.asarray(R_values, dtype=float), mu=self.bootstrap.mu, **self._model_parameters())
+
+    def overdensity_radii(self, deltas, redshift, R_values=None):
+        """
+        Radius (kpc) and mass (M_sun) at each overdensity for every valid
+        resample. Raises RuntimeError when no resample reaches an
+        overdensity inside ``R_values``.
+        """
+        if R_values is None:
+            R_values = np.geomspace(10, 5000, 500)
+        mass = self.mass_profiles(R_values)
+        result = {}
+        for delta in deltas:
+            label = int(delta) if float(delta).is_integer() else delta
+            radius, index, weight = overdensity_radius(R_values, mass, delta, redshift)
+            if radius.size and not np.isfinite(radius).any():
+                raise RuntimeError(f"No bootstrap realization reaches the overdensity {label} between "
+                                   f"{R_values[0]:g} and {R_values[-1]:g} kpc")
+            result[f'R{label}_kpc'] = radius
+            with np.errstate(divide='ignore', invalid='ignore'):
+                lower = np.log(np.take_along_axis(mass, index[:, np.newaxis], axis=-1)[:, 0])
+                upper = np.log(np.take_along_axis(mass, index[:, np.newaxis] + 1, axis=-1)[:, 0])
+                result[f'M{label}_Msun'] = np.exp(lower + weight * (upper - lower))
+        return result
+
+    def cooling_radius(self, cooling_function, threshold_yr=7.7e9, R_values=None):
+        """
+        Radius (kpc) where the cooling time of the model profiles reaches
+        ``threshold_yr``, for every valid resample. The density is the beta
+        model with the central density of ``Mass_Calculator.calcula_n0`` and
+        the cooling time uses the formula of ``cooling_time``.
+        """
+        if R_values is None:
+            R_values = np.geomspace(1, 1000, 500)
+        values = self.samples[self.valid]
+        ampl, beta = values['ampl'].to_numpy()[:, np.newaxis], values['beta'].to_numpy()[:, np.newaxis]
+        rc = values['r0'].to_numpy()[:, np.newaxis] * self.bootstrap.kpc_per_pixel
+        with np.errstate(divide='ignore', invalid='ignore'):
+            n0 = np.sqrt(ampl / (np.sqrt(np.pi) * UnitConverter.kpc_to_cm(rc) * cooling_function)
+                         * gamma(3 * beta) / gamma(3 * beta - 0.5))
+            n = n0 * (1 + (R_values / rc)**2)**(-1.5 * beta)
+            temperature = temperature_model(R_values, values[list(ProfileBootstrap.TEMPERATURE_PARAMETERS)].to_numpy())
+            cooling_time = 3 * 3.17098e-8 * (2 * n * temperature) * 1.60218e-9 / (2 * n**2 * cooling_function)
+        return _crossing_radius(np.asarray(R_values, dtype=float), cooling_time, threshold_yr)
+
+    def derived_summary(self, deltas, redshift, cooling_function, percentiles=(16, 50, 84)):
+        """
+        Percentiles of R_cool and of the radius and mass at each overdensity.
+        """
+        derived = self.overdensity_radii(deltas, redshift)
+        derived['R_cool_kpc'] = self.cooling_radius(cooling_function)
+        return {name: np.nanpercentile(values, percentiles) if np.isfinite(values).any()
+                else np.full(len(percentiles), np.nan) for name, values in derived.items()}
@@ -0,0 +1,161 @@
+import numpy as np
+import astropy.io.fits as fits
+from scipy.ndimage import gaussian_filter
+
+from lib.converte import UnitConverter
+from lib.image_profile import load_image, physical_transform, physical_grid
+from lib.regions import write_annulus_region_file
+from lib.instrumentation import instrument
+
+
+class CentroidFinder:
+    """
+    Finds the cluster center on a counts image or an event list.
+
+    The centroid is refined iteratively with the first moments of the counts
+    inside circular apertures that shrink from ``radii[0]`` to ``radii[-1]``;
+    each aperture is re-centered until the shift is below ``tolerance``. The
+    X-ray peak (maximum of the smoothed image) is also available, and
+    ``compare`` reports the centroid-peak offset, a common dynamical-state
+    indicator.
+
+    Parameters:
+    -----------
+    x, y : numpy.ndarray
+        Physical coordinates of the events or of the pixel centers.
+    weights : numpy.ndarray, optional
+        Counts of each pixel (None for events, which all weigh 1).
+    """
+
+    def __init__(self, x, y, weights=None):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+        self._image = None
+
+    @classmethod
+    def from_events(cls, evt_path, energy_range=None):
+        """
+        Reads the sky x/y columns of an event file (optionally within an
+        energy range in eV).
+        """
+        with fits.open(evt_path, memmap=True) as hdulist:
+            events = hdulist['EVENTS'].data
+            keep = slice(None)
+            if energy_range is not None:
+                keep = (events['energy'] >= energy_range[0]) & (events['energy'] < energy_range[1])
+            return cls(np.array(events['x'][keep]), np.array(events['y'][keep]))
+
+    @classmethod
+    def from_image(cls, image_path):
+        """
+        Uses the non-empty pixels of a counts image, in physical coordinates.
+        """
+        image, header = load_image(image_path)
+        transform = physical_transform(header)
+        x, y = physical_grid(image.shape, transform)
+        rows, columns = np.nonzero(image)
+        finder = cls(x[columns], y[rows], weights=image[rows, columns])
+        finder._image = (np.asarray(image, dtype=float), transform)
+        return finder
+
+    @instrument('centroid')
+    def centroid(self, start, radii, tolerance=0.05, max_iterations=50):
+        """
+        Iterative centroid within shrinking apertures.
+
+        Parameters:
+        -----------
+        start : tuple
+            Initial (x, y) guess, e.g. the region file center or the peak.
+        radii : sequence of float
+            Aperture radii in physical pixels, from the largest to the smallest.
+        tolerance : float
+            Convergence threshold of the shift, in pixels.
+
+        Returns:
+        --------
+        tuple
+            (x, y) of the centroid.
+        """
+        xc, yc = float(start[0]), float(start[1])
+        # as iterações só usam os eventos de um disco (x, y, raio) que contém a abertura, com folga de um raio
+        # para o centro se deslocar; quando a abertura sai do disco, a seleção é refeita
+        x, y, weights = self.x, self.y, self.weights
+        disc = None
+        for radius in radii:
+            for _ in range(max_iterations):
+                if disc is None or np.hypot(xc - disc[0], yc - disc[1]) + radius > disc[2]:
+                    new_disc = (xc, yc, 2 * radius)
+                    if disc is None or np.hypot(xc - disc[0], yc - disc[1]) + new_disc[2] > disc[2]:
+                        # o novo disco não cabe no anterior: seleciona de todos os eventos
+                        x, y, weights = self.x, self.y, self.weights
+                    near = (x - xc)**2 + (y - yc)**2 < new_disc[2]**2
+                    x, y = x[near], y[near]
+                    weights = None if weights is None else weights[near]
+                    disc = new_disc
+                dx, dy = x - xc, y - yc
+                inside = dx * dx + dy * dy < radius * radius
+                w = None if weights is None else weights[inside]
+                total = np.count_nonzero(inside) if w is None else w.sum()
+                if total == 0:
+                    raise RuntimeError(f"No counts inside the {radius} pixel aperture around ({xc:.1f}, {yc:.1f})")
+                shift_x = np.average(dx[inside], weights=w)
+                shift_y = np.average(dy[inside], weights=w)
+                xc, yc = xc + shift_x, yc + shift_y
+                if np.hypot(shift_x, shift_y) < tolerance:
+                    break
+        return xc, yc
+
+    def _binned_image(self, bin_size):
+        if self._image is not None:
+            return self._image
+        # eventos: imagem binada na parte central (1-99%) dos eventos, com a transformação física equivalente;
+        # a lista inteira do detector geraria uma imagem enorme e quase vazia
+        (x_low, x_high), (y_low, y_high) = np.percentile(self.x, [1, 99]), np.percentile(self.y, [1, 99])
+        x0 = np.floor(x_low) - 0.5
+        y0 = np.floor(y_low) - 0.5
+        nx = int(np.ceil((x_high - x0) / bin_size)) + 1
+        ny = int(np.ceil((y_high - y0) / bin_size)) + 1
+        image, _, _ = np.histogram2d(self.y, self.x, bins=(ny, nx),
+                                     range=[[y0, y0 + ny * bin_size], [x0, x0 + nx * bin_size]])
+        transform = (1.0 / bin_size, 0.5 - x0 / bin_size, 1.0 / bin_size, 0.5 - y0 / bin_size)
+        return image, transform
+
+    @instrument('find_peak')
+    def peak(self, smoothing=3.0, bin_size=1.0):
+        """
+        Position of the maximum of the image smoothed with a Gaussian of
+        ``smoothing`` image pixels.
+        """
+        image, transform = self._binned_image(bin_size)
+        smoothed = gaussian_filter(image, smoothing)
+        row, column = np.unravel_index(np.argmax(smoothed), smoothed.shape)
+        x, y = physical_grid(image.shape, transform)
+        return x[column], y[row]
+
+    def compare(self, radii, start=None, smoothing=3.0, redshift=None):
+        """
+        Computes the peak and the centroid (started from the peak unless
+        ``start`` is given) and their offset.
+
+        Returns:
+        --------
+        dict
+            peak, centroid, offset in pixels and arcsec (and kpc when
+            ``redshift`` is given).
+        """
+        peak = self.peak(smoothing=smoothing)
+        centroid = self.centroid(peak if start is None else start, radii)
+        offset = float(np.hypot(centroid[0] - peak[0], centroid[1] - peak[1]))
+        result = {'peak': peak, 'centroid': centroid, 'offset_pixel': offset,
+                  'offset_arcsec': UnitConverter.pixel_to_arcsec(offset)}
+        if redshift is not None:
+            result['offset_kpc'] = UnitConverter.arcsec_to_kpc(result['offset_arcsec'], redshift)
+        return result
+
+    def write_regions(self, reg_path, center, edges):
+        """
+        Writes the ``annulus(...)`` region file around the chosen center.
+        """
+        write_annulus_region_file(reg_path, center[0], center[1], edges)
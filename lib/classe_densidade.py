@@ -6,20 +6,32 @@ import numpy as np
 import matplotlib.pyplot as plt
 from lib.converte import *
 from astropy import units as u
+from lib.instrumentation import instrument
+from lib.fit_results import load_fit_rows
+
+
+def calcula_densidade_array(z, mu, N, R_out, R_in, DA=None):
+    '''Versão vetorizada de Density_Processor.calcula_densidade (N, R_out e R_in em arrays, raios em cm)
+    DA: distância de diâmetro angular em cm (Planck15 se None); pode ser um array para varrer cosmologias'''
+    if DA is None:
+        DA = UnitConverter.mpc_to_cm((Planck15.angular_diameter_distance(z)).value)
+    return (10**7) * (1 + z) * DA * np.sqrt((3 * mu * np.asarray(N, dtype=float)) / (R_out**3 - R_in**3))
 
 
 class Density_Processor:
-    def __init__(self, pkl_norm_path):
+    def __init__(self, pkl_norm_path, reg_path):
         self.pkl_norm_path = pkl_norm_path
+        self.reg_path = reg_path
         self.norm = []
         self.erro = []
         self.densidades = []
+        self.norm_carregado = None
             
     def open_file(self):
-        '''Abre o arquivo'''
-        with open(self.pkl_norm_path, 'rb') as arquivo1:
-            norm_carregado = pickle.load(arquivo1)
-            return norm_carregado
+        '''Abre o arquivo uma única vez (tabela FITS de resultados mapeada em memória ou pickle antigo)'''
+        if self.norm_carregado is None:
+            self.norm_carregado = load_fit_rows(self.pkl_norm_path, 'norm')
+        return self.norm_carregado
 
     def error_estimator(self):  
         norm_carregado = self.open_file()
@@ -36,6 +48,7 @@ class Density_Processor:
         for i in norm_carregado[:, 0]:
             self.norm.append(i)
     
+    @instrument('calcula_densidade')
     def calcula_densidade(self, z, mu, N, R_out, R_in):
         cosmo = Planck15
         DA = UnitConverter.mpc_to_cm((cosmo.angular_diameter_distance(z)).value)
@@ -43,7 +56,7 @@ class Density_Processor:
     
     def density_estimator(self, z, mu):
         self.norm_estimator()
-        processor = RegionProcessor('/home/vitorfermiano/Documentos/4976/repro/region.reg')
+        processor = RegionProcessor(self.reg_path)
         processor.make_inner_radius_list()
         processor.make_out_radius_list()
         raio_interno = processor.list_innerradius
@@ -1,6 +1,7 @@
 import numpy as np
 import uncertainties as un
 from astropy.cosmology import Planck15
+from lib.instrumentation import instrument
 
 class UnitConverter:
     @staticmethod
@@ -19,6 +20,7 @@ class UnitConverter:
         return pixel * 0.492
 
     @staticmethod
+    @instrument('arcsec_to_mpc')
     def arcsec_to_mpc(angular_size_arcsec, redshift, H0=70.0, Omega_M=0.3, Omega_Lambda=0.7):
         # Convert angular size to radians
         angular_size_rad = np.radians(angular_size_arcsec / 3600.0)
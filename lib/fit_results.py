@@ -0,0 +1,199 @@
+import os
+import pickle
+import datetime
+
+import numpy as np
+import astropy.io.fits as fits
+from numpy.lib import recfunctions
+
+
+def rows_to_float(rows):
+    """
+    Converts ``[value, +err, -err]`` object rows to an (n, 3) float array;
+    rows of ``None`` (failed fits) become NaN.
+    """
+    rows = np.array([[np.nan] * 3 if row is None or row[0] is None else row for row in rows], dtype=float)
+    return rows.reshape(-1, 3)
+
+
+def is_fit_table(path):
+    """
+    True if ``path`` is a FITS fit result table rather than a legacy pickle.
+    """
+    return os.path.splitext(str(path))[1].lower() in ('.fits', '.fit', '.fts')
+
+
+def load_fit_rows(path, name):
+    """
+    Reads the ``[value, +err, -err]`` rows of one parameter (``'kT'``,
+    ``'abundance'`` or ``'norm'``) from a FIT_RESULTS table or from a legacy
+    pickle holding that parameter.
+
+    Unlike ``FitResultTable.open``, this is not zero-copy: the table is
+    memory-mapped only while the rows are read, then they are copied out and
+    the file is closed. A table has one row per annulus, so the copy is a few
+    hundred bytes, while a memmap handle returned to the profile classes
+    would keep one file descriptor open per loaded table for the lifetime of
+    a batch run and stop ``write`` from replacing the file.
+    """
+    if is_fit_table(path):
+        with FitResultTable.open(path) as table:
+            return np.array(table.rows(name))
+    with open(path, 'rb') as file:
+        return rows_to_float(pickle.load(file))
+
+
+def load_start_values(path, n_annuli):
+    """
+    Best-fit (kT, abundance, norm) of a previous run (``FitResultTable.start_values``)
+    to warm-start the fit of ``n_annuli`` annuli, or None when the table is
+    missing or belongs to a different binning.
+    """
+    if path is None or not os.path.exists(path) or not is_fit_table(path):
+        return None
+    with FitResultTable.open(path) as table:
+        starts = table.start_values()
+    return starts if len(starts) == n_annuli else None
+
+
+class FitResultTable:
+    """
+    Typed columnar storage of the spectral fit results of every annulus.
+
+    The results are kept in a FITS binary table (extension ``FIT_RESULTS``)
+    with one row per annulus and, for each parameter, three float columns:
+    the best-fit value and the positive and negative errors (as returned by
+    XSPEC ``Fit.error``, so the negative error is <= 0). Failed fits are NaN
+    and flagged False in the ``VALID`` column. Provenance (model, nH,
+    redshift, spectra and region files, date) is kept in the header.
+
+    Tables opened with ``open`` are memory-mapped: the columns are views into
+    the file, so only the parts that are used are read from disk.
+
+    Attributes:
+    ----------
+    data : astropy.io.fits.FITS_rec
+        The table rows.
+    header : astropy.io.fits.Header
+        Header of the table, with the provenance keywords.
+    """
+
+    EXTNAME = 'FIT_RESULTS'
+    PARAMETERS = {'kT': 'KT', 'abundance': 'ABUND', 'norm': 'NORM'}
+
+    def __init__(self, data, header, hdulist=None):
+        self.data = data
+        self.header = header
+        self._hdulist = hdulist
+
+    @classmethod
+    def from_rows(cls, temperature, norm, abundance=None, annulus=None, provenance=None):
+        """
+        Builds the table from ``[value, +err, -err]`` rows as produced by
+        ``ajuste_apec_xspec`` (rows of ``None`` mark failed fits).
+        """
+        columns = {'kT': rows_to_float(temperature), 'norm': rows_to_float(norm)}
+        n_rows = len(columns['kT'])
+        columns['abundance'] = rows_to_float(abundance) if abundance is not None else np.full((n_rows, 3), np.nan)
+        if any(len(rows) != n_rows for rows in columns.values()):
+            raise ValueError("All parameters must have one row per annulus")
+        valid = np.isfinite(columns['kT'][:, 0]) & np.isfinite(columns['norm'][:, 0])
+        fits_columns = [
+            fits.Column(name='ANNULUS', format='J', array=np.arange(n_rows) if annulus is None else annulus),
+            fits.Column(name='VALID', format='L', array=valid),
+        ]
+        for name, prefix in cls.PARAMETERS.items():
+            rows = columns[name]
+            fits_columns += [fits.Column(name=prefix, format='D', array=rows[:, 0]),
+                             fits.Column(name=f'{prefix}_ERRP', format='D', array=rows[:, 1]),
+                             fits.Column(name=f'{prefix}_ERRM', format='D', array=rows[:, 2])]
+        hdu = fits.BinTableHDU.from_columns(fits_columns, name=cls.EXTNAME)
+        hdu.header['DATE'] = datetime.datetime.now().isoformat(timespec='seconds')
+        for key, value in (provenance or {}).items():
+            hdu.header[key[:8].upper()] = value
+        return cls(hdu.data, hdu.header)
+
+    @classmethod
+    def from_pickles(cls, pkl_temp_path, pkl_norm_path, provenance=None):
+        """
+        Converts the legacy ``temp_teste_1.pkl``/``normalizacao_teste_1.pkl`` object arrays.
+        """
+        with open(pkl_temp_path, 'rb') as file:
+            temperature = pickle.load(file)
+        with open(pkl_norm_path, 'rb') as file:
+            norm = pickle.load(file)
+        provenance = {'TEMPPKL': os.path.basename(pkl_temp_path), 'NORMPKL': os.path.basename(pkl_norm_path),
+                      **(provenance or {})}
+        return cls.from_rows(temperature, norm, provenance=provenance)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Opens a table memory-mapped; it stays readable until ``close``.
+        """
+        hdulist = fits.open(path, memmap=True)
+        hdu = hdulist[cls.EXTNAME]
+        return cls(hdu.data, hdu.header, hdulist)
+
+    def close(self):
+        if self._hdulist is not None:
+            self._hdulist.close()
+            self._hdulist = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, path, overwrite=True):
+        fits.BinTableHDU(self.data, self.header, name=self.EXTNAME).writeto(path, overwrite=overwrite)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def annulus(self):
+        return self.data['ANNULUS']
+
+    @property
+    def valid(self):
+        return self.data['VALID']
+
+    def value(self, name):
+        return self.data[self.PARAMETERS[name]]
+
+    def error_plus(self, name):
+        return self.data[f'{self.PARAMETERS[name]}_ERRP']
+
+    def error_minus(self, name):
+        return self.data[f'{self.PARAMETERS[name]}_ERRM']
+
+    def rows(self, name):
+        """
+        (n, 3) array of ``[value, +err, -err]`` for one parameter, the layout of
+        the legacy pickles. It is a view of the table (no copy).
+        """
+        prefix = self.PARAMETERS[name]
+        fields = [prefix, f'{prefix}_ERRP', f'{prefix}_ERRM']
+        raw = self.data.view(np.ndarray)
+        # mantém a ordem de bytes do arquivo (big-endian) para não copiar
+        return recfunctions.structured_to_unstructured(raw[fields], dtype=raw.dtype[prefix])
+
+    def mean_error(self, name):
+        """
+        Mean of the absolute positive and negative errors, as used by the processors.
+        """
+        return 0.5 * (np.abs(self.error_plus(name)) + np.abs(self.error_minus(name)))
+
+    def start_values(self):
+        """
+        (n, 3) array of the best-fit (kT, abundance, norm) of every annulus,
+        NaN where the fit failed; used to warm-start a new fit of the same annuli.
+        """
+        return np.column_stack([np.array(self.value(name), dtype=float) for name in ('kT', 'abundance', 'norm')])
+
+    @property
+    def provenance(self):
+        structural = ('XTENSION', 'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT', 'TFIELDS', 'TTYPE', 'TFORM', 'EXTNAME')
+        return {key: self.header[key] for key in self.header if not key.startswith(structural)}
@@ -0,0 +1,214 @@
+import numpy as np
+from astropy import units as u
+from astropy import constants as const
+from astropy.cosmology import Planck15
+from scipy.integrate import cumulative_trapezoid
+from scipy.special import hyp2f1
+
+from lib.instrumentation import instrument
+
+
+# massa (M_sun) de m_p * 1 cm^-3 ocupando 1 kpc^3
+_GAS_MASS_UNIT = (const.m_p * u.cm**-3 * u.kpc**3).to(u.solMass).value
+
+
+def critical_density(redshift):
+    """
+    Critical density of the universe at ``redshift`` in M_sun/kpc^3 (Planck15,
+    the cosmology used by ``UnitConverter``).
+    """
+    return Planck15.critical_density(redshift).to(u.solMass / u.kpc**3).value
+
+
+def _parameter(value):
+    # parâmetros de várias realizações (amostras MC) ganham um eixo para o raio
+    return np.asarray(value, dtype=float)[..., np.newaxis]
+
+
+def beta_model_density(r, n0, rc, beta):
+    """
+    Electron density n0 (1 + (r/rc)^2)^(-3 beta/2) in cm^-3 at radii ``r``
+    (kpc). ``n0``, ``rc`` and ``beta`` may be arrays of realizations: the
+    result has shape (n_realizations, n_radii), or (n_radii,) for scalars.
+    """
+    return _parameter(n0) * (1 + (np.asarray(r, dtype=float) / _parameter(rc))**2)**(-1.5 * _parameter(beta))
+
+
+@instrument('beta_model_gas_mass')
+def beta_model_gas_mass(r, n0, rc, beta, mu_e=1.17):
+    """
+    Gas mass (M_sun) within the radii ``r`` (kpc) of a beta model density,
+    in closed form:
+
+        M(<r) = 4/3 pi mu_e m_p n0 r^3 2F1(3/2, 3 beta/2; 5/2; -(r/rc)^2)
+
+    Parameters:
+    -----------
+    n0 : float or numpy.ndarray
+        Central electron density (cm^-3), e.g. ``Mass_Calculator.calcula_n0``.
+    rc : float or numpy.ndarray
+        Core radius (kpc).
+    beta : float or numpy.ndarray
+        Slope of the beta model.
+    mu_e : float
+        Mean molecular weight per electron (rho_gas = mu_e m_p n_e).
+
+    Returns:
+    --------
+    numpy.ndarray
+        (n_realizations, n_radii), or (n_radii,) for scalar parameters.
+    """
+    r = np.asarray(r, dtype=float)
+    x = -(r / _parameter(rc))**2
+    return (4 / 3) * np.pi * mu_e * _GAS_MASS_UNIT * _parameter(n0) * r**3 * hyp2f1(1.5, 1.5 * _parameter(beta), 2.5, x)
+
+
+@instrument('cumulative_gas_mass')
+def cumulative_gas_mass(r, density, mu_e=1.17):
+    """
+    Gas mass (M_sun) within each radius of an arbitrary density profile:
+    one cumulative trapezoid of 4 pi r^2 rho_gas over the last axis, so
+    any number of realizations (rows of ``density``) costs a single pass.
+    Inside the first radius the density is taken as constant.
+
+    Parameters:
+    -----------
+    r : numpy.ndarray
+        Increasing radii (kpc).
+    density : numpy.ndarray
+        Electron density (cm^-3) at ``r``, shape (..., n_radii).
+    """
+    r = np.asarray(r, dtype=float)
+    density = np.asarray(density, dtype=float)
+    integrand = 4 * np.pi * r**2 * density
+    core = (4 / 3) * np.pi * r[0]**3 * density[..., :1]
+    shells = cumulative_trapezoid(integrand, r, axis=-1, initial=0.0)
+    return mu_e * _GAS_MASS_UNIT * (core + shells)
+
+
+def overdensity_radius(r, mass, delta, redshift):
+    """
+    Radius where the mean enclosed density falls to ``delta`` times the
+    critical density, M(<r) = delta rho_c(z) 4/3 pi r^3, for every
+    realization (rows of ``mass``) at once.
+
+    The first crossing from above to below ``delta`` on the grid is located
+    with one comparison pass and refined by linear interpolation in log r.
+    Points with non-positive mass (e.g. the inner radii of a cool-core
+    hydrostatic profile) are skipped; realizations that do not cross
+    inside the grid are NaN.
+
+    Returns:
+    --------
+    tuple
+        (radius, index, weight): the radius (kpc) and the grid interval
+        (``index``, ``index + 1``) and interpolation weight in log r, to
+        evaluate other profiles at the same radius (see ``interpolate_at``).
+    """
+    r = np.asarray(r, dtype=float)
+    mass = np.asarray(mass, dtype=float)
+    contrast = mass / ((4 / 3) * np.pi * r**3 * critical_density(redshift)) - delta
+    # massa não positiva (perfil hidrostático não físico, p. ex. no centro de um cool core) não define um raio:
+    # procura a primeira passagem de acima para abaixo do contraste entre pontos de massa positiva
+    positive = mass > 0
+    below = (contrast < 0) & positive
+    above = (contrast >= 0) & positive
+    transition = above[..., :-1] & below[..., 1:]
+    crossed = transition.any(axis=-1)
+    index = np.argmax(transition, axis=-1)
+    lower = np.take_along_axis(contrast, index[..., np.newaxis], axis=-1)[..., 0]
+    upper = np.take_along_axis(contrast, index[..., np.newaxis] + 1, axis=-1)[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.clip(lower / (lower - upper), 0.0, 1.0)
+    log_r = np.log(r)
+    radius = np.exp(log_r[index] + weight * (log_r[index + 1] - log_r[index]))
+    return np.where(crossed, radius, np.nan), index, np.where(crossed, weight, np.nan)
+
+
+def interpolate_at(profile, index, weight):
+    """
+    Values of ``profile`` (..., n_radii) at the radii located by
+    ``overdensity_radius`` (linear in the grid interval).
+    """
+    profile = np.asarray(profile, dtype=float)
+    lower = np.take_along_axis(profile, np.asarray(index)[..., np.newaxis], axis=-1)[..., 0]
+    upper = np.take_along_axis(profile, np.asarray(index)[..., np.newaxis] + 1, axis=-1)[..., 0]
+    return lower + weight * (upper - lower)
+
+
+class GasMassProfile:
+    """
+    Enclosed gas mass, total (hydrostatic) mass and gas fraction on a
+    radius grid, for one or many realizations (e.g. Monte Carlo samples of
+    the T(r) and beta model parameters) stored as rows.
+
+    Attributes:
+    ----------
+    r : numpy.ndarray
+        Radii (kpc), increasing.
+    gas_mass : numpy.ndarray
+        Gas mass within ``r`` (M_sun), shape (..., n_radii).
+    total_mass : numpy.ndarray
+        Total mass within ``r`` (M_sun), same shape.
+    """
+
+    def __init__(self, r, gas_mass, total_mass):
+        self.r = np.asarray(r, dtype=float)
+        self.gas_mass = np.asarray(gas_mass, dtype=float)
+        self.total_mass = np.asarray(total_mass, dtype=float)
+
+    @classmethod
+    def from_beta_model(cls, r, total_mass, n0, rc, beta, mu_e=1.17):
+        """
+        Gas mass of the beta model density (closed form) against ``total_mass``.
+        """
+        return cls(r, beta_model_gas_mass(r, n0, rc, beta, mu_e), total_mass)
+
+    @classmethod
+    def from_density(cls, r, density, total_mass, mu_e=1.17):
+        """
+        Gas mass of any density profile (cumulative trapezoid) against ``total_mass``.
+        """
+        return cls(r, cumulative_gas_mass(r, density, mu_e), total_mass)
+
+    @property
+    def fraction(self):
+        """
+        Gas fraction f_gas(<r) = M_gas / M_tot.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.gas_mass / self.total_mass
+
+    def at_overdensity(self, delta, redshift):
+        """
+        Radius, total mass, gas mass and gas fraction at the overdensity
+        ``delta`` (e.g. 2500 or 500) of every realization.
+
+        Returns:
+        --------
+        dict
+            ``r_delta`` (kpc), ``M_delta`` and ``Mgas_delta`` (M_sun) and
+            ``fgas_delta``; NaN where the radius is outside the grid.
+        """
+        radius, index, weight = overdensity_radius(self.r, self.total_mass, delta, redshift)
+        # massa interpolada em log: o perfil é aproximadamente uma lei de potência entre dois pontos
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total = np.exp(interpolate_at(np.log(self.total_mass), index, weight))
+            gas = np.exp(interpolate_at(np.log(self.gas_mass), index, weight))
+            return {'r_delta': radius, 'M_delta': total, 'Mgas_delta': gas, 'fgas_delta': gas / total}
+
+    def summary(self, deltas, redshift):
+        """
+        Flat dict of ``at_overdensity`` for several overdensities, with keys
+        such as ``R2500_kpc``, ``M2500_Msun``, ``Mgas2500_Msun`` and ``fgas2500``
+        (scalars for a single realization).
+        """
+        result = {}
+        for delta in deltas:
+            values = self.at_overdensity(delta, redshift)
+            label = int(delta) if float(delta).is_integer() else delta
+            for key, name in (('r_delta', f'R{label}_kpc'), ('M_delta', f'M{label}_Msun'),
+                              ('Mgas_delta', f'Mgas{label}_Msun'), ('fgas_delta', f'fgas{label}')):
+                value = values[key]
+                result[name] = float(value) if np.ndim(value) == 0 else value
+        return result
@@ -0,0 +1,497 @@
+import numpy as np
+import scipy.fft
+import astropy.io.fits as fits
+from scipy.optimize import minimize
+
+from lib.image_profile import load_image, physical_transform, physical_grid
+from lib.instrumentation import instrument
+
+
+class PSFKernel:
+    """
+    Point spread function sampled on the image pixels, convolved with the
+    model images by zero-padded real FFTs.
+
+    The padded FFT shape (``scipy.fft.next_fast_len``), the spectrum of the
+    kernel and the padding buffer are computed once per image shape and
+    reused by every evaluation, so each convolution costs one forward and
+    one inverse transform.
+
+    Parameters:
+    -----------
+    kernel : numpy.ndarray
+        2D kernel with its center at pixel ``(ny // 2, nx // 2)``; normalized to unit sum.
+    workers : int
+        Threads of ``scipy.fft`` (-1 uses every core).
+    """
+
+    def __init__(self, kernel, workers=-1):
+        kernel = np.asarray(kernel, dtype=float)
+        self.kernel = kernel / kernel.sum()
+        self.workers = workers
+        self._plans = {}
+
+    @classmethod
+    def gaussian(cls, sigma, size=None, **kwargs):
+        """
+        Circular Gaussian of width ``sigma`` (image pixels), truncated at
+        ``size`` pixels (4 sigma on each side by default).
+        """
+        if size is None:
+            size = 2 * int(np.ceil(4 * sigma)) + 1
+        r = np.arange(size) - size // 2
+        profile = np.exp(-0.5 * (r / sigma)**2)
+        return cls(np.outer(profile, profile), **kwargs)
+
+    @classmethod
+    def from_fits(cls, path, hdu=0, **kwargs):
+        """
+        Kernel image (e.g. from MARX or ``psfsize_srcs``) on the pixel size
+        of the fitted image.
+        """
+        return cls(np.array(load_image(path, hdu)[0], dtype=float), **kwargs)
+
+    def rebin(self, factor):
+        """
+        Kernel of the image block-summed by ``factor``, with its center in
+        the central block.
+        """
+        ky, kx = self.kernel.shape
+        blocks = []
+        for half in (ky // 2, kx // 2):
+            n_side = int(np.ceil(max(half - (factor - 1 - factor // 2), 0) / factor))
+            blocks.append((n_side, n_side * factor + factor // 2 - half))
+        (ny, oy), (nx, ox) = blocks
+        padded = np.zeros(((2 * ny + 1) * factor, (2 * nx + 1) * factor))
+        padded[oy:oy + ky, ox:ox + kx] = self.kernel
+        return PSFKernel(_block_sum(padded, factor), self.workers)
+
+    def _plan(self, shape):
+        # forma do FFT, espectro do kernel e buffer de preenchimento, por forma de imagem
+        plan = self._plans.get(shape)
+        if plan is None:
+            ky, kx = self.kernel.shape
+            fft_shape = (scipy.fft.next_fast_len(shape[0] + ky - 1, real=True),
+                         scipy.fft.next_fast_len(shape[1] + kx - 1, real=True))
+            spectrum = scipy.fft.rfft2(self.kernel, s=fft_shape, workers=self.workers)
+            plan = (fft_shape, spectrum, np.zeros(fft_shape), (ky // 2, kx // 2))
+            self._plans[shape] = plan
+        return plan
+
+    def convolve(self, image):
+        """
+        Convolution with the kernel, cropped to the image ("same" mode;
+        the image is zero outside its borders).
+        """
+        fft_shape, spectrum, _, (oy, ox) = self._plan(image.shape)
+        ny, nx = image.shape
+        transform = scipy.fft.rfft2(image, s=fft_shape, workers=self.workers)
+        transform *= spectrum
+        return scipy.fft.irfft2(transform, s=fft_shape, workers=self.workers)[oy:oy + ny, ox:ox + nx]
+
+    def correlate(self, image):
+        """
+        Adjoint of ``convolve`` (correlation with the kernel), used for the
+        gradient of the likelihood.
+        """
+        fft_shape, spectrum, buffer, (oy, ox) = self._plan(image.shape)
+        ny, nx = image.shape
+        buffer[oy:oy + ny, ox:ox + nx] = image
+        transform = scipy.fft.rfft2(buffer, workers=self.workers)
+        transform *= spectrum.conj()
+        return scipy.fft.irfft2(transform, s=fft_shape, workers=self.workers)[:ny, :nx]
+
+
+def _block_sum(image, factor):
+    ny, nx = (image.shape[0] // factor) * factor, (image.shape[1] // factor) * factor
+    return image[:ny, :nx].reshape(ny // factor, factor, nx // factor, factor).sum(axis=(1, 3))
+
+
+class ImageLevel:
+    """
+    An image and everything the likelihood needs on its grid. The
+    sub-sampled levels used by the first iterations are block sums of the
+    full-resolution one.
+
+    Attributes:
+    -----------
+    counts : numpy.ndarray
+    exposure : numpy.ndarray
+        Relative exposure (1 at the median of the full-resolution image).
+    background : numpy.ndarray or None
+        Fixed background counts.
+    use : numpy.ndarray
+        Boolean mask of the pixels in the likelihood.
+    x, y : numpy.ndarray
+        Physical coordinates of the pixel centers along each axis.
+    area : float
+        Full-resolution pixels per pixel of the level.
+    psf : PSFKernel
+    """
+
+    def __init__(self, counts, exposure, background, use, x, y, area, psf):
+        self.counts = counts
+        self.exposure = exposure
+        self.background = background
+        self.use = use
+        self.x = x
+        self.y = y
+        self.area = area
+        self.psf = psf
+        # termos constantes da estatística: mu só entra somado nos pixels usados e ln mu só onde há contagens
+        self._area_exposure = area * exposure
+        self._use = use.astype(float).ravel()
+        self._scale = np.where(use, 2 * self._area_exposure, 0.0)
+        self._nonzero = np.flatnonzero(use & (counts > 0))
+        self._counts_nonzero = counts.ravel()[self._nonzero]
+        self._scale_nonzero = self._scale.ravel()[self._nonzero] * self._counts_nonzero
+
+    def downsample(self, factor):
+        ny, nx = (self.counts.shape[0] // factor) * factor, (self.counts.shape[1] // factor) * factor
+        # bloco usado só se todos os seus pixels forem usados (fontes pontuais mascaradas por inteiro)
+        use = _block_sum(self.use.astype(float), factor) == factor**2
+        background = None if self.background is None else _block_sum(self.background, factor)
+        return ImageLevel(_block_sum(self.counts, factor), _block_sum(self.exposure, factor) / factor**2,
+                          background, use, self.x[:nx].reshape(-1, factor).mean(axis=1),
+                          self.y[:ny].reshape(-1, factor).mean(axis=1), self.area * factor**2,
+                          self.psf.rebin(factor))
+
+
+class ImageBetaFit:
+    """
+    Poisson (Cash) fit of a PSF-convolved elliptical beta model plus a flat
+    background to a counts image:
+
+        mu = area * exposure * (PSF * S + bkg) [+ background image],
+        S(x, y) = ampl (1 + r_e^2 / r0^2)^(0.5 - 3 beta),
+        r_e^2 = x'^2 + y'^2 / (1 - ellip)^2,
+
+    with (x', y') the offsets from (x0, y0) rotated by ``theta`` (radians,
+    counter-clockwise from the x axis to the major axis, in [-pi/2, pi/2)).
+    ``ampl`` and ``bkg`` are counts per full-resolution pixel at the median
+    exposure; positions and ``r0`` (semi-major axis) are in physical pixels.
+
+    The gradient of the Cash statistic costs one more FFT: the convolution
+    is linear, so the derivatives of S are weighted by the correlation of
+    the residual weights with the PSF instead of being convolved one by
+    one. The first iterations run on a block-summed image (``subsample``)
+    and a few Fisher-scoring steps at full resolution refine that solution.
+    The model outside the image is not included.
+
+    Parameters:
+    -----------
+    counts : numpy.ndarray
+    x, y : numpy.ndarray
+        Physical coordinates of the pixel centers (see ``physical_grid``).
+    exposure : numpy.ndarray, optional
+        Exposure map on the same grid; uniform when None.
+    background : numpy.ndarray, optional
+        Fixed background counts on the same grid (already scaled).
+    psf : PSFKernel, optional
+        No convolution when None.
+    mask : numpy.ndarray, optional
+        Boolean mask of the pixels to use (False on point sources).
+    fit_background : bool
+        Fit the flat background; with a background image it may be fixed at zero.
+    """
+
+    PARAMETERS = ('x0', 'y0', 'ampl', 'r0', 'beta', 'ellip', 'theta', 'bkg')
+
+    # limites em (x0, y0, ln ampl, ln r0, beta, ellip, theta, ln bkg); posições e ln r0 dependem da imagem.
+    # ellip < 0 é a mesma elipse girada de 90 graus: sem o limite em 0 o ajuste não fica preso no caso
+    # circular, onde o gradiente em theta se anula
+    BOUNDS = ((None, None), (None, None), (None, None), (None, None), (0.1, 3.0), (-0.9, 0.9),
+              (None, None), (-30.0, None))
+
+    def __init__(self, counts, x, y, exposure=None, background=None, psf=None, mask=None,
+                 fit_background=True):
+        counts = np.asarray(counts, dtype=float)
+        if exposure is None:
+            exposure = np.ones(counts.shape)
+        else:
+            exposure = np.asarray(exposure, dtype=float)
+            exposure = exposure / np.median(exposure[exposure > 0])
+        use = exposure > 0
+        if mask is not None:
+            use &= np.asarray(mask, dtype=bool)
+        if background is not None:
+            background = np.asarray(background, dtype=float)
+        psf = PSFKernel(np.ones((1, 1))) if psf is None else psf
+        self.level = ImageLevel(counts, exposure, background, use, np.asarray(x, dtype=float),
+                                np.asarray(y, dtype=float), 1.0, psf)
+        self.fit_background = fit_background
+        self.params = None
+        self.params_covariance = None
+        self.cash = None
+
+    @classmethod
+    def from_files(cls, image_path, expmap_path=None, bkg_path=None, bkg_scale=1.0, psf=None,
+                   exclude=(), **kwargs):
+        """
+        Fit of a counts image with optional exposure map and background
+        image on the same grid, excluding the circles ``exclude`` given as
+        (x, y, radius) in physical coordinates.
+        """
+        counts, header = load_image(image_path)
+        x, y = physical_grid(counts.shape, physical_transform(header))
+        exposure = load_image(expmap_path)[0] if expmap_path else None
+        background = bkg_scale * np.asarray(load_image(bkg_path)[0], dtype=float) if bkg_path else None
+        fit = cls(counts, x, y, exposure, background, psf, **kwargs)
+        fit.exclude_circles(exclude)
+        return fit
+
+    def exclude_circles(self, circles):
+        """
+        Removes from the likelihood the pixels inside the circles
+        (x, y, radius), e.g. point sources.
+        """
+        level = self.level
+        for x_c, y_c, radius in circles:
+            inside = ((level.x[np.newaxis, :] - x_c)**2 + (level.y[:, np.newaxis] - y_c)**2) < radius**2
+            level.use &= ~inside
+        self.level = ImageLevel(level.counts, level.exposure, level.background, level.use, level.x, level.y,
+                                level.area, level.psf)
+
+    def _theta(self, params):
+        x0, y0, ampl, r0, beta, ellip, angle, bkg = params
+        return np.array([x0, y0, np.log(ampl), np.log(r0), beta, ellip, angle,
+                         np.log(max(bkg, np.exp(self.BOUNDS[7][0]))) if self.fit_background else 0.0])
+
+    @staticmethod
+    def _canonical(theta):
+        # ellip >= 0 e theta em [-pi/2, pi/2): q > 1 troca os eixos, r0 passa a ser o semi-eixo maior
+        theta = theta.copy()
+        if theta[5] < 0:
+            q = 1 - theta[5]
+            theta[3] += np.log(q)
+            theta[5] = 1 - 1 / q
+            theta[6] += 0.5 * np.pi
+        theta[6] = (theta[6] + 0.5 * np.pi) % np.pi - 0.5 * np.pi
+        return theta
+
+    def _params(self, theta):
+        return np.array([theta[0], theta[1], np.exp(theta[2]), np.exp(theta[3]), theta[4], theta[5], theta[6],
+                         np.exp(theta[7]) if self.fit_background else 0.0])
+
+    def _source(self, level, theta):
+        # modelo beta elíptico na grade do nível e os termos das derivadas
+        x0, y0, log_ampl, log_r0, beta, ellip, angle = theta[:7]
+        c, s = np.cos(angle), np.sin(angle)
+        dx = (level.x - x0)[np.newaxis, :]
+        dy = (level.y - y0)[:, np.newaxis]
+        xp = dx * c + dy * s
+        yp = dy * c - dx * s
+        q2 = (1 - ellip)**2
+        r0_2 = np.exp(2 * log_r0)
+        u = xp**2
+        u += yp**2 / q2
+        u /= r0_2
+        u += 1
+        log_u = np.log(u)
+        power = 0.5 - 3 * beta
+        source = np.exp(log_ampl + power * log_u)
+        return source, (xp, yp, u, log_u, power, q2, r0_2, c, s)
+
+    def _expected(self, level, theta, source=None):
+        if source is None:
+            source = self._source(level, theta)[0]
+        expected = level.psf.convolve(source)
+        if self.fit_background:
+            expected += np.exp(theta[7])
+        expected *= level._area_exposure
+        if level.background is not None:
+            expected += level.background
+        # pixels sem exposição valeriam 0; piso só para o logaritmo
+        return np.maximum(expected, 1e-300, out=expected)
+
+    def _cash(self, level, theta):
+        """
+        Cash statistic C = 2 sum (mu - n ln mu) on the used pixels and its
+        gradient in the fitted parameters.
+        """
+        source, (xp, yp, u, log_u, power, q2, r0_2, c, s) = self._source(level, theta)
+        expected = self._expected(level, theta, source).ravel()
+        expected_nonzero = expected[level._nonzero]
+        cash = 2 * np.dot(level._use, expected) - 2 * np.dot(level._counts_nonzero, np.log(expected_nonzero))
+        # dC/dmu * dmu/d(PSF * S) nos pixels usados, levado à grade do modelo pela correlação com a PSF
+        weight = level._scale.copy()
+        weight.flat[level._nonzero] -= level._scale_nonzero / expected_nonzero
+        back = level.psf.correlate(weight)
+        back *= source
+        inverse_u = 1 / u
+        # dS/dr_e^2 * back
+        radial = back * inverse_u
+        radial *= power / r0_2
+        radial_y = radial * yp
+        sum_x, sum_y = np.vdot(radial, xp), radial_y.sum()
+        gradient = np.empty(8)
+        gradient[0] = -2 * c * sum_x + 2 * s * sum_y / q2
+        gradient[1] = -2 * s * sum_x - 2 * c * sum_y / q2
+        gradient[2] = back.sum()
+        gradient[3] = -2 * power * (gradient[2] - np.vdot(back, inverse_u))
+        gradient[4] = -3 * np.vdot(back, log_u)
+        gradient[5] = 2 * np.vdot(radial_y, yp) / (q2 * np.sqrt(q2))
+        gradient[6] = 2 * np.vdot(radial_y, xp) * (1 - 1 / q2)
+        gradient[7] = weight.sum() * np.exp(theta[7]) if self.fit_background else 0.0
+        return cash, gradient
+
+    def _fisher(self, level, theta):
+        """
+        Expected Fisher information sum (dmu_j dmu_k) / mu of the fitted
+        parameters: one convolution per derivative of S.
+        """
+        source, (xp, yp, u, log_u, power, q2, r0_2, c, s) = self._source(level, theta)
+        expected = self._expected(level, theta, source)
+        # dmu/d(PSF * dS) / sqrt(mu), nulo fora dos pixels usados
+        scale = np.where(level.use, level._area_exposure / np.sqrt(expected), 0.0).ravel()
+        radial = source * power / (u * r0_2)
+        derivatives = (lambda: radial * (-2 * c * xp + 2 * s * yp / q2),
+                       lambda: radial * (-2 * s * xp - 2 * c * yp / q2),
+                       lambda: source,
+                       lambda: -2 * power * source * (u - 1) / u,
+                       lambda: -3 * source * log_u,
+                       lambda: 2 * radial * yp**2 / (q2 * np.sqrt(q2)),
+                       lambda: 2 * radial * xp * yp * (1 - 1 / q2))
+        weighted = np.empty((8, scale.size))
+        for j, derivative in enumerate(derivatives):
+            np.multiply(level.psf.convolve(derivative()).ravel(), scale, out=weighted[j])
+        np.multiply(scale, np.exp(theta[7]) if self.fit_background else 0.0, out=weighted[7])
+        return weighted @ weighted.T
+
+    def _start(self):
+        # chute inicial: fundo pela borda da imagem, centro pelo bloco mais brilhante e r0 pelo raio de meia luz
+        level = self.level
+        rate = np.where(level.use, level.counts / np.maximum(level.exposure, 1e-300), np.nan)
+        if level.background is not None:
+            rate -= level.background / np.maximum(level.exposure, 1e-300)
+        border = max(min(rate.shape) // 10, 1)
+        frame = np.concatenate([rate[:border].ravel(), rate[-border:].ravel(),
+                                rate[:, :border].ravel(), rate[:, -border:].ravel()])
+        bkg = max(np.nanmean(frame), 1e-3 * np.nanmean(rate)) if self.fit_background else 0.0
+        excess = np.nan_to_num(rate - bkg)
+        # centro, r0 e amplitude na imagem reduzida a ~32 blocos por lado
+        factor = max(min(rate.shape) // 32, 1)
+        blocks = _block_sum(excess, factor) / factor**2
+        x_blocks = level.x[:blocks.shape[1] * factor].reshape(-1, factor).mean(axis=1)
+        y_blocks = level.y[:blocks.shape[0] * factor].reshape(-1, factor).mean(axis=1)
+        iy, ix = np.unravel_index(np.argmax(blocks), blocks.shape)
+        x0, y0 = x_blocks[ix], y_blocks[iy]
+        r = np.hypot(x_blocks[np.newaxis, :] - x0, y_blocks[:, np.newaxis] - y0).ravel()
+        order = np.argsort(r)
+        cumulative = np.cumsum(np.clip(blocks.ravel()[order], 0, None))
+        r_half = r[order][np.searchsorted(cumulative, 0.5 * cumulative[-1])]
+        r0 = max(0.3 * r_half, 1.0)
+        ampl = max(blocks[iy, ix] / 0.6, 1e-3)
+        return (x0, y0, ampl, r0, 0.67, 0.1, 0.0, bkg if self.fit_background else 1.0)
+
+    @property
+    def _free(self):
+        # índices livres de (x0, y0, ln ampl, ln r0, beta, ellip, theta, ln bkg)
+        return list(range(8)) if self.fit_background else list(range(7))
+
+    def _bounds(self):
+        x, y = self.level.x, self.level.y
+        r_max = np.hypot(x.max() - x.min(), y.max() - y.min())
+        bounds = list(self.BOUNDS)
+        bounds[0] = (x.min(), x.max())
+        bounds[1] = (y.min(), y.max())
+        bounds[3] = (np.log(0.1 * abs(x[1] - x[0]) if x.size > 1 else 0.1), np.log(r_max))
+        if not self.fit_background:
+            bounds[7] = (0.0, 0.0)
+        return bounds
+
+    def _minimize(self, level, theta, max_iterations):
+        result = minimize(lambda t: self._cash(level, t), theta, jac=True, method='L-BFGS-B',
+                          bounds=self._bounds(), options={'maxiter': max_iterations, 'ftol': 1e-9})
+        return result.x
+
+    def _scoring(self, level, theta, tolerance, max_iterations, fisher_level=None):
+        # Fisher scoring a partir de uma solução próxima, com a informação de ``fisher_level`` (a imagem
+        # reduzida basta para a direção do passo); passo limitado aos limites e reduzido à metade até a
+        # estatística diminuir
+        fisher_level = level if fisher_level is None else fisher_level
+        free = self._free
+        bounds = self._bounds()
+        lower = np.array([-np.inf if low is None else low for low, _ in bounds])
+        upper = np.array([np.inf if high is None else high for _, high in bounds])
+        cash, gradient = self._cash(level, theta)
+        for _ in range(max_iterations):
+            information = self._fisher(fisher_level, theta)[np.ix_(free, free)]
+            step = np.zeros(8)
+            # pseudo-inversa: theta fica indeterminado se o aglomerado for circular
+            covariance = np.linalg.pinv(information)
+            step[free] = covariance @ (-0.5 * gradient[free])
+            converged = np.all(np.abs(step[free]) <= tolerance * np.sqrt(np.abs(np.diag(covariance))))
+            for _ in range(30):
+                trial = np.clip(theta + step, lower, upper)
+                trial_cash, trial_gradient = self._cash(level, trial)
+                if np.isfinite(trial_cash) and trial_cash <= cash:
+                    break
+                step = 0.5 * step
+            else:
+                break
+            theta, cash, gradient = trial, trial_cash, trial_gradient
+            if converged:
+                break
+        return theta, cash
+
+    @instrument('image_beta_fit')
+    def fit(self, start=None, subsample=8, tolerance=1e-3, max_iterations=50):
+        """
+        Fits the model from ``start`` (x0, y0, ampl, r0, beta, ellip, theta,
+        bkg): L-BFGS-B on the image block-summed by ``subsample`` (at full
+        resolution when 1), then Fisher scoring at full resolution, with the
+        information of the block-summed image, until the steps are below
+        ``tolerance`` standard errors.
+
+        Returns:
+        --------
+        tuple
+            (params, params_covariance); the covariance is the inverse of
+            the expected Fisher information at the best fit, propagated from
+            the logarithms of ampl, r0 and bkg.
+        """
+        theta = self._theta(self._start() if start is None else start)
+        level = self.level.downsample(subsample) if subsample > 1 else self.level
+        theta = self._canonical(self._minimize(level, theta, 10 * max_iterations))
+        theta, cash = self._scoring(self.level, theta, tolerance, max_iterations, level)
+        theta = self._canonical(theta)
+
+        free = self._free
+        information = self._fisher(self.level, theta)[np.ix_(free, free)]
+        covariance_theta = np.zeros((8, 8))
+        covariance_theta[np.ix_(free, free)] = np.linalg.pinv(information)
+        self.params = self._params(theta)
+        jacobian = np.diag([1.0, 1.0, self.params[2], self.params[3], 1.0, 1.0, 1.0, self.params[7]])
+        self.params_covariance = jacobian @ covariance_theta @ jacobian
+        self.cash = cash
+        self._theta_hat = theta
+        return self.params, self.params_covariance
+
+    def get_param_errors(self):
+        return np.sqrt(np.diag(self.params_covariance))
+
+    def get_r0(self):
+        return self.params[3]
+
+    def get_beta(self):
+        return self.params[4]
+
+    def get_ampl(self):
+        return self.params[2]
+
+    def model_image(self):
+        """
+        Expected counts of the best fit on the full-resolution grid.
+        """
+        return self._expected(self.level, self._theta_hat)
+
+    def residual_image(self):
+        """
+        (counts - model) / sqrt(model), zero on the excluded pixels.
+        """
+        model = self.model_image()
+        return np.where(self.level.use, (self.level.counts - model) / np.sqrt(model), 0.0)
+
+    def write_model(self, path, header=None):
+        fits.PrimaryHDU(self.model_image().astype(np.float32), header=header).writeto(path, overwrite=True)
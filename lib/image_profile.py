@@ -0,0 +1,290 @@
+import os
+import hashlib
+
+import numpy as np
+import astropy.io.fits as fits
+
+from lib.regions import RegionProcessor, Pie
+from lib.radial_profile import Profile
+from lib.instrumentation import instrument
+
+
+def load_image(path, hdu=0):
+    """
+    Opens a FITS image memory-mapped.
+
+    Returns:
+    --------
+    tuple
+        (data, header). ``data`` is a view of the file, not a copy.
+    """
+    hdulist = fits.open(path, memmap=True)
+    return hdulist[hdu].data, hdulist[hdu].header
+
+
+def physical_transform(header):
+    """
+    (LTM1_1, LTV1, LTM2_2, LTV2) of a CIAO image: physical (sky) coordinates
+    relate to image coordinates by ``x_img = LTM1_1 * x_phys + LTV1``.
+    """
+    return (float(header.get('LTM1_1', 1.0)), float(header.get('LTV1', 0.0)),
+            float(header.get('LTM2_2', 1.0)), float(header.get('LTV2', 0.0)))
+
+
+def physical_grid(shape, transform):
+    """
+    Physical (sky) x and y coordinates of the pixel centers of an image.
+    """
+    ltm1, ltv1, ltm2, ltv2 = transform
+    # índices numpy começam em 0, coordenadas de imagem FITS em 1
+    x = (np.arange(shape[1]) + 1 - ltv1) / ltm1
+    y = (np.arange(shape[0]) + 1 - ltv2) / ltm2
+    return x, y
+
+
+def exclusion_mask(shape, transform, circles):
+    """
+    True for the pixels whose centers fall inside any of the circles
+    (physical coordinates), filling only the box of each circle.
+    """
+    x, y = physical_grid(shape, transform)
+    mask = np.zeros(shape, dtype=bool)
+    for circle in circles:
+        # x e y crescem com o índice do pixel
+        columns = slice(*np.searchsorted(x, [circle.x_center - circle.radius, circle.x_center + circle.radius]))
+        rows = slice(*np.searchsorted(y, [circle.y_center - circle.radius, circle.y_center + circle.radius]))
+        mask[rows, columns] |= circle.contains(x[np.newaxis, columns], y[rows, np.newaxis])
+    return mask
+
+
+class RegionIndex:
+    """
+    Region membership of the pixels of an image, ready for ``np.bincount``.
+
+    ``labels`` holds the region index + 1 of each flattened pixel (0 outside
+    every region). When the regions cover only a small part of the image,
+    the inside pixels and their indices are also kept, so the sums gather
+    only those pixels instead of scanning the whole image.
+    """
+
+    def __init__(self, labels, n_regions, sparse_fraction=0.3):
+        self.labels = labels
+        self.n_regions = n_regions
+        self.pixels = None
+        self.index = None
+        inside = np.count_nonzero(labels)
+        if inside < sparse_fraction * labels.size:
+            self.pixels = np.flatnonzero(labels)
+            self.index = labels[self.pixels]
+        self.n_pixels = self.sum(None)
+
+    @classmethod
+    def from_map(cls, index_map, n_regions):
+        return cls((index_map.ravel() + 1).astype(np.intp), n_regions)
+
+    def sum(self, image):
+        """
+        Sum of ``image`` over each region (pixel count when ``image`` is None).
+        """
+        if self.pixels is not None:
+            weights = None if image is None else np.ravel(image)[self.pixels]
+            totals = np.bincount(self.index, weights=weights, minlength=self.n_regions + 1)
+        else:
+            weights = None if image is None else np.ravel(image)
+            totals = np.bincount(self.labels, weights=weights, minlength=self.n_regions + 1)
+        return totals[1:]
+
+
+class RadiusMapCache:
+    """
+    Cache of per-pixel region-index maps.
+
+    The map of an image grid and a region set (annuli/pies, in physical
+    coordinates) gives, for every pixel, the index of the region that
+    contains it (-1 outside). It depends only on the geometry, so it is
+    built once per (shape, transform, regions) and reused for every energy
+    band, exposure map and background of the same observation.
+
+    Parameters:
+    -----------
+    directory : str, optional
+        When given, maps are also stored there as ``.npy`` files and loaded
+        memory-mapped in later sessions.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._maps = {}
+
+    @staticmethod
+    def key(shape, transform, regions):
+        geometry = [tuple(shape), tuple(transform)]
+        for region in regions:
+            geometry.append((type(region).__name__, region.x_center, region.y_center, region.inner_radius,
+                             region.outer_radius, getattr(region, 'angle_start', None),
+                             getattr(region, 'angle_end', None),
+                             tuple(repr(circle) for circle in getattr(region, 'exclusions', ()))))
+        return hashlib.sha1(repr(geometry).encode()).hexdigest()
+
+    def get(self, shape, transform, regions):
+        """
+        Returns the cached RegionIndex of an image grid and region set.
+        """
+        key = self.key(shape, transform, regions)
+        if key in self._maps:
+            return self._maps[key]
+        path = os.path.join(self.directory, f'radius_map_{key}.npy') if self.directory else None
+        if path is not None and os.path.exists(path):
+            entry = RegionIndex(np.load(path, mmap_mode='r'), len(regions))
+        else:
+            entry = RegionIndex.from_map(self.build(shape, transform, regions), len(regions))
+            if path is not None:
+                os.makedirs(self.directory, exist_ok=True)
+                np.save(path, entry.labels)
+        self._maps[key] = entry
+        return entry
+
+    @staticmethod
+    @instrument('build_radius_map')
+    def build(shape, transform, regions):
+        """
+        Region-index map of the image (int32, -1 outside every region).
+        Later regions do not overwrite pixels already assigned; the pixels
+        inside the excluded circles of a region (point sources) are left out.
+        """
+        x, y = physical_grid(shape, transform)
+        index_map = np.full(shape, -1, dtype=np.int32)
+        radius_maps = {}
+        for i, region in enumerate(regions):
+            center = (region.x_center, region.y_center)
+            if center not in radius_maps:
+                dx = x[np.newaxis, :] - center[0]
+                dy = y[:, np.newaxis] - center[1]
+                radius_maps[center] = (np.hypot(dx, dy), np.degrees(np.arctan2(dy, dx)) % 360.0)
+            r, theta = radius_maps[center]
+            inside = (r >= region.inner_radius) & (r < region.outer_radius) & (index_map < 0)
+            if isinstance(region, Pie):
+                start, end = region.angle_start % 360.0, region.angle_end % 360.0
+                if start < end:
+                    inside &= (theta >= start) & (theta < end)
+                elif start > end:
+                    inside &= (theta >= start) | (theta < end)
+            if getattr(region, 'exclusions', None):
+                inside &= ~exclusion_mask(shape, transform, region.exclusions)
+            index_map[inside] = i
+        return index_map
+
+
+default_cache = RadiusMapCache()
+
+
+class ImageProfileBuilder:
+    """
+    Builds exposure-corrected, background-subtracted surface brightness
+    profiles directly from images, without dmextract.
+
+    Parameters:
+    -----------
+    counts_path : str
+        Counts image (e.g. from ``dmcopy "evt.fits[bin sky=1]"``).
+    expmap_path : str, optional
+        Exposure map on the same grid (cm^2 s). Without it the profile is in
+        counts per pixel^2.
+    bkg_path : str, optional
+        Background counts image on the same grid.
+    bkg_scale : float
+        Factor applied to the background counts (e.g. ratio of exposure times).
+    cache : RadiusMapCache, optional
+        Cache of region-index maps; the module-level cache by default.
+    """
+
+    def __init__(self, counts_path, expmap_path=None, bkg_path=None, bkg_scale=1.0, cache=None):
+        self.counts, header = load_image(counts_path)
+        self.transform = physical_transform(header)
+        self.exposure = load_image(expmap_path)[0] if expmap_path else None
+        self.background = load_image(bkg_path)[0] if bkg_path else None
+        for image in (self.exposure, self.background):
+            if image is not None and image.shape != self.counts.shape:
+                raise ValueError("Counts, exposure and background images must share the same grid")
+        self.bkg_scale = bkg_scale
+        self.cache = default_cache if cache is None else cache
+        self._exposure_sums = {}
+
+    @instrument('image_profile')
+    def profile(self, reg_path, counts=None, background=None):
+        """
+        Computes the profile of the regions of ``reg_path``.
+
+        Parameters:
+        -----------
+        reg_path : str
+            Region file with annuli/pies in physical coordinates.
+        counts, background : numpy.ndarray, optional
+            Alternative counts/background images on the same grid (e.g.
+            another energy band), reusing the cached region map.
+
+        Returns:
+        --------
+        Profile
+            Radii in physical pixels, with the columns ``counts``,
+            ``bkg_counts``, ``net_counts``, ``area`` and ``sur_bri``.
+        """
+        processor = RegionProcessor(reg_path)
+        processor.parse_file()
+        regions = processor.regions
+        region_index = self.cache.get(self.counts.shape, self.transform, regions)
+        n_pixels = region_index.n_pixels
+
+        counts = self.counts if counts is None else counts
+        background = self.background if background is None else background
+        source = region_index.sum(counts)
+        ltm1, _, ltm2, _ = self.transform
+        area = n_pixels / abs(ltm1 * ltm2)
+
+        if background is not None:
+            bkg = self.bkg_scale * region_index.sum(background)
+            variance = source + self.bkg_scale * bkg
+        else:
+            bkg = np.zeros(len(regions))
+            variance = source
+        if self.exposure is not None:
+            # soma da exposição (cm² s) sobre os pixels, por pixel físico²
+            # a exposição não muda entre bandas/fundos: soma guardada por mapa de regiões
+            if id(region_index) not in self._exposure_sums:
+                self._exposure_sums[id(region_index)] = region_index.sum(self.exposure) / abs(ltm1 * ltm2)
+            normalization = self._exposure_sums[id(region_index)]
+        else:
+            normalization = area
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sur_bri = (source - bkg) / normalization
+            sur_bri_err = np.sqrt(variance) / normalization
+
+        profile = Profile([region.inner_radius for region in regions], [region.outer_radius for region in regions],
+                          radius_unit='pixel')
+        profile.add_column('counts', source, np.sqrt(source), unit='counts')
+        profile.add_column('bkg_counts', bkg, unit='counts')
+        profile.add_column('net_counts', source - bkg, np.sqrt(variance), unit='counts')
+        profile.add_column('area', area, unit='pixel^2')
+        profile.add_column('sur_bri', sur_bri, sur_bri_err,
+                           unit='photons/cm^2/pixel^2/s' if self.exposure is not None else 'counts/pixel^2')
+        return profile.select(n_pixels > 0)
+
+
+def write_profile_fits(profile, path):
+    """
+    Writes a surface brightness Profile in the dmextract layout (R, RMID,
+    SUR_BRI, SUR_BRI_ERR, ...) so ``Make_surface_brightness_plot`` can fit it.
+    """
+    profile = profile.compress()
+    columns = [
+        fits.Column(name='R', format='2D', array=np.column_stack([profile.r_in, profile.r_out])),
+        fits.Column(name='RMID', format='D', array=profile.radius),
+        fits.Column(name='SUR_BRI', format='D', array=profile.value('sur_bri')),
+        fits.Column(name='SUR_BRI_ERR', format='D', array=profile.error('sur_bri')),
+        fits.Column(name='COUNTS', format='D', array=profile.value('counts')),
+        fits.Column(name='BG_COUNTS', format='D', array=profile.value('bkg_counts')),
+        fits.Column(name='NET_COUNTS', format='D', array=profile.value('net_counts')),
+        fits.Column(name='AREA', format='D', array=profile.value('area')),
+    ]
+    fits.BinTableHDU.from_columns(columns, name='HISTOGRAM').writeto(path, overwrite=True)
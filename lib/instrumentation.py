@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import functools
+import threading
+import resource
+from contextlib import contextmanager
+
+
+class Profiler:
+    """
+    Collects wall time, CPU time, resident memory and call counts per
+    pipeline stage and per instrumented function.
+
+    Measurements are keyed by the call stack of stage/function names, so the
+    report can be read both as a table and as a flame graph. The profiler is
+    disabled by default; set the environment variable ``ABELL496_PROFILE=1``
+    or call ``enable()``. When disabled, ``stage`` and ``instrument`` only
+    check one attribute before running the wrapped code.
+
+    Memory is sampled as the current RSS of the process when a stage starts
+    and ends: ``rss_mb`` is the largest RSS seen at the end of the stage and
+    ``rss_delta_mb`` the largest growth during one call. Both are process
+    values, so stages running in other threads contribute to them. The
+    process high-water mark (``ru_maxrss``), which in reused pool workers
+    also covers earlier tasks, is only reported once, as ``peak_rss_mb`` at
+    the top level of the report.
+
+    Attributes:
+    ----------
+    enabled : bool
+        Whether measurements are being recorded.
+    records : dict
+        Stack tuple -> dict with calls, wall_s, cpu_s, rss_mb and
+        rss_delta_mb.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.started = time.time()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.records = {}
+        self.started = time.time()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @staticmethod
+    def peak_rss_mb():
+        # ru_maxrss está em kB no Linux e em bytes no macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+    @classmethod
+    def rss_mb(cls):
+        # RSS atual (páginas residentes de /proc/self/statm); sem /proc usa o pico do processo
+        try:
+            with open('/proc/self/statm') as file:
+                pages = int(file.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            return cls.peak_rss_mb()
+        return pages * resource.getpagesize() / (1024.0 * 1024.0)
+
+    @contextmanager
+    def measure(self, name):
+        stack = self._stack()
+        stack.append(name)
+        key = tuple(stack)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        rss_start = self.rss_mb()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            rss = self.rss_mb()
+            stack.pop()
+            with self._lock:
+                record = self.records.get(key)
+                if record is None:
+                    record = self.records[key] = {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                  'rss_mb': 0.0, 'rss_delta_mb': 0.0}
+                record['calls'] += 1
+                record['wall_s'] += wall
+                record['cpu_s'] += cpu
+                record['rss_mb'] = max(record['rss_mb'], rss)
+                record['rss_delta_mb'] = max(record['rss_delta_mb'], rss - rss_start)
+
+    def report(self):
+        """
+        Returns the measurements as a JSON-serializable dict.
+
+        ``self_wall_s`` is the wall time not spent in instrumented children,
+        which is the value used in the flame graph.
+        """
+        with self._lock:
+            records = {key: dict(value) for key, value in self.records.items()}
+        children_wall = {}
+        for key, value in records.items():
+            if len(key) > 1:
+                children_wall[key[:-1]] = children_wall.get(key[:-1], 0.0) + value['wall_s']
+        entries = []
+        for key, value in sorted(records.items()):
+            entries.append({'stack': list(key), 'name': key[-1], **value,
+                            'self_wall_s': max(value['wall_s'] - children_wall.get(key, 0.0), 0.0)})
+        totals = {}
+        for entry in entries:
+            total = totals.setdefault(entry['name'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0})
+            total['calls'] += entry['calls']
+            total['wall_s'] += entry['wall_s'] if entry['name'] not in entry['stack'][:-1] else 0.0
+            total['cpu_s'] += entry['cpu_s'] if entry['name'] not in entry['stack'][:-1] else 0.0
+        return {'started': self.started, 'pid': os.getpid(), 'peak_rss_mb': self.peak_rss_mb(),
+                'entries': entries, 'totals': totals}
+
+    def folded(self):
+        """
+        Returns the report in the collapsed-stack format of flamegraph.pl and
+        speedscope (one ``a;b;c <microseconds>`` line per stack).
+        """
+        lines = []
+        for entry in self.report()['entries']:
+            microseconds = int(round(entry['self_wall_s'] * 1e6))
+            if microseconds > 0:
+                lines.append(f"{';'.join(entry['stack'])} {microseconds}")
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, path):
+        """
+        Writes ``path`` (JSON report) and ``path`` with the ``.folded``
+        extension (flame graph input).
+        """
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+        with open(os.path.splitext(path)[0] + '.folded', 'w') as file:
+            file.write(self.folded())
+
+
+profiler = Profiler(enabled=os.environ.get('ABELL496_PROFILE', '') not in ('', '0'))
+
+
+@contextmanager
+def _disabled():
+    yield
+
+
+def stage(name):
+    """
+    Context manager that measures a pipeline stage or any block of code.
+
+    Example:
+    --------
+    with stage('Fit.perform'):
+        Fit.perform()
+    """
+    if not profiler.enabled:
+        return _disabled()
+    return profiler.measure(name)
+
+
+def instrument(name=None):
+    """
+    Decorator that measures every call of a function under ``name``
+    (the function's qualified name by default).
+    """
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with profiler.measure(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,314 @@
+import numpy as np
+from astropy import units as u
+from astropy import constants as const
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from scipy.optimize import least_squares
+from scipy.special import gamma, gammainc, hyp2f1
+
+from lib.instrumentation import instrument
+from lib.gas_mass import overdensity_radius
+
+
+# G m_p M_sun / kpc em keV: dP/dr = -mu m_p n G M / r^2 com P em keV cm^-3, r em kpc e M em M_sun
+_POTENTIAL_UNIT = (const.G * const.m_p * u.solMass / u.kpc).to(u.keV).value
+
+
+def _columns(theta, n):
+    # vetor de parâmetros (n,) ou várias realizações (m, n): cada parâmetro ganha um eixo para o raio
+    theta = np.asarray(theta, dtype=float)
+    return [theta[..., i, np.newaxis] for i in range(n)]
+
+
+class NFW:
+    """
+    Navarro-Frenk-White total mass, rho = rho_s / (x (1 + x)^2) with x = r/rs:
+
+        M(<r) = 4 pi rho_s rs^3 (ln(1 + x) - x / (1 + x))
+
+    Parameters are ``(rs, log_rho_s)``: rs in kpc and log10 of rho_s in M_sun/kpc^3.
+    """
+
+    name = 'nfw'
+    PARAMETERS = ('rs', 'log_rho_s')
+    START = (300.0, 6.5)
+    BOUNDS = ((1.0, 3.0), (1e4, 10.0))
+
+    @classmethod
+    def mass(cls, r, theta):
+        """
+        Mass (M_sun) within ``r`` (kpc); rows of ``theta`` give (n, n_r).
+        """
+        rs, log_rho_s = _columns(theta, 2)
+        x = np.asarray(r, dtype=float) / rs
+        return 4 * np.pi * 10**log_rho_s * rs**3 * (np.log1p(x) - x / (1 + x))
+
+
+class GNFW:
+    """
+    Generalized NFW with a free inner slope, rho = rho_s / (x^gamma (1 + x)^(3 - gamma)):
+
+        M(<r) = 4 pi rho_s rs^3 x^(3 - gamma) / (3 - gamma) 2F1(3 - gamma, 3 - gamma; 4 - gamma; -x)
+
+    Parameters are ``(rs, log_rho_s, gamma)``; gamma = 1 is the NFW profile.
+    """
+
+    name = 'gnfw'
+    PARAMETERS = ('rs', 'log_rho_s', 'gamma')
+    START = (300.0, 6.5, 1.0)
+    BOUNDS = ((1.0, 3.0, 0.0), (1e4, 10.0, 2.5))
+
+    @classmethod
+    def mass(cls, r, theta):
+        rs, log_rho_s, slope = _columns(theta, 3)
+        x = np.asarray(r, dtype=float) / rs
+        s = 3 - slope
+        return 4 * np.pi * 10**log_rho_s * rs**3 * x**s / s * hyp2f1(s, s, s + 1, -x)
+
+
+class Einasto:
+    """
+    Einasto total mass, rho = rho_s exp(-2/alpha (x^alpha - 1)):
+
+        M(<r) = 4 pi rho_s rs^3 e^(2/alpha) / alpha (alpha/2)^(3/alpha) gamma(3/alpha, 2/alpha x^alpha)
+
+    with the lower incomplete gamma function. Parameters are ``(rs, log_rho_s, alpha)``.
+    """
+
+    name = 'einasto'
+    PARAMETERS = ('rs', 'log_rho_s', 'alpha')
+    START = (300.0, 5.5, 0.2)
+    BOUNDS = ((1.0, 3.0, 0.05), (1e4, 10.0, 1.0))
+
+    @classmethod
+    def mass(cls, r, theta):
+        rs, log_rho_s, alpha = _columns(theta, 3)
+        x = np.asarray(r, dtype=float) / rs
+        s = 3 / alpha
+        lower_gamma = gammainc(s, 2 / alpha * x**alpha) * gamma(s)
+        return 4 * np.pi * 10**log_rho_s * rs**3 * np.exp(2 / alpha) / alpha * (alpha / 2)**s * lower_gamma
+
+
+MASS_MODELS = {model.name: model for model in (NFW, GNFW, Einasto)}
+
+
+def projection_matrix(shell_edges, r_in, r_out):
+    """
+    Volume of every spherical shell inside every cylindrical annulus seen
+    along the line of sight.
+
+    Parameters:
+    -----------
+    shell_edges : numpy.ndarray
+        Edges of the shells (n_shells + 1), increasing from 0.
+    r_in, r_out : numpy.ndarray
+        Inner and outer projected radius of each annulus (same unit).
+
+    Returns:
+    --------
+    numpy.ndarray
+        (n_annuli, n_shells) volumes.
+    """
+    edges = np.asarray(shell_edges, dtype=float)[np.newaxis, :]
+
+    def sphere_in_cylinder(R):
+        # volume da esfera de raio r dentro do cilindro de raio R
+        R = np.asarray(R, dtype=float)[:, np.newaxis]
+        return 4 / 3 * np.pi * (edges**3 - np.clip(edges**2 - R**2, 0, None)**1.5)
+
+    inside = sphere_in_cylinder(r_out) - sphere_in_cylinder(r_in)
+    return np.diff(inside, axis=1)
+
+
+class HydrostaticKernel:
+    """
+    Precomputed linear operators of the forward model of the projected
+    temperature profile for a fixed gas density.
+
+    Hydrostatic equilibrium, d(n T)/dr = -mu m_p G n M(<r) / r^2, integrated
+    from the outer grid radius gives the 3D temperature as
+
+        T(r) = [n(r_max) T(r_max) + mu G m_p int_r^r_max n M / r'^2 dr'] / n(r),
+
+    linear in the mass profile and in T(r_max). The cumulative integral on
+    the radial grid and the emission-weighted (n^2) projection onto the
+    annuli are therefore folded once into one matrix, and a model
+    evaluation is a single matrix product of its mass on the grid.
+
+    Parameters:
+    -----------
+    r_in, r_out : numpy.ndarray
+        Projected radii (kpc) of the annuli of the temperature profile.
+    density : callable
+        Gas density n(r) with r in kpc; only its shape matters.
+    n_grid : int
+        Number of radial grid points.
+    r_max : float, optional
+        Outer radius of the grid (kpc), where the temperature is a free
+        parameter. Three times the outermost annulus by default.
+
+    Attributes:
+    ----------
+    r : numpy.ndarray
+        Radial grid (kpc), logarithmic.
+    kernel : numpy.ndarray
+        (n_annuli, n_grid) projected temperature per unit of mass and of mu.
+    outer : numpy.ndarray
+        (n_annuli,) projected temperature per keV of T(r_max).
+    """
+
+    def __init__(self, r_in, r_out, density, n_grid=200, r_max=None):
+        self.r_in = np.asarray(r_in, dtype=float)
+        self.r_out = np.asarray(r_out, dtype=float)
+        r_max = 3 * self.r_out.max() if r_max is None else r_max
+        r_min = min(self.r_out.min(), r_max) / 20 if self.r_in.min() <= 0 else self.r_in.min() / 2
+        self.r = np.geomspace(r_min, r_max, n_grid)
+        n = np.asarray(density(self.r), dtype=float)
+
+        # pesos do trapézio de int_{r_i}^{r_max} f dr' para cada nó j (matriz triangular superior)
+        widths = np.diff(self.r)
+        upper = np.triu(np.ones((n_grid, n_grid)))
+        trapezoid = 0.5 * (upper * np.append(widths, 0.0) + np.triu(upper, 1) * np.insert(widths, 0, 0.0))
+        integral = trapezoid * (n / self.r**2)[np.newaxis, :]
+
+        # cascas centradas nos pontos da grade (bordas na média geométrica), a primeira a partir de 0
+        edges = np.concatenate([[0.0], np.sqrt(self.r[1:] * self.r[:-1]), [r_max]])
+        emission = projection_matrix(edges, self.r_in, self.r_out) * n**2
+        weights = emission / emission.sum(axis=1, keepdims=True)
+
+        self.kernel = _POTENTIAL_UNIT * (weights / n) @ integral
+        self.outer = weights @ (n[-1] / n)
+        self._temperature_kernel = _POTENTIAL_UNIT * integral / n[:, np.newaxis]
+        self._temperature_outer = n[-1] / n
+
+    @classmethod
+    def from_beta_model(cls, r_in, r_out, rc, beta, **kwargs):
+        """
+        Kernel of the beta model density with core radius ``rc`` (kpc).
+        """
+        return cls(r_in, r_out, lambda r: (1 + (r / rc)**2)**(-1.5 * beta), **kwargs)
+
+    def projected_temperature(self, mass, T_outer, mu=0.6):
+        """
+        Projected temperature (keV) of each annulus for the mass profile
+        ``mass`` (M_sun) on ``r``; rows of ``mass`` and ``T_outer`` give
+        several models at once.
+        """
+        return np.asarray(T_outer, dtype=float)[..., np.newaxis] * self.outer + mu * np.asarray(mass) @ self.kernel.T
+
+    def temperature(self, mass, T_outer, mu=0.6):
+        """
+        3D temperature (keV) on ``r``.
+        """
+        return (np.asarray(T_outer, dtype=float)[..., np.newaxis] * self._temperature_outer
+                + mu * np.asarray(mass) @ self._temperature_kernel.T)
+
+
+class MassModelFit:
+    """
+    Fit of a parametric total mass model (``MASS_MODELS``) to the projected
+    temperature profile through ``HydrostaticKernel``, with the full
+    covariance of the measured temperatures.
+
+    The free parameters are those of the model followed by ``T_outer``,
+    the temperature (keV) at the outer radius of the kernel grid.
+
+    Parameters:
+    -----------
+    kernel : HydrostaticKernel
+    model : class or str
+        Mass model, e.g. ``NFW`` or ``'gnfw'``.
+    temperature : numpy.ndarray
+        Projected temperature of each annulus (keV).
+    covariance : numpy.ndarray
+        (n, n) covariance of the temperatures, or their (n,) errors.
+    mu : float
+        Mean molecular weight.
+    """
+
+    def __init__(self, kernel, model, temperature, covariance, mu=0.6):
+        self.kernel = kernel
+        self.model = MASS_MODELS[model] if isinstance(model, str) else model
+        self.temperature = np.asarray(temperature, dtype=float)
+        covariance = np.asarray(covariance, dtype=float)
+        self.covariance = np.diag(covariance**2) if covariance.ndim == 1 else covariance
+        self._cholesky = cho_factor(self.covariance, lower=True)
+        self.mu = mu
+        self.params = None
+        self.params_covariance = None
+        self.chi2 = None
+
+    @property
+    def parameter_names(self):
+        return list(self.model.PARAMETERS) + ['T_outer']
+
+    def predict(self, theta):
+        """
+        Projected temperatures of the parameter vector(s) ``theta``.
+        """
+        theta = np.asarray(theta, dtype=float)
+        mass = self.model.mass(self.kernel.r, theta[..., :-1])
+        return self.kernel.projected_temperature(mass, theta[..., -1], self.mu)
+
+    def residuals(self, theta):
+        """
+        Residuals whitened by the Cholesky factor of the covariance.
+        """
+        return solve_triangular(self._cholesky[0], self.predict(theta) - self.temperature, lower=True)
+
+    def chi_square(self, theta):
+        residual = self.predict(theta) - self.temperature
+        return float(residual @ cho_solve(self._cholesky, residual))
+
+    @instrument('mass_model_fit')
+    def fit(self, start=None):
+        """
+        Least-squares fit from ``start`` (the model's ``START`` and the mean
+        temperature by default). The parameter covariance is the inverse of
+        J^T J at the best fit.
+
+        Returns:
+        --------
+        tuple
+            (params, params_covariance)
+        """
+        if start is None or not np.all(np.isfinite(start)):
+            start = list(self.model.START) + [float(np.mean(self.temperature))]
+        lower = list(self.model.BOUNDS[0]) + [0.0]
+        upper = list(self.model.BOUNDS[1]) + [np.inf]
+        start = np.clip(np.asarray(start, dtype=float), lower, upper)
+        result = least_squares(self.residuals, start, bounds=(lower, upper), x_scale='jac')
+        self.params = result.x
+        self.params_covariance = np.linalg.pinv(result.jac.T @ result.jac)
+        self.chi2 = float(2 * result.cost)
+        return self.params, self.params_covariance
+
+    def get_param_errors(self):
+        return np.sqrt(np.diag(self.params_covariance))
+
+    def mass_profile(self, R_values, params=None):
+        """
+        Total mass (M_sun) within ``R_values`` (kpc) of the best fit, or of
+        ``params`` (rows for several realizations).
+        """
+        params = self.params if params is None else np.asarray(params, dtype=float)
+        return self.model.mass(R_values, params[..., :len(self.model.PARAMETERS)])
+
+    def summary(self, deltas, redshift, R_values=None):
+        """
+        Best-fit parameters and errors, chi2 and the radius and mass at each
+        overdensity, with keys prefixed by the model name (e.g.
+        ``nfw_rs``, ``nfw_R500_kpc``, ``nfw_M500_Msun``).
+        """
+        if R_values is None:
+            R_values = np.geomspace(1, 1e4, 2000)
+        result = {f'{self.model.name}_chi2': self.chi2, f'{self.model.name}_dof': len(self.temperature) - len(self.params)}
+        for name, value, error in zip(self.parameter_names, self.params, self.get_param_errors()):
+            result[f'{self.model.name}_{name}'] = float(value)
+            result[f'{self.model.name}_{name}_err'] = float(error)
+        mass = self.mass_profile(R_values)
+        for delta in deltas:
+            label = int(delta) if float(delta).is_integer() else delta
+            radius = float(overdensity_radius(R_values, mass, delta, redshift)[0])
+            result[f'{self.model.name}_R{label}_kpc'] = radius
+            result[f'{self.model.name}_M{label}_Msun'] = float(self.mass_profile([radius])[0]) if np.isfinite(radius) else np.nan
+        return result
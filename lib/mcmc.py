@@ -0,0 +1,338 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import astropy.io.fits as fits
+from scipy.optimize import curve_fit, minimize
+
+from lib.converte import UnitConverter
+from lib.radial_profile import Profile
+from lib.fit_results import load_fit_rows
+from lib.temperaturas import CurveFitter
+from lib.symbolic_mass import SymbolicMassModel
+from lib.instrumentation import instrument
+
+
+class EnsembleSampler:
+    """
+    Affine-invariant ensemble MCMC sampler (stretch move of Goodman & Weare
+    2010, as in emcee).
+
+    The walkers are split in two halves and each half is moved using the
+    other as the complementary ensemble, so the proposals of a whole half
+    are evaluated in one call of ``log_prob`` on an (n, n_dim) array.
+
+    Parameters:
+    -----------
+    log_prob : callable
+        Maps an (n, n_dim) array of positions to n log-probabilities
+        (-inf outside the prior). Must be picklable when ``max_workers`` > 1.
+    n_walkers : int
+        Number of walkers; even and at least ``2 * n_dim``.
+    n_dim : int
+        Number of parameters.
+    a : float
+        Scale of the stretch move.
+    max_workers : int, optional
+        When > 1, every half-ensemble is split across a process pool (one
+        pool per run; serial inside a worker process, e.g. of run_batch).
+    """
+
+    def __init__(self, log_prob, n_walkers, n_dim, a=2.0, max_workers=None):
+        if n_walkers % 2 or n_walkers < 2 * n_dim:
+            raise ValueError("n_walkers must be even and at least 2 * n_dim")
+        self.log_prob = log_prob
+        self.n_walkers = n_walkers
+        self.n_dim = n_dim
+        self.a = a
+        self.max_workers = max_workers
+        self.chain = None
+        self.log_probs = None
+        self.acceptance_fraction = None
+
+    def _evaluate(self, positions, executor):
+        if executor is None:
+            values = self.log_prob(positions)
+        else:
+            chunks = np.array_split(positions, self.max_workers)
+            values = np.concatenate(list(executor.map(self.log_prob, chunks)))
+        values = np.asarray(values, dtype=float)
+        return np.where(np.isnan(values), -np.inf, values)
+
+    @instrument('ensemble_sampler')
+    def run(self, p0, n_steps, seed=None):
+        """
+        Advances the walkers from ``p0`` (n_walkers, n_dim) for ``n_steps``
+        steps, storing the chain. Returns the final positions.
+        """
+        rng = np.random.default_rng(seed)
+        positions = np.array(p0, dtype=float)
+        # dentro de um worker o pool se aninharia no de fora: os walkers são avaliados em série
+        parallel = self.max_workers and self.max_workers > 1 and multiprocessing.parent_process() is None
+        executor = ProcessPoolExecutor(max_workers=self.max_workers) if parallel else None
+        try:
+            log_prob = self._evaluate(positions, executor)
+            if not np.all(np.isfinite(log_prob)):
+                raise ValueError("Every initial walker must have a finite log-probability")
+            half = self.n_walkers // 2
+            halves = (np.arange(half), np.arange(half, self.n_walkers))
+            self.chain = np.empty((n_steps, self.n_walkers, self.n_dim))
+            self.log_probs = np.empty((n_steps, self.n_walkers))
+            accepted = np.zeros(self.n_walkers)
+            for step in range(n_steps):
+                for active, complement in (halves, halves[::-1]):
+                    # z com densidade proporcional a 1/sqrt(z) em [1/a, a]
+                    z = ((self.a - 1) * rng.random(half) + 1)**2 / self.a
+                    partners = positions[complement[rng.integers(half, size=half)]]
+                    proposal = partners + z[:, np.newaxis] * (positions[active] - partners)
+                    new_log_prob = self._evaluate(proposal, executor)
+                    log_ratio = (self.n_dim - 1) * np.log(z) + new_log_prob - log_prob[active]
+                    accept = np.log(rng.random(half)) < log_ratio
+                    positions[active[accept]] = proposal[accept]
+                    log_prob[active[accept]] = new_log_prob[accept]
+                    accepted[active[accept]] += 1
+                self.chain[step] = positions
+                self.log_probs[step] = log_prob
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.acceptance_fraction = accepted / n_steps
+        return positions
+
+    def get_chain(self, discard=0, thin=1, flat=False):
+        """
+        Stored chain (n_steps, n_walkers, n_dim) after dropping the first
+        ``discard`` steps and keeping one step in ``thin``; ``flat`` merges the walkers.
+        """
+        chain = self.chain[discard::thin]
+        return chain.reshape(-1, self.n_dim) if flat else chain
+
+    def get_log_prob(self, discard=0, thin=1, flat=False):
+        log_probs = self.log_probs[discard::thin]
+        return log_probs.ravel() if flat else log_probs
+
+
+def load_joint_profiles(reg_path, pkl_temp_path, r_profile_fits_path, redshift, exclude_bins=()):
+    """
+    Temperature profile of the annuli (fit result table or pickle) and the
+    dmextract surface brightness profile (RMID, SUR_BRI, SUR_BRI_ERR).
+    Bins in ``exclude_bins``, failed fits and zero-error SB bins are dropped.
+
+    Returns:
+    --------
+    tuple
+        (radius, temperature, temperature_err, sb_radius, sb, sb_err,
+        kpc_per_pixel), radii in kpc for T and in pixels for the SB.
+    """
+    profile = Profile.from_regions(reg_path, redshift)
+    temperature = load_fit_rows(pkl_temp_path, 'kT')
+    profile.add_column('temperature', temperature[:, 0],
+                       0.5 * (np.abs(temperature[:, 1]) + np.abs(temperature[:, 2])), unit='keV')
+    profile.exclude(list(exclude_bins))
+    profile = profile.mask_invalid('temperature').compress()
+    with fits.open(r_profile_fits_path) as hdulist:
+        data = hdulist[1].data
+        sb_radius = np.array(data['RMID'], dtype=float)
+        sb = np.array(data['SUR_BRI'], dtype=float)
+        sb_err = np.array(data['SUR_BRI_ERR'], dtype=float)
+    keep = sb_err > 0
+    kpc_per_pixel = UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(1.0), redshift)
+    return (profile.radius, profile.value('temperature'), profile.error('temperature'),
+            sb_radius[keep], sb[keep], sb_err[keep], kpc_per_pixel)
+
+
+class JointHydrostaticLikelihood:
+    """
+    Joint likelihood of the T(r) model of ``CurveFitter`` and the beta model
+    of the surface brightness, for all walkers at once.
+
+    The parameters are ``(a, b, c, d, ampl, r0, beta)``: T(r) = a + b exp(-c r)
+    - d r (keV, r in kpc) and SB(r) = ampl (1 + (r/r0)^2)^(0.5 - 3 beta)
+    (r0 in pixels, as the sherpa Beta1D fit). The density of the mass model
+    is the beta model with rc = r0 in kpc, so both data sets constrain the
+    hydrostatic mass together. With ``physical`` the prior also requires a
+    positive, non-decreasing mass on ``mass_radii``.
+
+    Parameters:
+    -----------
+    radius, temperature, temperature_err : numpy.ndarray
+        Temperature profile (kpc, keV).
+    sb_radius, sb, sb_err : numpy.ndarray
+        Surface brightness profile (radius in pixels).
+    kpc_per_pixel : float
+        Physical size of one pixel at the cluster redshift.
+    mass_radii : numpy.ndarray, optional
+        Radii (kpc) where the physical prior is checked; the range of the
+        temperature profile by default.
+    mu : float
+        Mean molecular weight of the mass.
+    physical : bool
+        Apply the positive, non-decreasing mass prior. Off by default: with
+        a flat beta model core, a temperature rising outwards (cool core)
+        always gives a negative mass at small radii.
+    """
+
+    PARAMETERS = ('a', 'b', 'c', 'd', 'ampl', 'r0', 'beta')
+
+    def __init__(self, radius, temperature, temperature_err, sb_radius, sb, sb_err, kpc_per_pixel,
+                 mass_radii=None, mu=0.6, physical=False):
+        self.radius = np.asarray(radius, dtype=float)
+        self.temperature = np.asarray(temperature, dtype=float)
+        self.temperature_err = np.asarray(temperature_err, dtype=float)
+        self.sb_radius = np.asarray(sb_radius, dtype=float)
+        self.sb = np.asarray(sb, dtype=float)
+        self.sb_err = np.asarray(sb_err, dtype=float)
+        self.kpc_per_pixel = kpc_per_pixel
+        if mass_radii is None:
+            mass_radii = np.geomspace(max(self.radius.min(), 1e-3), self.radius.max(), 32)
+        self.mass_radii = np.asarray(mass_radii, dtype=float)
+        self.mu = mu
+        self.physical = physical
+        self.model = SymbolicMassModel.from_names('exponential', 'beta')
+
+    @classmethod
+    def from_files(cls, reg_path, pkl_temp_path, r_profile_fits_path, redshift, exclude_bins=(), **kwargs):
+        """
+        Likelihood of the profiles read by ``load_joint_profiles``.
+        """
+        return cls(*load_joint_profiles(reg_path, pkl_temp_path, r_profile_fits_path, redshift, exclude_bins), **kwargs)
+
+    def _columns(self, theta):
+        theta = np.atleast_2d(np.asarray(theta, dtype=float))
+        return {name: theta[:, [i]] for i, name in enumerate(self.PARAMETERS)}
+
+    def mass_profiles(self, theta, R_values):
+        """
+        Hydrostatic mass (M_sun) at ``R_values`` (kpc) of every parameter
+        vector (rows of ``theta``): shape (n, n_radii).
+        """
+        p = self._columns(theta)
+        return self.model.mass_profile(np.asarray(R_values, dtype=float), mu=self.mu, a=p['a'], b=p['b'], c=p['c'],
+                                       d=p['d'], n0=1.0, rc=p['r0'] * self.kpc_per_pixel, beta=p['beta'])
+
+    def _chi2(self, theta):
+        """
+        (chi2 of both data sets, box prior) of every row of ``theta``.
+        """
+        p = self._columns(theta)
+        a, b, c, d, ampl, r0, beta = (p[name] for name in self.PARAMETERS)
+        prior = ((ampl > 0) & (r0 > 0) & (beta > 0.1) & (beta < 3.0) & (c >= 0))[:, 0]
+        T = a + b * np.exp(-c * self.radius) - d * self.radius
+        chi2_T = np.sum(((self.temperature - T) / self.temperature_err)**2, axis=1)
+        with np.errstate(invalid='ignore', over='ignore', divide='ignore'):
+            sb = np.abs(ampl) * (1 + (self.sb_radius / np.abs(r0))**2)**(0.5 - 3 * beta)
+        chi2_sb = np.sum(((self.sb - sb) / self.sb_err)**2, axis=1)
+        T_grid = a + b * np.exp(-c * self.mass_radii) - d * self.mass_radii
+        prior &= np.all(T > 0, axis=1) & np.all(T_grid > 0, axis=1)
+        return chi2_T + chi2_sb, prior
+
+    def mass_violation(self, theta):
+        """
+        How far each row of ``theta`` is from a positive, non-decreasing mass
+        on ``mass_radii`` (0 when physical), relative to the largest mass.
+        """
+        with np.errstate(invalid='ignore', over='ignore', divide='ignore'):
+            mass = self.mass_profiles(theta, self.mass_radii)
+            scale = np.max(np.abs(mass), axis=1)
+            violation = (np.sum(np.maximum(-mass, 0), axis=1) +
+                         np.sum(np.maximum(-np.diff(mass, axis=1), 0), axis=1)) / scale
+        return np.where(np.isfinite(violation), violation, np.inf)
+
+    def __call__(self, theta):
+        chi2, prior = self._chi2(theta)
+        if self.physical:
+            prior &= self.mass_violation(theta) == 0
+        return np.where(prior, -0.5 * chi2, -np.inf)
+
+    def physical_start(self, start, penalties=(1e2, 1e4, 1e6, 1e8)):
+        """
+        Nearest physical starting point: minimizes chi2 plus a growing
+        penalty times the mass violation from ``start`` (e.g. separate fits
+        whose combined mass is negative somewhere).
+        """
+        x = np.asarray(start, dtype=float)
+        for penalty in penalties:
+            def objective(y):
+                chi2, prior = self._chi2(y)
+                return float(chi2[0] + penalty * self.mass_violation(y)[0]) if prior[0] else np.inf
+            x = minimize(objective, x, method='Nelder-Mead', options={'maxiter': 20000, 'maxfev': 20000}).x
+            if self.mass_violation(x)[0] == 0:
+                break
+        return x
+
+    def initial_guess(self, temperature_guess=None, sb_guess=None):
+        """
+        Starting point from the separate fits: ``CurveFitter`` for T(r) and a
+        least-squares beta model for the surface brightness.
+        """
+        temperature_params, _ = CurveFitter(self.radius, self.temperature, None,
+                                            self.temperature_err).fit_curve(temperature_guess)
+        beta_model = lambda r, ampl, r0, beta: ampl * (1 + (r / r0)**2)**(0.5 - 3 * beta)
+        if sb_guess is None:
+            sb_guess = (self.sb[0], np.median(self.sb_radius), 0.7)
+        sb_params, _ = curve_fit(beta_model, self.sb_radius, self.sb, p0=sb_guess, sigma=self.sb_err,
+                                 absolute_sigma=True, maxfev=30000)
+        return np.concatenate([temperature_params, sb_params])
+
+
+class JointHydrostaticFit:
+    """
+    Posterior of the joint T(r) + beta model fit sampled with ``EnsembleSampler``.
+
+    Parameters:
+    -----------
+    likelihood : JointHydrostaticLikelihood
+    n_walkers : int
+        Number of walkers (even, at least 14).
+    max_workers : int, optional
+        Processes evaluating the walkers.
+    """
+
+    def __init__(self, likelihood, n_walkers=32, max_workers=None):
+        self.likelihood = likelihood
+        self.sampler = EnsembleSampler(likelihood, n_walkers, len(likelihood.PARAMETERS), max_workers=max_workers)
+
+    def run(self, n_steps=2000, start=None, seed=None, scatter=1e-3):
+        """
+        Samples the posterior starting from a small ball around ``start``
+        (``likelihood.initial_guess()`` by default), moved to the nearest
+        physical point if needed. Walkers drawn outside the prior are redrawn.
+        """
+        rng = np.random.default_rng(seed)
+        start = self.likelihood.initial_guess() if start is None else np.asarray(start, dtype=float)
+        n_walkers, n_dim = self.sampler.n_walkers, self.sampler.n_dim
+        if not np.isfinite(self.likelihood(start)[0]):
+            start = self.likelihood.physical_start(start)
+        if not np.isfinite(self.likelihood(start)[0]):
+            raise ValueError("No starting point inside the prior (e.g. a non-physical mass profile)")
+        p0 = start * (1 + scatter * rng.standard_normal((n_walkers, n_dim)))
+        for _ in range(100):
+            bad = ~np.isfinite(self.likelihood(p0))
+            if not bad.any():
+                break
+            p0[bad] = start * (1 + scatter * rng.standard_normal((bad.sum(), n_dim)))
+        self.sampler.run(p0, n_steps, seed=rng.integers(2**32))
+        return self
+
+    def samples(self, discard=0, thin=1):
+        return self.sampler.get_chain(discard, thin, flat=True)
+
+    def parameter_summary(self, discard=0, thin=1):
+        """
+        ``[median, +err, -err]`` (16th and 84th percentiles) of every parameter.
+        """
+        low, median, high = np.percentile(self.samples(discard, thin), [16, 50, 84], axis=0)
+        return {name: [median[i], high[i] - median[i], low[i] - median[i]]
+                for i, name in enumerate(self.likelihood.PARAMETERS)}
+
+    def mass_posterior(self, R_values, discard=0, thin=1, percentiles=(16, 50, 84)):
+        """
+        Percentiles of the posterior mass profile at ``R_values`` (kpc), with
+        every retained sample evaluated in one vectorized call.
+        """
+        mass = self.likelihood.mass_profiles(self.samples(discard, thin), R_values)
+        table = pd.DataFrame({'R_kpc': np.asarray(R_values, dtype=float)})
+        for q, values in zip(percentiles, np.percentile(mass, percentiles, axis=0)):
+            table[f'M_p{q:g}_Msun'] = values
+        return table
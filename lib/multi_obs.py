@@ -0,0 +1,237 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import astropy.io.fits as fits
+from astropy.wcs import WCS
+
+from lib.regions import transform_region_file
+from lib.radial_profile import Profile
+from lib.image_profile import write_profile_fits
+from lib.spectral_fit import ajuste_apec_nativo
+from lib.instrumentation import instrument
+
+
+def sky_wcs(evt_path):
+    """
+    Tangent-plane WCS of the sky x/y columns of an event file (the
+    TCTYP/TCRVL/TCRPX/TCDLT keywords of the columns), for physical
+    coordinates (origin 1).
+    """
+    with fits.open(evt_path, memmap=True) as hdulist:
+        hdu = hdulist['EVENTS']
+        header = hdu.header
+        names = [name.lower() for name in hdu.columns.names]
+    ix, iy = names.index('x') + 1, names.index('y') + 1
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = [header.get(f'TCTYP{ix}', 'RA---TAN'), header.get(f'TCTYP{iy}', 'DEC--TAN')]
+    wcs.wcs.crval = [header[f'TCRVL{ix}'], header[f'TCRVL{iy}']]
+    wcs.wcs.crpix = [header[f'TCRPX{ix}'], header[f'TCRPX{iy}']]
+    wcs.wcs.cdelt = [header[f'TCDLT{ix}'], header[f'TCDLT{iy}']]
+    return wcs
+
+
+class Observation:
+    """
+    One ObsID of a cluster.
+
+    Attributes:
+    ----------
+    obsid : str
+        Observation identifier, also the name of its working directory.
+    evt_path : str
+        Clean event file.
+    bkg_path : str, optional
+        Background event file; without it the spectra and the profile are
+        extracted without background subtraction.
+    """
+
+    def __init__(self, obsid, evt_path, bkg_path=None):
+        self.obsid = str(obsid)
+        self.evt_path = evt_path
+        self.bkg_path = bkg_path
+        self._wcs = None
+        self._exposure = None
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(entry['obsid'], entry['evt_path'], entry.get('bkg_path'))
+
+    @property
+    def wcs(self):
+        if self._wcs is None:
+            self._wcs = sky_wcs(self.evt_path)
+        return self._wcs
+
+    @property
+    def exposure(self):
+        """
+        Exposure time (s) of the event file (EXPOSURE, or LIVETIME when absent).
+        """
+        if self._exposure is None:
+            with fits.open(self.evt_path, memmap=True) as hdulist:
+                header = hdulist['EVENTS'].header
+            keyword = next((keyword for keyword in ('EXPOSURE', 'LIVETIME') if keyword in header), None)
+            if keyword is None:
+                # sem exposição os perfis não podem ser pesados; um valor fictício esconderia o erro
+                raise ValueError(f"{self.evt_path}: the EVENTS header has no EXPOSURE or LIVETIME keyword")
+            self._exposure = float(header[keyword])
+        return self._exposure
+
+    def sky_to_world(self, x, y):
+        return self.wcs.wcs_pix2world(x, y, 1)
+
+    def world_to_sky(self, ra, dec):
+        return self.wcs.wcs_world2pix(ra, dec, 1)
+
+
+def reproject_region_file(reg_path, reference, observation, output_path):
+    """
+    Rewrites a region file drawn on the sky frame of ``reference`` in the
+    sky frame of ``observation``: the centers go through (RA, Dec) and the
+    radii are scaled by the ratio of the sky pixel sizes.
+    """
+    scale = abs(reference.wcs.wcs.cdelt[0] / observation.wcs.wcs.cdelt[0])
+    transform = lambda x, y: observation.world_to_sky(*reference.sky_to_world(x, y))
+    transform_region_file(reg_path, transform, output_path, scale)
+
+
+def combine_profiles(profile_paths, exposures, output_path):
+    """
+    Exposure-weighted sum of the surface brightness profiles (dmextract
+    layout) of the same annuli in several observations: the net counts are
+    summed and divided by the exposure-weighted mean area, so the result
+    is in counts/pixel^2 for the total exposure, like a single deep
+    observation.
+    """
+    exposures = np.asarray(exposures, dtype=float)
+    net, variance, counts, area = 0.0, 0.0, 0.0, 0.0
+    for path, exposure in zip(profile_paths, exposures):
+        with fits.open(path) as hdulist:
+            data = hdulist[1].data
+            radii = np.array(data['R'], dtype=float)
+            obs_area = np.array(data['AREA'], dtype=float)
+            obs_net = np.array(data['NET_COUNTS'], dtype=float)
+            # erro das contagens líquidas pelo do brilho, válido para as duas versões da tabela
+            variance = variance + (np.array(data['SUR_BRI_ERR'], dtype=float) * obs_area)**2
+            counts = counts + np.array(data['COUNTS'], dtype=float)
+        net = net + obs_net
+        area = area + obs_area * exposure / exposures.sum()
+
+    profile = Profile(radii[:, 0], radii[:, 1], radius_unit='pixel')
+    profile.add_column('counts', counts, np.sqrt(counts), unit='counts')
+    profile.add_column('bkg_counts', counts - net, unit='counts')
+    profile.add_column('net_counts', net, np.sqrt(variance), unit='counts')
+    profile.add_column('area', area, unit='pixel^2')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        profile.add_column('sur_bri', net / area, np.sqrt(variance) / area, unit='counts/pixel^2')
+    write_profile_fits(profile, output_path)
+    return output_path
+
+
+class MultiObservation:
+    """
+    Joint analysis of several ObsIDs of one cluster.
+
+    ``reg_path`` is drawn on the sky frame of the first observation and
+    reprojected to the frame of each one. Spectra and surface brightness
+    profiles are extracted per observation, the observations in parallel
+    (the CIAO tools run as subprocesses, so threads are enough), and then
+    combined: one joint spectral fit per annulus and an exposure-weighted
+    summed profile.
+
+    Parameters:
+    -----------
+    observations : list of Observation
+        The first one is the reference frame of ``reg_path``.
+    reg_path : str
+        Region file (annuli/pies, with optional exclusions).
+    work_dir : str
+        Each observation gets ``work_dir/<obsid>`` with its region file,
+        spectra and profile.
+    conda_env_path : str, optional
+        Conda environment where CIAO is installed.
+    max_workers : int, optional
+        Observations extracted at the same time.
+    """
+
+    def __init__(self, observations, reg_path, work_dir, conda_env_path=None, max_workers=None):
+        if not observations:
+            raise ValueError("At least one observation is required")
+        self.observations = list(observations)
+        self.reg_path = reg_path
+        self.work_dir = os.path.abspath(work_dir)
+        self.conda_env_path = conda_env_path
+        self.max_workers = max_workers
+
+    @classmethod
+    def from_config(cls, config, work_dir, reg_path=None, max_workers=None):
+        """
+        Observations of the ``observations`` entries of a batch.ClusterConfig.
+        """
+        return cls([Observation.from_dict(entry) for entry in config.observations],
+                   reg_path if reg_path is not None else config.reg_path, work_dir, config.conda_ciao_env_path,
+                   max_workers)
+
+    @property
+    def reference(self):
+        return self.observations[0]
+
+    def directory(self, observation):
+        return os.path.join(self.work_dir, observation.obsid)
+
+    def region_path(self, observation):
+        return os.path.join(self.directory(observation), 'region.reg')
+
+    def spec_dir(self, observation):
+        return os.path.join(self.directory(observation), 'extract')
+
+    def profile_path(self, observation):
+        return os.path.join(self.directory(observation), 'surface_brighness.fits')
+
+    def reproject_regions(self):
+        for observation in self.observations:
+            os.makedirs(self.directory(observation), exist_ok=True)
+            reproject_region_file(self.reg_path, self.reference, observation, self.region_path(observation))
+        return [self.region_path(observation) for observation in self.observations]
+
+    def extract_spectra(self, observation):
+        from lib import batch
+        _, extrair_espectros = batch._load_data_analysis('função_extrair_espectros.py', 'extrair_espectros')
+        extrair_espectros(os.path.dirname(os.path.abspath(observation.evt_path)), self.region_path(observation),
+                          os.path.basename(observation.evt_path),
+                          None if observation.bkg_path is None else os.path.abspath(observation.bkg_path),
+                          self.spec_dir(observation), conda_env_path=self.conda_env_path)
+
+    def extract_profile(self, observation):
+        from lib.superficie_de_brilho import Create_rprofile
+        Create_rprofile(self.conda_env_path, observation.evt_path, self.region_path(observation),
+                        self.directory(observation), observation.bkg_path).make_rprofile()
+
+    @instrument('multi_obs_extraction')
+    def extract_all(self):
+        """
+        Reprojects the regions and extracts the spectra and the profile of
+        every observation, all observations at the same time.
+        """
+        self.reproject_regions()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(function, observation) for observation in self.observations
+                       for function in (self.extract_spectra, self.extract_profile)]
+            for future in futures:
+                future.result()
+
+    def combine_profiles(self, output_path=None):
+        output_path = output_path or os.path.join(self.work_dir, 'surface_brighness.fits')
+        return combine_profiles([self.profile_path(observation) for observation in self.observations],
+                                [observation.exposure for observation in self.observations], output_path)
+
+    def fit_spectra(self, table_path, redshift, nH, output_dir=None, **kwargs):
+        """
+        Joint native fit of the spectra of every annulus over the
+        observations (see ``ajuste_apec_nativo``). Returns the path of
+        ``ajuste_apec.fits``.
+        """
+        return ajuste_apec_nativo([self.spec_dir(observation) for observation in self.observations],
+                                  self.region_path(self.reference), table_path, redshift, nH,
+                                  output_dir=output_dir or self.work_dir, **kwargs)
@@ -0,0 +1,423 @@
+import os
+import json
+import hashlib
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+
+from lib import batch
+from lib.multi_obs import MultiObservation
+from lib.instrumentation import profiler, stage as stage_timer
+
+
+class Stage:
+    """
+    One step of the analysis pipeline.
+
+    Attributes:
+    ----------
+    name : str
+        Unique name of the stage.
+    func : callable
+        Function called without arguments; it must write every path in ``outputs``.
+    inputs : list of str
+        Files or directories read by the stage.
+    outputs : list of str
+        Files or directories written by the stage.
+    params : dict
+        Non-file settings of the stage (redshift, nH, ...). Changing them
+        makes the stage stale as well.
+    exclusive : bool
+        The stage is not thread-safe (PyXSPEC changes the working directory,
+        sherpa and pyplot keep global state): it runs alone, with no other
+        stage running at the same time.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, exclusive=False):
+        self.name = name
+        self.func = func
+        self.inputs = [os.path.abspath(path) for path in inputs]
+        self.outputs = [os.path.abspath(path) for path in outputs]
+        self.params = params or {}
+        self.exclusive = exclusive
+
+    def params_hash(self):
+        return hashlib.sha256(json.dumps(self.params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Pipeline:
+    """
+    Dependency-graph scheduler that rebuilds only the stages whose inputs changed.
+
+    A stage depends on every stage that produces one of its inputs. After a
+    stage runs, the content hashes (SHA-256) of its inputs and outputs are
+    stored in ``state_path``; on the next run the stage is skipped if none of
+    them changed. Independent branches run in parallel in a thread pool (the
+    heavy work is done by CIAO subprocesses and compiled code); exclusive
+    stages run alone.
+
+    Parameters:
+    -----------
+    state_path : str
+        JSON file where the hashes of the last successful run are kept.
+    max_workers : int, optional
+        Maximum number of stages running at the same time.
+    """
+
+    def __init__(self, state_path, max_workers=None):
+        self.state_path = state_path
+        self.max_workers = max_workers
+        self.stages = {}
+        self.state = {'stages': {}, 'hash_cache': {}}
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as file:
+                self.state = json.load(file)
+
+    def add_stage(self, name, func, inputs=(), outputs=(), params=None, exclusive=False):
+        if name in self.stages:
+            raise ValueError(f"Stage {name} already defined")
+        stage = Stage(name, func, inputs, outputs, params, exclusive)
+        for other in self.stages.values():
+            overlap = set(stage.outputs) & set(other.outputs)
+            if overlap:
+                raise ValueError(f"Stages {other.name} and {name} both write {sorted(overlap)}")
+        self.stages[name] = stage
+        return stage
+
+    def dependencies(self):
+        """
+        Returns a dict mapping each stage name to the names of the stages it depends on.
+        """
+        producers = {path: stage.name for stage in self.stages.values() for path in stage.outputs}
+        return {name: sorted({producers[path] for path in stage.inputs if path in producers})
+                for name, stage in self.stages.items()}
+
+    def topological_order(self):
+        dependencies = self.dependencies()
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle in the pipeline involving stage {name}")
+            visiting.add(name)
+            for dependency in dependencies[name]:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def file_hash(self, path):
+        """
+        SHA-256 of a file, or of the sorted (name, hash) pairs of a directory.
+
+        Hashes are cached by (size, mtime) so unchanged large event files are
+        not read again.
+        """
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for entry in sorted(os.listdir(path)):
+                digest.update(entry.encode())
+                digest.update(self.file_hash(os.path.join(path, entry)).encode())
+            return digest.hexdigest()
+        stat = os.stat(path)
+        key = f"{stat.st_size}:{stat.st_mtime_ns}"
+        cached = self.state['hash_cache'].get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        self.state['hash_cache'][path] = [key, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def _hashes(self, paths):
+        return {path: self.file_hash(path) if os.path.exists(path) else None for path in paths}
+
+    def is_stale(self, name):
+        """
+        True if the stage has never run, its params changed, an output is
+        missing or modified, or an input content differs from the last run.
+        """
+        stage = self.stages[name]
+        record = self.state['stages'].get(name)
+        if record is None or record['params'] != stage.params_hash():
+            return True
+        if any(not os.path.exists(path) for path in stage.outputs):
+            return True
+        return self._hashes(stage.inputs) != record['inputs'] or self._hashes(stage.outputs) != record['outputs']
+
+    def _save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.state, file, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def _run_stage(self, name):
+        stage = self.stages[name]
+        missing = [path for path in stage.inputs if not os.path.exists(path)]
+        if missing:
+            raise FileNotFoundError(f"Stage {name}: missing inputs {missing}")
+        for path in stage.outputs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with stage_timer(name):
+            stage.func()
+        missing = [path for path in stage.outputs if not os.path.exists(path)]
+        if missing:
+            raise RuntimeError(f"Stage {name} did not write {missing}")
+
+    def run(self, targets=None, force=False):
+        """
+        Runs the stale stages needed for ``targets`` (all stages by default).
+
+        Parameters:
+        -----------
+        targets : list of str, optional
+            Stages to bring up to date, together with their dependencies.
+        force : bool
+            Rebuild every selected stage regardless of the hashes.
+
+        Returns:
+        --------
+        dict
+            Stage name -> 'ran', 'up to date' or 'failed: ...'/'skipped: ...'.
+
+        When profiling is enabled, the instrumentation report is written next
+        to the state file (``pipeline_profile.json``/``.folded``).
+        """
+        dependencies = self.dependencies()
+        order = self.topological_order()
+        if targets is not None:
+            selected = set()
+            pending = list(targets)
+            while pending:
+                name = pending.pop()
+                if name not in selected:
+                    selected.add(name)
+                    pending.extend(dependencies[name])
+            order = [name for name in order if name in selected]
+
+        status = {}
+        running = {}
+        remaining = list(order)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while remaining or running:
+                for name in list(remaining):
+                    if any(dep not in status for dep in dependencies[name]):
+                        continue
+                    # um estágio exclusivo só começa sozinho, e nada começa enquanto ele roda
+                    if running and (self.stages[name].exclusive
+                                    or any(self.stages[other].exclusive for other in running.values())):
+                        continue
+                    remaining.remove(name)
+                    failed = [dep for dep in dependencies[name] if not status[dep].startswith(('ran', 'up to date'))]
+                    if failed:
+                        status[name] = f"skipped: {', '.join(failed)} failed"
+                    elif force or self.is_stale(name):
+                        running[executor.submit(self._run_stage, name)] = name
+                    else:
+                        status[name] = 'up to date'
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        stage = self.stages[name]
+                        self.state['stages'][name] = {'params': stage.params_hash(),
+                                                      'inputs': self._hashes(stage.inputs),
+                                                      'outputs': self._hashes(stage.outputs)}
+                        self._save_state()
+                        status[name] = 'ran'
+                    else:
+                        status[name] = f"failed: {type(error).__name__}: {error}"
+                    print(f"[{name}] {status[name]}")
+        if profiler.enabled:
+            profiler.write_report(os.path.join(os.path.dirname(os.path.abspath(self.state_path)), 'pipeline_profile.json'))
+        return status
+
+
+def _add_observation_stages(pipeline, config, reg_path, work_dir):
+    """
+    Adds the per-ObsID stages of ``config.observations``: the reprojection of
+    the regions to every sky frame and, for each observation, its spectral
+    and profile extractions, which the pipeline runs in parallel.
+
+    Returns:
+    --------
+    MultiObservation
+    """
+    multi = MultiObservation.from_config(config, os.path.join(work_dir, 'observations'), reg_path)
+    region_paths = [multi.region_path(observation) for observation in multi.observations]
+    pipeline.add_stage('reproject_regions', multi.reproject_regions,
+                       inputs=[reg_path] + [observation.evt_path for observation in multi.observations],
+                       outputs=region_paths)
+    for observation in multi.observations:
+        inputs = [path for path in (observation.evt_path, observation.bkg_path) if path is not None]
+        inputs.append(multi.region_path(observation))
+        pipeline.add_stage(f'extract_spectra_{observation.obsid}', partial(multi.extract_spectra, observation),
+                           inputs=inputs, outputs=[multi.spec_dir(observation)])
+        pipeline.add_stage(f'extract_profile_{observation.obsid}', partial(multi.extract_profile, observation),
+                           inputs=inputs, outputs=[multi.profile_path(observation)])
+    return multi
+
+
+def build_cluster_pipeline(config, work_dir, max_workers=None):
+    """
+    Builds the extract -> fit -> profile -> mass pipeline of one cluster.
+
+    The spectral branch (specextract, XSPEC, profiles, T(r) fit) and the
+    surface brightness branch (dmextract, beta model) are independent and
+    run in parallel; they join in the mass stage. The extraction stages are
+    only added when ``config.evt_path`` is set, otherwise the pickles and the
+    surface brightness FITS of the config are used as the pipeline sources.
+    With ``config.detect_sources``, a source detection stage writes the
+    annuli with the point sources excluded, which the extraction stages use.
+    With ``config.observations``, every ObsID gets its own extraction stages
+    (run in parallel) and the spectral fit and profile combine them.
+
+    Parameters:
+    -----------
+    config : batch.ClusterConfig
+        Cluster configuration.
+    work_dir : str
+        Directory where every intermediate product and the state file are written.
+
+    Returns:
+    --------
+    Pipeline
+    """
+    work_dir = os.path.abspath(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    pipeline = Pipeline(os.path.join(work_dir, 'pipeline_state.json'), max_workers=max_workers)
+
+    spec_dir = os.path.join(work_dir, 'extract')
+    pkl_temp_path = pkl_norm_path = os.path.join(work_dir, 'ajuste_apec.fits')
+    sb_fits_path = os.path.join(work_dir, 'surface_brighness.fits')
+    profiles_path = os.path.join(work_dir, 'profiles.csv')
+    temperature_fit_path = os.path.join(work_dir, 'temperature_fit.json')
+    sb_fit_path = os.path.join(work_dir, 'sb_fit.json')
+    mass_path = os.path.join(work_dir, 'mass_profile.csv')
+
+    reg_path = config.reg_path
+    # com várias observações, as fontes são detectadas na de referência (a primeira)
+    evt_path = config.observations[0]['evt_path'] if config.observations else config.evt_path
+    if evt_path is not None:
+        if config.detect_sources:
+            source_reg_path = config.reg_path
+            reg_path = os.path.join(work_dir, 'region_sources.reg')
+
+            def detect_sources():
+                batch.detect_point_sources(evt_path, source_reg_path, work_dir)
+
+            pipeline.add_stage('detect_sources', detect_sources, inputs=[evt_path, source_reg_path],
+                               outputs=[reg_path])
+
+        if config.observations:
+            multi = _add_observation_stages(pipeline, config, reg_path, work_dir)
+            spec_dirs = [multi.spec_dir(observation) for observation in multi.observations]
+
+            def fit_spectra():
+                batch.run_spectral_fit(config, work_dir, spec_dirs)
+
+            def extract_profile():
+                multi.combine_profiles(sb_fits_path)
+
+            fit_inputs = spec_dirs + [config.reg_path]
+            profile_inputs = [multi.profile_path(observation) for observation in multi.observations]
+        else:
+            def extract_spectra():
+                _, extrair_espectros = batch._load_data_analysis('função_extrair_espectros.py', 'extrair_espectros')
+                # caminho absoluto: o fundo pode estar fora do diretório dos eventos
+                background_file = None if config.bkg_path is None else os.path.abspath(config.bkg_path)
+                extrair_espectros(os.path.dirname(os.path.abspath(config.evt_path)), reg_path,
+                                  os.path.basename(config.evt_path), background_file,
+                                  spec_dir, conda_env_path=config.conda_ciao_env_path)
+
+            def fit_spectra():
+                batch.run_spectral_fit(config, work_dir, spec_dir)
+
+            def extract_profile():
+                from lib.superficie_de_brilho import Create_rprofile
+                Create_rprofile(config.conda_ciao_env_path, config.evt_path, reg_path, work_dir,
+                                config.bkg_path).make_rprofile()
+
+            # sem arquivo de fundo, a extração e o perfil seguem sem subtração
+            event_inputs = [path for path in (config.evt_path, config.bkg_path) if path is not None] + [reg_path]
+            pipeline.add_stage('extract_spectra', extract_spectra, inputs=event_inputs, outputs=[spec_dir])
+            fit_inputs, profile_inputs = [spec_dir, config.reg_path], event_inputs
+
+        if config.apec_table is not None:
+            # a tabela é entrada do ajuste: editá-la no mesmo caminho também refaz o estágio
+            fit_inputs = fit_inputs + [config.apec_table]
+        # o PyXSPEC muda o diretório de trabalho e guarda o estado da sessão: não roda ao lado de outros estágios
+        pipeline.add_stage('fit_spectra', fit_spectra, inputs=fit_inputs,
+                           outputs=[pkl_temp_path],
+                           params={'redshift': config.redshift, 'nH': config.nH, 'abundance': config.abundance},
+                           exclusive=config.apec_table is None)
+        pipeline.add_stage('extract_profile', extract_profile, inputs=profile_inputs, outputs=[sb_fits_path])
+    else:
+        pkl_temp_path, pkl_norm_path = config.pkl_temp_path, config.pkl_norm_path
+        sb_fits_path = config.r_profile_fits_path
+
+    # os estágios rodam em threads: os caminhos vão como argumentos, config nunca é alterado
+    def profiles():
+        batch.build_profiles(config, pkl_temp_path, pkl_norm_path).to_csv(profiles_path, index=False)
+
+    def previous_result(path):
+        # resultado da rodada anterior do estágio, usado como ponto de partida (warm start)
+        if not config.warm_start or not os.path.exists(path):
+            return None
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    def temperature_fit():
+        result = batch.fit_temperature_profile(config, pd.read_csv(profiles_path), previous_result(temperature_fit_path))
+        with open(temperature_fit_path, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    def sb_fit():
+        # o ajuste aos fótons usa os anéis com as fontes excluídas; config não é alterado (estágios em paralelo)
+        result = batch.fit_surface_brightness(config, previous_result(sb_fit_path), reg_path=reg_path,
+                                              sb_fits_path=sb_fits_path)
+        with open(sb_fit_path, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    def mass():
+        with open(temperature_fit_path, 'r') as file:
+            temperature_result = json.load(file)
+        with open(sb_fit_path, 'r') as file:
+            sb_result = json.load(file)
+        R_values = np.logspace(1, 3, 100)
+        M_values = batch.evaluate_mass(config, temperature_result, sb_result, R_values)
+        Mgas_values = batch.evaluate_gas_mass(config, temperature_result, sb_result, R_values)
+        pd.DataFrame({'R_kpc': R_values, 'M_Msun': M_values, 'Mgas_Msun': Mgas_values,
+                      'f_gas': Mgas_values / M_values}).to_csv(mass_path, index=False)
+
+    pipeline.add_stage('profiles', profiles, inputs=sorted({pkl_temp_path, pkl_norm_path}) + [config.reg_path],
+                       outputs=[profiles_path],
+                       params={'redshift': config.redshift, 'mu': config.mu, 'cooling_function': config.cooling_function})
+    pipeline.add_stage('temperature_fit', temperature_fit, inputs=[profiles_path], outputs=[temperature_fit_path],
+                       params={'exclude_bins': config.exclude_bins})
+    if sb_fits_path is not None:
+        sb_inputs = [sb_fits_path, reg_path]
+        if config.sb_method == 'unbinned' and config.evt_path is not None:
+            # o ajuste sem binagem lê os fótons diretamente
+            sb_inputs.append(config.evt_path)
+        # o ajuste binado usa o sherpa e o pyplot (estado global)
+        pipeline.add_stage('sb_fit', sb_fit, inputs=sb_inputs, outputs=[sb_fit_path],
+                           params={'redshift': config.redshift, 'sb_method': config.sb_method,
+                                   'sb_error_method': config.sb_error_method},
+                           exclusive=config.sb_method != 'unbinned')
+        pipeline.add_stage('mass', mass, inputs=[temperature_fit_path, sb_fit_path], outputs=[mass_path],
+                           params={'mu_mass': config.mu_mass, 'cooling_function': config.cooling_function})
+    return pipeline
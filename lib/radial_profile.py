@@ -0,0 +1,211 @@
+import numpy as np
+import pandas as pd
+
+from lib.converte import UnitConverter
+from lib.regions import RegionProcessor
+from lib.fit_results import load_fit_rows
+from lib.classe_densidade import calcula_densidade_array
+
+
+class Profile:
+    """
+    Array-backed radial profile with shared radius/edge arrays.
+
+    All quantities (temperature, density, pressure, ...) are rows of two
+    2D arrays, one for the values and one for the errors, so a slice of the
+    profile is a view of every column at once. Bins are removed by clearing
+    the shared boolean ``mask`` (no copy); ``compress`` materializes the
+    valid bins once when a contiguous array is needed (e.g. for a fit).
+
+    Attributes:
+    ----------
+    r_in, r_out : numpy.ndarray
+        Inner and outer radius of each bin.
+    radius : numpy.ndarray
+        Bin midpoint, as in ``Annulus.calculate_radius``.
+    mask : numpy.ndarray
+        True for the bins that are used.
+    units : dict
+        Unit of the radius and of every column.
+    names : list of str
+        Column names, in storage order.
+    """
+
+    def __init__(self, r_in, r_out, radius_unit='kpc', mask=None, values=None, errors=None, names=None, units=None):
+        self.r_in = np.asarray(r_in, dtype=float)
+        self.r_out = np.asarray(r_out, dtype=float)
+        self.radius = 0.5 * (self.r_in + self.r_out)
+        n = self.r_in.size
+        self.mask = np.ones(n, dtype=bool) if mask is None else mask
+        # linhas alocadas além das colunas em uso: add_column preenche a próxima sem copiar o resto
+        self._value_rows = np.empty((0, n)) if values is None else values
+        self._error_rows = np.empty((0, n)) if errors is None else errors
+        self.names = [] if names is None else names
+        self.units = {'radius': radius_unit} if units is None else units
+
+    def __len__(self):
+        return self.r_in.size
+
+    @property
+    def _values(self):
+        return self._value_rows[:len(self.names)]
+
+    @property
+    def _errors(self):
+        return self._error_rows[:len(self.names)]
+
+    def _reserve(self, n_columns):
+        # capacidade dobra a cada realocação, então n colunas custam O(n) cópias no total
+        if n_columns <= len(self._value_rows):
+            return
+        capacity = max(n_columns, 2 * len(self._value_rows), 8)
+        for attribute in ('_value_rows', '_error_rows'):
+            rows = np.full((capacity, len(self)), np.nan)
+            rows[:len(self.names)] = getattr(self, attribute)[:len(self.names)]
+            setattr(self, attribute, rows)
+
+    @property
+    def half_width(self):
+        return 0.5 * (self.r_out - self.r_in)
+
+    def add_column(self, name, values, errors=None, unit=None):
+        """
+        Adds (or replaces) a column. Missing errors are stored as NaN.
+        """
+        values = np.asarray(values, dtype=float)
+        errors = np.full(values.shape, np.nan) if errors is None else np.asarray(errors, dtype=float)
+        if values.shape != (len(self),) or errors.shape != (len(self),):
+            raise ValueError(f"Column {name} must have one value per bin ({len(self)})")
+        if name in self.names:
+            index = self.names.index(name)
+            self._values[index] = values
+            self._errors[index] = errors
+        else:
+            index = len(self.names)
+            self._reserve(index + 1)
+            self._value_rows[index] = values
+            self._error_rows[index] = errors
+            self.names.append(name)
+        self.units[name] = unit
+        return self
+
+    def value(self, name):
+        return self._values[self.names.index(name)]
+
+    def error(self, name):
+        return self._errors[self.names.index(name)]
+
+    def __getitem__(self, index):
+        """
+        Basic slicing (``profile[2:-2]``) returns a Profile whose arrays are
+        views of this one.
+        """
+        if not isinstance(index, slice):
+            raise TypeError("Profiles are sliced with slices; use exclude/select to drop single bins")
+        return Profile(self.r_in[index], self.r_out[index], mask=self.mask[index], values=self._values[:, index],
+                       errors=self._errors[:, index], names=list(self.names), units=dict(self.units))
+
+    def exclude(self, indices):
+        """
+        Masks out the given bins (negative indices count from the end).
+        """
+        self.mask[np.asarray(indices, dtype=int)] = False
+        return self
+
+    def select(self, condition):
+        """
+        Keeps only the bins where ``condition`` (boolean array) is True.
+        """
+        self.mask &= np.asarray(condition, dtype=bool)
+        return self
+
+    def mask_invalid(self, *names):
+        """
+        Masks the bins where any of the given columns (all by default) is not finite.
+        """
+        rows = [self.names.index(name) for name in names] if names else slice(None)
+        return self.select(np.all(np.isfinite(self._values[rows]), axis=0))
+
+    def compress(self):
+        """
+        Returns a new Profile with only the unmasked bins (one copy of all columns).
+        """
+        keep = self.mask
+        return Profile(self.r_in[keep], self.r_out[keep], values=self._values[:, keep],
+                       errors=self._errors[:, keep], names=list(self.names), units=dict(self.units))
+
+    def to_dataframe(self, masked=True):
+        profile = self.compress() if masked else self
+        columns = {'r_in': profile.r_in, 'r_out': profile.r_out, 'radius': profile.radius,
+                   'radius_err': profile.half_width}
+        for name in profile.names:
+            columns[name] = profile.value(name)
+            columns[f'{name}_err'] = profile.error(name)
+        return pd.DataFrame(columns)
+
+    @classmethod
+    def from_regions(cls, reg_path, redshift):
+        """
+        Builds an empty profile (radii in kpc) from the annuli/pies of a region file.
+        """
+        processor = RegionProcessor(reg_path)
+        processor.parse_file()
+        r_in = np.array([region.inner_radius for region in processor.regions], dtype=float)
+        r_out = np.array([region.outer_radius for region in processor.regions], dtype=float)
+        return cls(UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(r_in), redshift),
+                   UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(r_out), redshift))
+
+    @classmethod
+    def from_fit_results(cls, reg_path, pkl_temp_path, pkl_norm_path, redshift, mu):
+        """
+        Builds the temperature, normalization and density profile from the
+        region file and the spectral fit results (FIT_RESULTS table or legacy
+        pickles). Bins whose fit failed are masked.
+        """
+        profile = cls.from_regions(reg_path, redshift)
+        temperature = load_fit_rows(pkl_temp_path, 'kT')
+        norm = load_fit_rows(pkl_norm_path, 'norm')
+        temperature_err = 0.5 * (np.abs(temperature[:, 1]) + np.abs(temperature[:, 2]))
+        norm_err = 0.5 * (np.abs(norm[:, 1]) + np.abs(norm[:, 2]))
+        profile.add_column('temperature', temperature[:, 0], temperature_err, unit='keV')
+        profile.add_column('norm', norm[:, 0], norm_err, unit='cm^-5')
+
+        r_in_cm = UnitConverter.kpc_to_cm(profile.r_in)
+        r_out_cm = UnitConverter.kpc_to_cm(profile.r_out)
+        density = calcula_densidade_array(redshift, mu, profile.value('norm'), r_out_cm, r_in_cm)
+        # n ~ sqrt(N): erro relativo da densidade é metade do erro relativo da normalização
+        profile.add_column('density', density, 0.5 * density * norm_err / profile.value('norm'), unit='cm^-3')
+        return profile.mask_invalid('temperature', 'norm')
+
+    def add_thermodynamics(self, cooling_function):
+        """
+        Adds pressure, entropy and cooling time computed from the density and
+        temperature columns in one vectorized pass (same formulas as
+        ``pressao``, ``Entropia`` and ``cooling_time``), with the relative
+        errors propagated in quadrature.
+        """
+        quantities = thermodynamic_quantities(self.value('density'), self.error('density'),
+                                              self.value('temperature'), self.error('temperature'), cooling_function)
+        for name, (values, errors, unit) in quantities.items():
+            self.add_column(name, values, errors, unit=unit)
+        return self
+
+
+def thermodynamic_quantities(n, n_err, T, T_err, cooling_function):
+    """
+    Pressure, entropy and cooling time of arrays of any shape of density
+    (cm^-3) and temperature (keV), with errors propagated in quadrature.
+
+    Returns:
+    --------
+    dict
+        ``name: (values, errors, unit)`` for ``pressure``, ``entropy`` and ``cooling_time``.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_n, rel_T = n_err / n, T_err / T
+        pressure = 2 * n * T
+        entropy = T * n**(-2 / 3)
+        cooling = 3 * 3.17098e-8 * pressure * 1.60218e-9 / (2 * n**2 * cooling_function)
+    return {'pressure': (pressure, pressure * np.hypot(rel_n, rel_T), 'keV cm^-3'),
+            'entropy': (entropy, entropy * np.hypot(2 / 3 * rel_n, rel_T), 'keV cm^2'),
+            'cooling_time': (cooling, cooling * np.hypot(rel_n, rel_T), 'yr')}
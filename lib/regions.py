@@ -1,12 +1,84 @@
+import numpy as np
 import pandas as pd
 from lib.converte import UnitConverter
 
+
+class Circle:
+    """
+    Circular region (physical pixels). In a region file, ``-circle(...)``
+    after a shape, or alone in a line for every shape, excludes it (e.g. a
+    point source).
+    """
+
+    def __init__(self, x_center, y_center, radius):
+        self.x_center = x_center
+        self.y_center = y_center
+        self.radius = radius
+
+    def __repr__(self):
+        return f"circle({self.x_center:.4f},{self.y_center:.4f},{self.radius:.4f})"
+
+    def __eq__(self, other):
+        return isinstance(other, Circle) and repr(self) == repr(other)
+
+    def __hash__(self):
+        return hash(repr(self))
+
+    def contains(self, x, y):
+        return (np.asarray(x) - self.x_center)**2 + (np.asarray(y) - self.y_center)**2 < self.radius**2
+
+    def arc_fraction(self, r, x_center, y_center):
+        """
+        Fraction of the circumference of radius ``r`` around (x_center,
+        y_center) that falls inside the circle.
+        """
+        r = np.asarray(r, dtype=float)
+        distance = np.hypot(self.x_center - x_center, self.y_center - y_center)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosine = (r**2 + distance**2 - self.radius**2) / (2 * r * distance)
+        fraction = np.arccos(np.clip(np.nan_to_num(cosine, nan=1.0, posinf=1.0, neginf=-1.0), -1, 1)) / np.pi
+        # circunferência inteira dentro do círculo (centro da abertura dentro dele e r pequeno)
+        return np.where(r + distance < self.radius, 1.0, fraction)
+
+
+def excluded(x, y, circles):
+    """
+    True for the points (physical coordinates) inside any of the circles.
+
+    The points are sorted by x once, so each circle only tests the points
+    of its bounding box.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    inside = np.zeros(x.shape, dtype=bool)
+    if len(circles) == 0 or x.size == 0:
+        return inside
+    order = np.argsort(x.ravel(), kind='stable')
+    x_sorted = x.ravel()[order]
+    flat = inside.ravel()
+    for circle in circles:
+        start, end = np.searchsorted(x_sorted, [circle.x_center - circle.radius, circle.x_center + circle.radius])
+        candidates = order[start:end]
+        flat[candidates[circle.contains(x.ravel()[candidates], y.ravel()[candidates])]] = True
+    return flat.reshape(x.shape)
+
+
+def _parse_exclusions(line):
+    # "-circle(x,y,r)" depois da forma principal da linha
+    exclusions = []
+    for part in line.split('-circle(')[1:]:
+        x_center, y_center, radius = (float(value) for value in part[:part.find(')')].split(','))
+        exclusions.append(Circle(x_center, y_center, radius))
+    return exclusions
+
+
 class Annulus:
-    def __init__(self, x_center, y_center, inner_radius, outer_radius):
+    def __init__(self, x_center, y_center, inner_radius, outer_radius, exclusions=None):
         self.x_center = x_center
         self.y_center = y_center
         self.inner_radius = inner_radius
         self.outer_radius = outer_radius
+        self.exclusions = list(exclusions or [])
 
     def calculate_radius(self):
         # Convertendo de pixel para arcsec e calculando o raio
@@ -17,13 +89,14 @@ class Annulus:
 
 class Pie:
     
-    def __init__(self, x_center, y_center, inner_radius, outer_radius, angle_start, angle_end):
+    def __init__(self, x_center, y_center, inner_radius, outer_radius, angle_start, angle_end, exclusions=None):
         self.x_center = x_center
         self.y_center = y_center
         self.inner_radius = inner_radius
         self.outer_radius = outer_radius
         self.angle_start = angle_start
         self.angle_end = angle_end
+        self.exclusions = list(exclusions or [])
 
     def calculate_radius(self):
         # Convertendo de pixel para arcsec e calculando o raio
@@ -39,6 +112,7 @@ class RegionProcessor:
         self.list_innerradius = []
         self.list_outradius = []
         self.list_erro_region = []
+        self.exclusions = []
 
     def parse_file(self):
         with open(self.file_path, 'r') as file:
@@ -47,11 +121,18 @@ class RegionProcessor:
         for line in lines:
             if line.startswith('annulus'):
                 region_data = self._parse_annulus(line)
-                self.regions.append(Annulus(*region_data))
+                self.regions.append(Annulus(*region_data, exclusions=_parse_exclusions(line)))
                 
             elif line.startswith('pie'):
                 region_data = self._parse_pie(line)
-                self.regions.append(Pie(*region_data))
+                self.regions.append(Pie(*region_data, exclusions=_parse_exclusions(line)))
+
+            elif line.startswith('-circle'):
+                # exclusão em linha própria vale para todas as regiões do arquivo
+                self.exclusions.extend(_parse_exclusions(line))
+
+        for region in self.regions:
+            region.exclusions.extend(circle for circle in self.exclusions if circle not in region.exclusions)
 
     def _parse_annulus(self, line):
         parts = line[line.find('(') + 1 : line.find(')')].split(',')
@@ -113,3 +194,84 @@ class RegionProcessor:
 
 
 
+def _region_line(region, x_center, y_center):
+    # exclusões na mesma linha ("annulus(...)-circle(...)"): o specextract e o dmextract tratam cada linha
+    # como uma região, e o número de linhas continua igual ao de regiões
+    if isinstance(region, Pie):
+        line = (f"pie({x_center:.4f},{y_center:.4f},{region.inner_radius:.4f},{region.outer_radius:.4f},"
+                f"{region.angle_start:.4f},{region.angle_end:.4f})")
+    else:
+        line = f"annulus({x_center:.4f},{y_center:.4f},{region.inner_radius:.4f},{region.outer_radius:.4f})"
+    return line + ''.join(f"-{circle!r}" for circle in region.exclusions) + "\n"
+
+
+def write_annulus_region_file(file_path, x_center, y_center, edges, exclusions=()):
+    """
+    Writes concentric ``annulus(x,y,r_in,r_out)`` regions (physical pixels),
+    one per line, in the format parsed by RegionProcessor, each with the
+    circles of ``exclusions`` that overlap it.
+    """
+    with open(file_path, 'w') as file:
+        for inner_radius, outer_radius in zip(edges[:-1], edges[1:]):
+            region = Annulus(x_center, y_center, inner_radius, outer_radius)
+            region.exclusions = overlapping(region, exclusions)
+            file.write(_region_line(region, x_center, y_center))
+
+
+def recenter_region_file(file_path, x_center, y_center, output_path):
+    """
+    Rewrites the annuli/pies of a region file around a new center, keeping
+    their radii, angles and exclusions.
+    """
+    processor = RegionProcessor(file_path)
+    processor.parse_file()
+    with open(output_path, 'w') as file:
+        for region in processor.regions:
+            file.write(_region_line(region, x_center, y_center))
+
+
+def transform_region_file(file_path, transform, output_path, scale=1.0):
+    """
+    Rewrites the annuli/pies of a region file in another frame: ``transform``
+    maps physical (x, y) arrays to the new frame and is applied to the
+    centers of the regions and of their exclusions; the radii are
+    multiplied by ``scale`` (the ratio of the pixel sizes).
+    """
+    processor = RegionProcessor(file_path)
+    processor.parse_file()
+    with open(output_path, 'w') as file:
+        for region in processor.regions:
+            circles = region.exclusions
+            x, y = transform(np.array([region.x_center] + [circle.x_center for circle in circles]),
+                             np.array([region.y_center] + [circle.y_center for circle in circles]))
+            region.inner_radius, region.outer_radius = region.inner_radius * scale, region.outer_radius * scale
+            region.exclusions = [Circle(float(x_center), float(y_center), circle.radius * scale)
+                                 for x_center, y_center, circle in zip(x[1:], y[1:], circles)]
+            file.write(_region_line(region, float(x[0]), float(y[0])))
+
+
+def overlapping(region, circles):
+    """
+    Circles that intersect the ring of an annulus/pie (the pie angles are
+    not checked: a circle outside them only costs a longer region string).
+    """
+    selected = []
+    for circle in circles:
+        distance = np.hypot(circle.x_center - region.x_center, circle.y_center - region.y_center)
+        if region.inner_radius - circle.radius < distance < region.outer_radius + circle.radius:
+            selected.append(circle)
+    return selected
+
+
+def write_excluded_region_file(file_path, circles, output_path):
+    """
+    Rewrites the annuli/pies of a region file adding, to each one, the
+    circles (e.g. detected point sources) that overlap it.
+    """
+    processor = RegionProcessor(file_path)
+    processor.parse_file()
+    with open(output_path, 'w') as file:
+        for region in processor.regions:
+            region.exclusions = region.exclusions + [circle for circle in overlapping(region, circles)
+                                                     if circle not in region.exclusions]
+            file.write(_region_line(region, region.x_center, region.y_center))
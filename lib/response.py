@@ -0,0 +1,214 @@
+import os
+import hashlib
+
+import numpy as np
+import astropy.io.fits as fits
+from scipy import sparse
+
+from lib.instrumentation import instrument
+
+
+def _unpack(column, lengths):
+    """
+    Concatenates the first ``lengths[i]`` elements of each row of a table
+    column.
+    """
+    array = np.asarray(column)
+    if array.dtype != object:
+        # coluna de tamanho fixo (ou escalar): uma máscara sobre a matriz inteira
+        array = array.reshape(len(lengths), -1)
+        return array[np.arange(array.shape[1]) < lengths[:, None]]
+    # coluna de tamanho variável (formato P/Q): cada linha é um array próprio
+    return np.concatenate([np.atleast_1d(row)[:n] for row, n in zip(column, lengths)])
+
+
+def read_rmf(path):
+    """
+    Reads an OGIP redistribution matrix into a CSR sparse matrix.
+
+    The grouped rows (N_GRP, F_CHAN, N_CHAN, MATRIX) are unpacked with
+    whole-array operations when the columns have a fixed width; variable
+    length columns are unpacked row by row. Only the non-zero elements are
+    stored.
+
+    Returns:
+    --------
+    tuple
+        (energ_lo, energ_hi, matrix, e_min, e_max, first_channel), with
+        ``matrix`` a (n_energy, n_channels) ``scipy.sparse.csr_matrix``.
+    """
+    with fits.open(path) as hdulist:
+        try:
+            hdu = hdulist['MATRIX']
+        except KeyError:
+            hdu = hdulist['SPECRESP MATRIX']
+        ebounds = hdulist['EBOUNDS'].data
+        data = hdu.data
+        column = data.columns.names.index('F_CHAN') + 1
+        first_channel = int(hdu.header.get(f'TLMIN{column}', 1))
+        n_energy, n_channels = len(data), len(ebounds)
+
+        n_grp = np.asarray(data['N_GRP'], dtype=np.intp)
+        f_chan = _unpack(data['F_CHAN'], n_grp).astype(np.intp)
+        n_chan = _unpack(data['N_CHAN'], n_grp).astype(np.intp)
+        # elementos por linha de energia (linhas sem grupos, N_GRP = 0, somam zero); colunas MATRIX de
+        # tamanho fixo vêm completadas com zeros
+        row_length = np.bincount(np.repeat(np.arange(n_energy), n_grp), weights=n_chan,
+                                 minlength=n_energy).astype(np.intp)
+        values = _unpack(data['MATRIX'], row_length)
+
+        group_start = np.concatenate([[0], np.cumsum(n_chan)[:-1]])
+        offset = np.arange(values.size) - np.repeat(group_start, n_chan)
+        columns = np.repeat(f_chan - first_channel, n_chan) + offset
+        rows = np.repeat(np.repeat(np.arange(n_energy), n_grp), n_chan)
+        matrix = sparse.csr_matrix((values.astype(float), (rows, columns)), shape=(n_energy, n_channels))
+        return (np.array(data['ENERG_LO'], dtype=float), np.array(data['ENERG_HI'], dtype=float), matrix,
+                np.array(ebounds['E_MIN'], dtype=float), np.array(ebounds['E_MAX'], dtype=float), first_channel)
+
+
+def read_arf(path):
+    with fits.open(path) as hdulist:
+        return np.array(hdulist['SPECRESP'].data['SPECRESP'], dtype=float)
+
+
+class Response:
+    """
+    Instrument response of one region: the redistribution matrix (RMF) and
+    the effective area (ARF) on the same energy grid.
+
+    The RMF is kept sparse and the ARF is multiplied into it once, so
+    folding is a single sparse-dense product ``R^T @ flux`` for any number
+    of model spectra.
+
+    Attributes:
+    ----------
+    energ_lo, energ_hi : numpy.ndarray
+        Energy bins of the response (keV).
+    matrix : scipy.sparse.csr_matrix
+        (n_energy, n_channels) redistribution probabilities.
+    area : numpy.ndarray
+        Effective area of each energy bin (cm^2); ones without an ARF.
+    e_min, e_max : numpy.ndarray
+        Energy bounds of each channel (keV).
+    first_channel : int
+        Number of the first channel (1 for Chandra ACIS).
+    """
+
+    def __init__(self, energ_lo, energ_hi, matrix, e_min, e_max, area=None, first_channel=1):
+        self.energ_lo = energ_lo
+        self.energ_hi = energ_hi
+        self.matrix = sparse.csr_matrix(matrix)
+        self.e_min = e_min
+        self.e_max = e_max
+        self.area = np.ones(energ_lo.size) if area is None else area
+        if self.area.size != self.energ_lo.size:
+            raise ValueError("The ARF and the RMF must share the same energy grid")
+        self.first_channel = first_channel
+        # (n_channels, n_energy): ARF incluída, pronta para multiplicar espectros em colunas
+        self.folding = sparse.csr_matrix(self.matrix.multiply(self.area[:, np.newaxis]).T)
+
+    @classmethod
+    def from_files(cls, rmf_path, arf_path=None):
+        energ_lo, energ_hi, matrix, e_min, e_max, first_channel = read_rmf(rmf_path)
+        area = read_arf(arf_path) if arf_path is not None and arf_path.lower() != 'none' else None
+        return cls(energ_lo, energ_hi, matrix, e_min, e_max, area, first_channel)
+
+    @property
+    def energy(self):
+        return 0.5 * (self.energ_lo + self.energ_hi)
+
+    @property
+    def n_channels(self):
+        return self.e_min.size
+
+    @instrument('fold_response')
+    def fold(self, flux):
+        """
+        Count rate per channel of photon fluxes per energy bin (photons/cm^2/s);
+        any leading dimensions of ``flux`` are folded in one product.
+        """
+        flux = np.asarray(flux, dtype=float)
+        flat = flux.reshape(-1, flux.shape[-1])
+        return np.asarray(self.folding @ flat.T).T.reshape(flux.shape[:-1] + (self.n_channels,))
+
+    def save(self, path):
+        """
+        Stores the response as ``.npz`` (CSR arrays), much faster to load than the FITS file.
+        """
+        np.savez(path, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                 shape=self.matrix.shape, energ_lo=self.energ_lo, energ_hi=self.energ_hi, e_min=self.e_min,
+                 e_max=self.e_max, area=self.area, first_channel=self.first_channel)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as stored:
+            matrix = sparse.csr_matrix((stored['data'], stored['indices'], stored['indptr']),
+                                       shape=tuple(stored['shape']))
+            return cls(stored['energ_lo'], stored['energ_hi'], matrix, stored['e_min'], stored['e_max'],
+                       stored['area'], int(stored['first_channel']))
+
+
+class ResponseCache:
+    """
+    Cache of responses keyed by the content of the RMF and ARF files.
+
+    specextract writes one RMF/ARF per region, but regions often share
+    identical responses (or the same file): keying by a SHA-1 of the file
+    contents loads and converts each distinct response only once. File
+    hashes are remembered by (size, mtime).
+
+    Parameters:
+    -----------
+    directory : str, optional
+        When given, converted responses are also stored there as ``.npz``
+        and reused by later sessions and other processes.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._responses = {}
+        self._digests = {}
+
+    def digest(self, path):
+        if path is None or str(path).lower() == 'none':
+            return 'none'
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self._digests:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(block)
+            self._digests[key] = digest.hexdigest()
+        return self._digests[key]
+
+    def get(self, rmf_path, arf_path=None):
+        """
+        Response of an RMF/ARF pair, loaded once per distinct content.
+        """
+        key = hashlib.sha1(f'{self.digest(rmf_path)}:{self.digest(arf_path)}'.encode()).hexdigest()
+        if key in self._responses:
+            return self._responses[key]
+        path = os.path.join(self.directory, f'response_{key}.npz') if self.directory else None
+        if path is not None and os.path.exists(path):
+            response = Response.load(path)
+        else:
+            response = Response.from_files(rmf_path, arf_path)
+            if path is not None:
+                os.makedirs(self.directory, exist_ok=True)
+                response.save(path)
+        self._responses[key] = response
+        return response
+
+    def __len__(self):
+        return len(self._responses)
+
+
+default_response_cache = ResponseCache()
+
+
+def load_response(rmf_path, arf_path=None):
+    """
+    Response from the module-level cache.
+    """
+    return default_response_cache.get(rmf_path, arf_path)
@@ -0,0 +1,284 @@
+import numpy as np
+import pandas as pd
+import astropy.io.fits as fits
+
+from lib.converte import UnitConverter
+from lib.regions import RegionProcessor, Pie, excluded
+from lib.fit_results import load_fit_rows
+from lib.classe_densidade import calcula_densidade_array
+from lib.radial_profile import Profile, thermodynamic_quantities
+from lib.instrumentation import instrument
+
+
+class SectorProfiles:
+    """
+    Radial profiles of N azimuthal sectors stored as (sector x radius) arrays.
+
+    The ``pie`` regions of a region file are grouped by their angles
+    (sectors) and radii (bins); ``annulus`` regions form one 360 degree
+    sector. Every quantity is a pair of 2D arrays (values and errors), so
+    densities, derived quantities and sector comparisons are computed for
+    all sectors at once. Bins missing from the region file or whose fit
+    failed are NaN.
+
+    Attributes:
+    ----------
+    angles : numpy.ndarray
+        (n_sectors, 2) start and end angle of each sector (degrees).
+    r_in, r_out : numpy.ndarray
+        Edges of the radial bins, in physical pixels.
+    sector_index, radius_index : numpy.ndarray
+        Sector and radial bin of each region, in file order (the order of
+        the spectral fit results).
+    center : tuple
+        Center of the regions.
+    exclusions : list of Circle
+        Excluded circles (point sources) of the regions.
+    """
+
+    def __init__(self, angles, r_in, r_out, sector_index, radius_index, center, exclusions=()):
+        self.angles = angles
+        self.r_in = r_in
+        self.r_out = r_out
+        self.sector_index = sector_index
+        self.radius_index = radius_index
+        self.center = center
+        self.exclusions = list(exclusions)
+        self.values = {}
+        self.errors = {}
+        self.units = {}
+
+    @property
+    def shape(self):
+        return len(self.angles), len(self.r_in)
+
+    @property
+    def opening(self):
+        """
+        Opening angle of each sector, in degrees.
+        """
+        opening = (self.angles[:, 1] - self.angles[:, 0]) % 360.0
+        return np.where(opening == 0, 360.0, opening)
+
+    @classmethod
+    def from_regions(cls, reg_path):
+        processor = RegionProcessor(reg_path)
+        processor.parse_file()
+        regions = processor.regions
+        if len({(region.x_center, region.y_center) for region in regions}) > 1:
+            raise ValueError("All sector regions must share the same center")
+        sector_keys = [(region.angle_start, region.angle_end) if isinstance(region, Pie) else (0.0, 360.0)
+                       for region in regions]
+        radius_keys = [(region.inner_radius, region.outer_radius) for region in regions]
+        angles, sector_index = np.unique(np.array(sector_keys), axis=0, return_inverse=True)
+        radii, radius_index = np.unique(np.array(radius_keys), axis=0, return_inverse=True)
+        exclusions = list(dict.fromkeys(circle for region in regions for circle in region.exclusions))
+        return cls(angles, radii[:, 0], radii[:, 1], sector_index.ravel(), radius_index.ravel(),
+                   (regions[0].x_center, regions[0].y_center), exclusions)
+
+    def scatter(self, per_region):
+        """
+        Places one value per region (file order) on the (sector x radius) grid.
+        """
+        grid = np.full(self.shape, np.nan)
+        grid[self.sector_index, self.radius_index] = per_region
+        return grid
+
+    def add(self, name, values, errors=None, unit=None):
+        self.values[name] = np.asarray(values, dtype=float)
+        self.errors[name] = np.full(self.shape, np.nan) if errors is None else np.asarray(errors, dtype=float)
+        self.units[name] = unit
+        return self
+
+    def radius_kpc(self, redshift):
+        """
+        Midpoint and half width of the radial bins in kpc.
+        """
+        r_in = UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(self.r_in), redshift)
+        r_out = UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(self.r_out), redshift)
+        return 0.5 * (r_in + r_out), 0.5 * (r_out - r_in)
+
+    @classmethod
+    def from_fit_results(cls, reg_path, pkl_temp_path, pkl_norm_path, redshift, mu):
+        """
+        Temperature, normalization and density of every sector from the
+        spectral fit results of the pie regions (one row per region, file order).
+
+        The density of a sector uses the volume of its part of the spherical
+        shell (``opening / 360``), which is the volume the normalization refers to.
+        """
+        sectors = cls.from_regions(reg_path)
+        temperature = load_fit_rows(pkl_temp_path, 'kT')
+        norm = load_fit_rows(pkl_norm_path, 'norm')
+        sectors.add('temperature', sectors.scatter(temperature[:, 0]),
+                    sectors.scatter(0.5 * (np.abs(temperature[:, 1]) + np.abs(temperature[:, 2]))), unit='keV')
+        sectors.add('norm', sectors.scatter(norm[:, 0]),
+                    sectors.scatter(0.5 * (np.abs(norm[:, 1]) + np.abs(norm[:, 2]))), unit='cm^-5')
+
+        r_in_cm = UnitConverter.kpc_to_cm(UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(sectors.r_in), redshift))
+        r_out_cm = UnitConverter.kpc_to_cm(UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(sectors.r_out), redshift))
+        fraction = sectors.opening[:, np.newaxis] / 360.0
+        N = sectors.values['norm']
+        density = calcula_densidade_array(redshift, mu, N / fraction, r_out_cm[np.newaxis, :], r_in_cm[np.newaxis, :])
+        sectors.add('density', density, 0.5 * density * sectors.errors['norm'] / N, unit='cm^-3')
+        return sectors
+
+    def add_thermodynamics(self, cooling_function):
+        """
+        Pressure, entropy and cooling time of every (sector, radius) bin at once.
+        """
+        quantities = thermodynamic_quantities(self.values['density'], self.errors['density'],
+                                              self.values['temperature'], self.errors['temperature'],
+                                              cooling_function)
+        for name, (values, errors, unit) in quantities.items():
+            self.add(name, values, errors, unit)
+        return self
+
+    def _bins(self, x, y):
+        """
+        Flat (sector, radius) bin of each point (-1 outside every bin).
+        """
+        dx = np.asarray(x, dtype=float) - self.center[0]
+        dy = np.asarray(y, dtype=float) - self.center[1]
+        r = np.hypot(dx, dy)
+        theta = np.degrees(np.arctan2(dy, dx)) % 360.0
+
+        radius_bin = self._bin_of(r, self.r_in, self.r_out)
+        # setores que cruzam 0 grau são deslocados para que todos os intervalos fiquem crescentes
+        start = self.angles[:, 0] % 360.0
+        end = start + self.opening
+        sector_bin = np.full(r.shape, -1, dtype=np.intp)
+        for shift in (0.0, 360.0):
+            candidate = self._bin_of(theta + shift, start, end)
+            sector_bin = np.where(sector_bin < 0, candidate, sector_bin)
+        return np.where((radius_bin >= 0) & (sector_bin >= 0), sector_bin * len(self.r_in) + radius_bin, -1)
+
+    def excluded_area(self, spacing=0.1):
+        """
+        Area (pixel^2) of the excluded circles inside each (sector, radius)
+        bin, from a grid of points of step ``spacing`` over every circle.
+        """
+        n_sectors, n_radii = self.shape
+        area = np.zeros(n_sectors * n_radii)
+        for circle in self.exclusions:
+            offsets = np.arange(-circle.radius + 0.5 * spacing, circle.radius, spacing)
+            x = circle.x_center + offsets[np.newaxis, :]
+            y = circle.y_center + offsets[:, np.newaxis]
+            inside = circle.contains(x, y)
+            x, y = np.broadcast_arrays(x, y)
+            bins = self._bins(x[inside], y[inside])
+            area += spacing**2 * np.bincount(bins[bins >= 0], minlength=area.size)
+        return area.reshape(n_sectors, n_radii)
+
+    @instrument('sector_counts')
+    def count_events(self, evt_path, energy_range=None, bkg_density=0.0):
+        """
+        Counts and surface brightness of every (sector, radius) bin from one
+        pass over the events: each event gets its radial bin and sector with
+        ``np.searchsorted`` and all bins are filled with one ``np.bincount``.
+        Events inside the excluded circles are dropped and their area is
+        removed from the bins.
+
+        Parameters:
+        -----------
+        energy_range : tuple, optional
+            (min, max) energy in eV.
+        bkg_density : float
+            Uniform background (counts per pixel^2) subtracted from the counts.
+        """
+        with fits.open(evt_path, memmap=True) as hdulist:
+            events = hdulist['EVENTS'].data
+            keep = slice(None)
+            if energy_range is not None:
+                keep = (events['energy'] >= energy_range[0]) & (events['energy'] < energy_range[1])
+            x = np.asarray(events['x'][keep], dtype=float)
+            y = np.asarray(events['y'][keep], dtype=float)
+
+        n_sectors, n_radii = self.shape
+        bins = self._bins(x, y)
+        if self.exclusions:
+            bins[excluded(x, y, self.exclusions)] = -1
+        counts = np.bincount(bins[bins >= 0], minlength=n_sectors * n_radii).reshape(n_sectors, n_radii).astype(float)
+        area = np.pi * (self.r_out**2 - self.r_in**2)[np.newaxis, :] * self.opening[:, np.newaxis] / 360.0
+        if self.exclusions:
+            area = area - self.excluded_area()
+        net = counts - bkg_density * area
+        defined = np.isfinite(self.scatter(0.0))
+        self.add('counts', np.where(defined, counts, np.nan), np.where(defined, np.sqrt(counts), np.nan), unit='counts')
+        self.add('sur_bri', np.where(defined, net / area, np.nan), np.where(defined, np.sqrt(counts) / area, np.nan),
+                 unit='counts/pixel^2')
+        return self
+
+    @staticmethod
+    def _bin_of(values, lower, upper):
+        """
+        Index of the [lower, upper) interval holding each value (-1 if none);
+        the intervals must be sorted and not overlap.
+        """
+        order = np.argsort(lower)
+        index = np.searchsorted(lower[order], values, side='right') - 1
+        inside = (index >= 0)
+        index = np.where(inside, order[np.clip(index, 0, None)], -1)
+        inside &= values < upper[np.clip(index, 0, None)]
+        return np.where(inside, index, -1)
+
+    def azimuthal_mean(self, name):
+        """
+        Error-weighted mean over the sectors at each radius (and its error).
+        """
+        values, errors = self.values[name], self.errors[name]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.where(np.isfinite(values) & (errors > 0), 1.0 / errors**2, 0.0)
+            total = weights.sum(axis=0)
+            mean = np.nansum(weights * np.nan_to_num(values), axis=0) / total
+            return mean, 1.0 / np.sqrt(total)
+
+    def deviation(self, name):
+        """
+        Relative deviation of every sector from the azimuthal mean and its
+        significance (in sigma), e.g. to spot cold fronts or sloshing spirals.
+        """
+        mean, mean_error = self.azimuthal_mean(name)
+        values, errors = self.values[name], self.errors[name]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = values / mean - 1.0
+            significance = (values - mean) / np.hypot(errors, mean_error)
+        return relative, significance
+
+    def contrast(self, name, sector_a, sector_b):
+        """
+        Ratio of a quantity between two sectors at each radius, with its error.
+        """
+        a, b = self.values[name][sector_a], self.values[name][sector_b]
+        error_a, error_b = self.errors[name][sector_a], self.errors[name][sector_b]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = a / b
+            return ratio, ratio * np.hypot(error_a / a, error_b / b)
+
+    def profile(self, sector, redshift=None):
+        """
+        One sector as a Profile (radii in kpc when ``redshift`` is given,
+        pixels otherwise), with the bins missing from that sector masked.
+        """
+        if redshift is None:
+            profile = Profile(self.r_in, self.r_out, radius_unit='pixel')
+        else:
+            to_kpc = lambda r: UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(r), redshift)
+            profile = Profile(to_kpc(self.r_in), to_kpc(self.r_out))
+        for name in self.values:
+            profile.add_column(name, self.values[name][sector], self.errors[name][sector], unit=self.units[name])
+        return profile.mask_invalid(*[name for name in ('temperature', 'norm') if name in self.values])
+
+    def to_dataframe(self):
+        """
+        Long table with one row per (sector, radius) bin.
+        """
+        n_sectors, n_radii = self.shape
+        sector, radius = np.meshgrid(np.arange(n_sectors), np.arange(n_radii), indexing='ij')
+        columns = {'sector': sector.ravel(), 'angle_start': self.angles[sector.ravel(), 0],
+                   'angle_end': self.angles[sector.ravel(), 1], 'r_in': self.r_in[radius.ravel()],
+                   'r_out': self.r_out[radius.ravel()]}
+        for name in self.values:
+            columns[name] = self.values[name].ravel()
+            columns[f'{name}_err'] = self.errors[name].ravel()
+        return pd.DataFrame(columns)
@@ -0,0 +1,332 @@
+import numpy as np
+import pandas as pd
+from astropy.cosmology import Planck15
+
+from lib.converte import UnitConverter
+from lib.fit_results import load_fit_rows
+from lib.radial_profile import Profile, thermodynamic_quantities
+from lib.classe_densidade import calcula_densidade_array
+from lib.temperaturas import CurveFitter
+from lib.symbolic_mass import SymbolicMassModel
+from lib.instrumentation import instrument
+
+
+# entradas contínuas que podem ser varridas (e têm elasticidade definida)
+SWEEP_INPUTS = ('mu', 'mu_mass', 'cooling_function', 'H0', 'Om0')
+OUTPUTS = ('density', 'pressure', 'entropy', 'cooling_time', 'mass')
+
+
+class SensitivitySweep:
+    """
+    Density, pressure, entropy and cooling time of every annulus and the
+    hydrostatic mass profile over a Cartesian grid of the scalar inputs of
+    the analysis, evaluated with broadcasting (grid points x radius).
+
+    The continuous inputs are those of ``SWEEP_INPUTS``: the mean molecular
+    weight of the density (``mu``, 1.2 in ``variables.py``) and of the mass
+    (``mu_mass``, 0.6 in ``mass_calc.py``), the cooling function and the
+    cosmology (``H0``, ``Om0``, varied around Planck15). A change of
+    cosmology rescales every physical radius by the ratio of angular
+    diameter distances, so the T(r) and beta model fits are rescaled rather
+    than refitted. Inputs that need new spectral fits (nH, abundance) enter
+    as the categorical axis ``spectral_fit``, one value per fit added with
+    ``add_spectral_fit``.
+
+    Parameters:
+    -----------
+    r_in, r_out : numpy.ndarray
+        Annulus radii (kpc) in the baseline cosmology.
+    temperature, temperature_err, norm : numpy.ndarray
+        Baseline spectral fit of every annulus (keV, cm^-5).
+    redshift : float
+        Cluster redshift.
+    rc, beta : float
+        Beta model core radius (kpc, baseline cosmology) and slope.
+    temperature_params : array-like, optional
+        (a, b, c, d) of ``CurveFitter``; fitted to ``temperature`` if None.
+    mu, mu_mass, cooling_function : float
+        Baseline inputs.
+    cosmology : astropy.cosmology.FLRW
+        Baseline cosmology, whose H0 and Om0 are swept.
+    R_values : numpy.ndarray, optional
+        Radii (kpc) of the mass profile; ``np.logspace(1, 3, 100)`` by default.
+    """
+
+    def __init__(self, r_in, r_out, temperature, temperature_err, norm, redshift, rc, beta, temperature_params=None,
+                 mu=1.2, mu_mass=0.6, cooling_function=3e-23, cosmology=Planck15, R_values=None):
+        self.r_in = np.asarray(r_in, dtype=float)
+        self.r_out = np.asarray(r_out, dtype=float)
+        self.temperature_err = np.asarray(temperature_err, dtype=float)
+        self.redshift = redshift
+        self.rc = rc
+        self.beta = beta
+        self.cosmology = cosmology
+        self.baseline = {'mu': mu, 'mu_mass': mu_mass, 'cooling_function': cooling_function,
+                         'H0': cosmology.H0.value, 'Om0': cosmology.Om0, 'spectral_fit': 0}
+        self.R_values = np.logspace(1, 3, 100) if R_values is None else np.asarray(R_values, dtype=float)
+        self.model = SymbolicMassModel.from_names('exponential', 'beta')
+        self._distance_base = cosmology.angular_diameter_distance(redshift).value
+        self._regions = None
+        self._distances = {}
+        self.spectral_fits = []
+        self._temperature = np.empty((0, self.r_in.size))
+        self._norm = np.empty((0, self.r_in.size))
+        self._temperature_params = np.empty((0, 4))
+        self.add_spectral_fit('baseline', temperature, norm, temperature_params)
+
+    @classmethod
+    def from_fit_results(cls, reg_path, pkl_temp_path, pkl_norm_path, redshift, rc, beta, exclude_bins=(), **kwargs):
+        """
+        Sweep of the spectral fit results (FIT_RESULTS table or legacy
+        pickles) of the annuli of a region file. Bins in ``exclude_bins``
+        and failed fits are dropped.
+        """
+        profile = cls._load_profile(reg_path, pkl_temp_path, pkl_norm_path, redshift, exclude_bins)
+        sweep = cls(profile.r_in, profile.r_out, profile.value('temperature'), profile.error('temperature'),
+                    profile.value('norm'), redshift, rc, beta, **kwargs)
+        sweep._regions = (reg_path, redshift, tuple(exclude_bins))
+        return sweep
+
+    @staticmethod
+    def _load_profile(reg_path, pkl_temp_path, pkl_norm_path, redshift, exclude_bins=()):
+        profile = Profile.from_regions(reg_path, redshift)
+        temperature = load_fit_rows(pkl_temp_path, 'kT')
+        norm = load_fit_rows(pkl_norm_path, 'norm')
+        profile.add_column('temperature', temperature[:, 0],
+                           0.5 * (np.abs(temperature[:, 1]) + np.abs(temperature[:, 2])), unit='keV')
+        profile.add_column('norm', norm[:, 0], unit='cm^-5')
+        profile.exclude(list(exclude_bins))
+        return profile.mask_invalid('temperature', 'norm').compress()
+
+    def add_spectral_fit(self, label, temperature, norm, temperature_params=None):
+        """
+        Adds a value of the ``spectral_fit`` axis: the temperatures and
+        normalizations of the same annuli fitted with other inputs (e.g.
+        ``'nH=0.03'``). The T(r) model is refitted from the baseline one.
+        """
+        temperature = np.asarray(temperature, dtype=float)
+        if temperature_params is None:
+            guess = self._temperature_params[0] if len(self.spectral_fits) else None
+            temperature_params, _ = CurveFitter(0.5 * (self.r_in + self.r_out), temperature, None,
+                                                self.temperature_err).fit_curve(guess)
+        self.spectral_fits.append(label)
+        self._temperature = np.vstack([self._temperature, temperature])
+        self._norm = np.vstack([self._norm, np.asarray(norm, dtype=float)])
+        self._temperature_params = np.vstack([self._temperature_params, temperature_params])
+        return self
+
+    def add_spectral_fit_results(self, label, pkl_temp_path, pkl_norm_path):
+        """
+        ``add_spectral_fit`` from result files of a sweep built with ``from_fit_results``.
+        """
+        profile = self._load_profile(self._regions[0], pkl_temp_path, pkl_norm_path, self._regions[1], self._regions[2])
+        if len(profile) != self.r_in.size:
+            raise ValueError(f"Spectral fit {label} has {len(profile)} valid annuli, expected {self.r_in.size}")
+        return self.add_spectral_fit(label, profile.value('temperature'), profile.value('norm'))
+
+    def _angular_distance(self, H0, Om0):
+        # uma distância por cosmologia distinta da grade (poucas), calculada uma vez e guardada
+        pairs, inverse = np.unique(np.column_stack([H0, Om0]), axis=0, return_inverse=True)
+        for h, om in pairs:
+            if (h, om) not in self._distances:
+                self._distances[(h, om)] = self.cosmology.clone(H0=h, Om0=om).angular_diameter_distance(self.redshift).value
+        return np.array([self._distances[(h, om)] for h, om in pairs])[inverse.ravel()]
+
+    def evaluate(self, mu, mu_mass, cooling_function, H0, Om0, spectral_fit):
+        """
+        All outputs for k grid points given as (k,) arrays of every input
+        (``spectral_fit`` as indices).
+
+        Returns:
+        --------
+        dict
+            (k, n_annuli) density, pressure, entropy and cooling time and
+            (k, n_R) mass (M_sun).
+        """
+        column = lambda value: np.asarray(value, dtype=float)[:, np.newaxis]
+        spectral_fit = np.asarray(spectral_fit, dtype=int)
+        distance = self._angular_distance(np.asarray(H0, dtype=float), np.asarray(Om0, dtype=float))
+        scale = column(distance / self._distance_base)
+        r_in_cm = UnitConverter.kpc_to_cm(self.r_in) * scale
+        r_out_cm = UnitConverter.kpc_to_cm(self.r_out) * scale
+        density = calcula_densidade_array(self.redshift, column(mu), self._norm[spectral_fit], r_out_cm, r_in_cm,
+                                          DA=UnitConverter.mpc_to_cm(column(distance)))
+        temperature = self._temperature[spectral_fit]
+        zeros = np.zeros_like(density)
+        quantities = thermodynamic_quantities(density, zeros, temperature, zeros, column(cooling_function))
+        outputs = {'density': density}
+        outputs.update({name: values for name, (values, _, _) in quantities.items()})
+        # raios físicos escalam com D_A: T(R) e rc são reescalados em vez de reajustados. M ~ 1/mu_mass, então
+        # o perfil é calculado uma vez por par (cosmologia, ajuste espectral) distinto
+        pairs, inverse = np.unique(np.column_stack([distance, spectral_fit]), axis=0, return_inverse=True)
+        pair_scale = column(pairs[:, 0] / self._distance_base)
+        a, b, c, d = (self._temperature_params[pairs[:, 1].astype(int), [i]][:, np.newaxis] for i in range(4))
+        mass = self.model.mass_profile(self.R_values, mu=1.0, a=a, b=b, c=c / pair_scale, d=d / pair_scale,
+                                       n0=1.0, rc=self.rc * pair_scale, beta=self.beta)
+        outputs['mass'] = mass[inverse.ravel()] / column(mu_mass)
+        return outputs
+
+    def elasticities(self, step=0.01):
+        """
+        d ln(output) / d ln(input) at the baseline for every continuous
+        input, by central differences (all in one evaluation).
+
+        Returns:
+        --------
+        dict
+            ``{output: {input: (n,) array}}``.
+        """
+        points = {name: np.full(2 * len(SWEEP_INPUTS), value) for name, value in self.baseline.items()}
+        for i, name in enumerate(SWEEP_INPUTS):
+            points[name][2 * i:2 * i + 2] = self.baseline[name] * np.array([1 + step, 1 - step])
+        outputs = self.evaluate(**points)
+        result = {}
+        for output, values in outputs.items():
+            with np.errstate(divide='ignore', invalid='ignore'):
+                log_values = np.log(np.abs(values))
+                result[output] = {name: (log_values[2 * i] - log_values[2 * i + 1]) / np.log((1 + step) / (1 - step))
+                                  for i, name in enumerate(SWEEP_INPUTS)}
+        return result
+
+    @instrument('sensitivity_sweep')
+    def run(self, axes, chunk_size=50000, keep_grid=False):
+        """
+        Evaluates every output over the Cartesian grid of ``axes`` in chunks
+        of ``chunk_size`` grid points, keeping only running reductions (sum,
+        sum of squares, minimum, maximum and the sums per value of each
+        axis), so memory does not grow with the grid.
+
+        Parameters:
+        -----------
+        axes : dict
+            ``{input: values}`` for inputs of ``SWEEP_INPUTS`` and/or
+            ``'spectral_fit'`` (labels or indices of the added fits);
+            the other inputs stay at the baseline.
+        keep_grid : bool
+            Also return the full outputs with shape grid + (n,).
+
+        Returns:
+        --------
+        SweepResult
+        """
+        unknown = set(axes) - set(SWEEP_INPUTS) - {'spectral_fit'}
+        if unknown:
+            raise ValueError(f"Unknown sweep inputs: {sorted(unknown)}")
+        names = list(axes)
+        values = []
+        for name in names:
+            if name == 'spectral_fit':
+                values.append(np.array([self.spectral_fits.index(v) if isinstance(v, str) else int(v) for v in axes[name]]))
+            else:
+                values.append(np.asarray(axes[name], dtype=float))
+        shape = tuple(len(v) for v in values)
+        n_points = int(np.prod(shape))
+
+        baseline = self.evaluate(**{name: np.array([value]) for name, value in self.baseline.items()})
+        sizes = {output: array.shape[-1] for output, array in baseline.items()}
+        total = {output: np.zeros(size) for output, size in sizes.items()}
+        squares = {output: np.zeros(size) for output, size in sizes.items()}
+        minimum = {output: np.full(size, np.inf) for output, size in sizes.items()}
+        maximum = {output: np.full(size, -np.inf) for output, size in sizes.items()}
+        per_value = {output: [np.zeros((len(v), size)) for v in values] for output, size in sizes.items()}
+        grid = {output: np.empty((n_points, size)) for output, size in sizes.items()} if keep_grid else None
+
+        for start in range(0, n_points, chunk_size):
+            flat = np.arange(start, min(start + chunk_size, n_points))
+            index = np.unravel_index(flat, shape)
+            points = {name: np.full(flat.size, value) for name, value in self.baseline.items()}
+            for name, axis_values, axis_index in zip(names, values, index):
+                points[name] = axis_values[axis_index]
+            outputs = self.evaluate(**points)
+            for output, array in outputs.items():
+                total[output] += array.sum(axis=0)
+                squares[output] += (array**2).sum(axis=0)
+                minimum[output] = np.minimum(minimum[output], array.min(axis=0))
+                maximum[output] = np.maximum(maximum[output], array.max(axis=0))
+                columns = np.arange(array.shape[1])
+                for k, axis_index in enumerate(index):
+                    # soma por (valor do eixo, raio) em um único bincount
+                    bins = (axis_index[:, np.newaxis] * array.shape[1] + columns).ravel()
+                    per_value[output][k] += np.bincount(bins, array.ravel(),
+                                                        minlength=shape[k] * array.shape[1]).reshape(shape[k], -1)
+                if keep_grid:
+                    grid[output][flat] = array
+
+        if keep_grid:
+            grid = {output: array.reshape(shape + (array.shape[-1],)) for output, array in grid.items()}
+        return SweepResult(names, values, n_points, {output: array[0] for output, array in baseline.items()},
+                           total, squares, minimum, maximum, per_value, self.elasticities(), grid)
+
+
+class SweepResult:
+    """
+    Reductions of a ``SensitivitySweep`` over its grid.
+
+    Attributes:
+    ----------
+    axes : dict
+        Swept values of every input.
+    baseline, mean, std, minimum, maximum : dict
+        ``{output: (n,) array}`` over the grid.
+    axis_means : dict
+        ``{output: {input: (n_values, n) array}}`` mean of the output at
+        each value of each input (averaged over the other inputs).
+    main_effect : dict
+        ``{output: {input: (n,) array}}`` fraction of the grid variance
+        explained by each input alone (first-order Sobol index of a full
+        factorial design).
+    elasticity : dict
+        ``{output: {input: (n,) array}}`` d ln(output) / d ln(input) at the baseline.
+    grid : dict or None
+        Full outputs (grid shape + (n,)) when ``keep_grid`` was set.
+    """
+
+    def __init__(self, names, values, n_points, baseline, total, squares, minimum, maximum, per_value,
+                 elasticity, grid=None):
+        self.axes = dict(zip(names, values))
+        self.baseline = baseline
+        self.mean = {output: total[output] / n_points for output in total}
+        with np.errstate(invalid='ignore'):
+            variance = {output: np.clip(squares[output] / n_points - self.mean[output]**2, 0, None) for output in total}
+        self.std = {output: np.sqrt(variance[output]) for output in total}
+        self.minimum = minimum
+        self.maximum = maximum
+        self.axis_means = {output: {name: per_value[output][k] / (n_points / len(values[k]))
+                                    for k, name in enumerate(names)} for output in total}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # saída constante na grade: nenhuma variância a explicar
+            self.main_effect = {output: {name: np.where(variance[output] > 0, np.var(means, axis=0) / variance[output], 0.0)
+                                         for name, means in self.axis_means[output].items()} for output in total}
+        self.elasticity = elasticity
+        self.grid = grid
+
+    def profile(self, output):
+        """
+        Baseline, minimum, maximum, mean and standard deviation of ``output``
+        at each radius (annulus or mass radius).
+        """
+        return pd.DataFrame({'baseline': self.baseline[output], 'minimum': self.minimum[output],
+                             'maximum': self.maximum[output], 'mean': self.mean[output], 'std': self.std[output]})
+
+    def sensitivity_table(self):
+        """
+        One row per (output, input): the median over radius of the
+        elasticity, of the main-effect variance fraction and of the
+        relative swing of the axis means, (max - min) / |baseline|.
+        """
+        rows = []
+        for output in self.baseline:
+            inputs = list(dict.fromkeys(list(self.axes) + list(SWEEP_INPUTS)))
+            for name in inputs:
+                row = {'output': output, 'input': name, 'swept': name in self.axes,
+                       'elasticity': np.nan, 'main_effect': np.nan, 'relative_swing': np.nan}
+                if name in self.elasticity[output]:
+                    row['elasticity'] = float(np.nanmedian(self.elasticity[output][name]))
+                if name in self.axes:
+                    means = self.axis_means[output][name]
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        swing = (means.max(axis=0) - means.min(axis=0)) / np.abs(self.baseline[output])
+                        row['main_effect'] = float(np.nanmedian(self.main_effect[output][name]))
+                    row['relative_swing'] = float(np.nanmedian(swing))
+                rows.append(row)
+        return pd.DataFrame(rows)
@@ -0,0 +1,347 @@
+import numpy as np
+import pandas as pd
+import scipy.fft
+import scipy.special
+import scipy.stats
+import astropy.io.fits as fits
+
+from lib.regions import Circle, RegionProcessor
+from lib.image_profile import load_image, physical_transform, physical_grid, exclusion_mask
+from lib.instrumentation import instrument, stage
+
+
+class DetectedSources:
+    """
+    Point sources found by ``SourceDetector``, in physical coordinates.
+
+    Attributes:
+    -----------
+    x, y : numpy.ndarray
+        Position of the peak pixel.
+    radius : numpy.ndarray
+        Exclusion radius (physical pixels).
+    net_counts : numpy.ndarray
+        Background-subtracted counts in a box of half-width two scales.
+    significance : numpy.ndarray
+        Wavelet significance (Gaussian sigmas) at the best scale.
+    scale : numpy.ndarray
+        Best wavelet scale (image pixels).
+    """
+
+    COLUMNS = ('x', 'y', 'radius', 'net_counts', 'significance', 'scale')
+
+    def __init__(self, x, y, radius, net_counts=None, significance=None, scale=None):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.radius = np.asarray(radius, dtype=float)
+        missing = np.full(self.x.shape, np.nan)
+        self.net_counts = missing if net_counts is None else np.asarray(net_counts, dtype=float)
+        self.significance = missing if significance is None else np.asarray(significance, dtype=float)
+        self.scale = missing if scale is None else np.asarray(scale, dtype=float)
+
+    def __len__(self):
+        return self.x.size
+
+    def select(self, keep):
+        return DetectedSources(*(getattr(self, column)[keep] for column in self.COLUMNS))
+
+    def outside(self, x_center, y_center, radius):
+        """
+        Sources farther than ``radius`` from (x_center, y_center), e.g.
+        without the cluster core, which the larger scales can take for a
+        source.
+        """
+        return self.select(np.hypot(self.x - x_center, self.y - y_center) >= radius)
+
+    def outside_core(self, reg_path):
+        """
+        Sources outside the innermost annulus/pie of a region file: the
+        detections inside it are the cluster core, not point sources, and
+        must not be excluded from the annuli.
+        """
+        processor = RegionProcessor(reg_path)
+        processor.parse_file()
+        core = processor.regions[0]
+        return self.outside(core.x_center, core.y_center, core.outer_radius)
+
+    def circles(self):
+        return [Circle(x, y, radius) for x, y, radius in zip(self.x, self.y, self.radius)]
+
+    def to_dataframe(self):
+        return pd.DataFrame({column: getattr(self, column) for column in self.COLUMNS})
+
+    def write(self, path):
+        """
+        Writes one ``circle(x,y,r)`` per source (ds9/CIAO physical
+        coordinates), with the counts and significance as comments.
+        """
+        with open(path, 'w') as file:
+            for i, circle in enumerate(self.circles()):
+                file.write(f"{circle!r} # net_counts={self.net_counts[i]:.1f} "
+                           f"significance={self.significance[i]:.1f} scale={self.scale[i]:g}\n")
+
+    @classmethod
+    def read(cls, path):
+        circles = []
+        with open(path, 'r') as file:
+            for line in file:
+                line = line.strip().lstrip('-')
+                if line.startswith('circle('):
+                    circles.append([float(value) for value in line[line.find('(') + 1:line.find(')')].split(',')])
+        circles = np.array(circles, dtype=float).reshape(-1, 3)
+        return cls(circles[:, 0], circles[:, 1], circles[:, 2])
+
+
+def _box_sums(integral, rows, columns, half_width):
+    # somas em caixas (2 h + 1)^2 centradas nos pixels, pela imagem integral (com uma linha/coluna de zeros)
+    ny, nx = integral.shape[0] - 1, integral.shape[1] - 1
+    top = np.clip(rows - half_width, 0, ny)
+    bottom = np.clip(rows + half_width + 1, 0, ny)
+    left = np.clip(columns - half_width, 0, nx)
+    right = np.clip(columns + half_width + 1, 0, nx)
+    return integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+
+
+def _integral_image(image):
+    integral = np.zeros((image.shape[0] + 1, image.shape[1] + 1))
+    np.cumsum(np.cumsum(image, axis=0), axis=1, out=integral[1:, 1:])
+    return integral
+
+
+class SourceDetector:
+    """
+    Multi-scale Mexican-hat wavelet detection of point sources (the
+    ``wavdetect`` approach) on a counts image.
+
+    The count rate image, the exposed-pixel mask and the inverse exposure
+    are transformed once; every scale is then a product with the analytic
+    spectrum of the wavelet (or of a Gaussian) and one inverse real FFT, so
+    all scales cost little more than one convolution each. The wavelet has
+    zero sum, so the smooth cluster emission does not contribute to the
+    coefficients; their significance is measured against the local
+    background (a wide Gaussian smoothing of the rate with the sources
+    found so far masked), re-estimated after each pass.
+
+    Parameters:
+    -----------
+    counts : numpy.ndarray
+        Counts image.
+    transform : tuple
+        ``physical_transform`` of the image header.
+    exposure : numpy.ndarray, optional
+        Exposure map on the same grid; pixels without exposure are ignored.
+    scales : tuple of float
+        Wavelet scales (image pixels): about the PSF width on axis up to
+        several times it off axis.
+    threshold : float
+        Detection threshold (Gaussian sigmas).
+    background_scale : float
+        Width (image pixels) of the Gaussian that smooths the background.
+    min_counts : float
+        Minimum net counts of a source.
+    min_coverage : float
+        Minimum exposed fraction of the wavelet footprint (rejects the
+        false sources at the image and chip edges).
+    workers : int
+        Threads of ``scipy.fft`` (-1 uses every core).
+    """
+
+    def __init__(self, counts, transform, exposure=None, scales=(1.0, 2.0, 4.0, 8.0), threshold=5.0,
+                 background_scale=16.0, min_counts=5.0, min_coverage=0.9, workers=-1):
+        self.counts = np.asarray(counts, dtype=np.float32)
+        self.transform = transform
+        self.scales = tuple(float(scale) for scale in scales)
+        self.threshold = threshold
+        self.background_scale = background_scale
+        self.min_counts = min_counts
+        self.min_coverage = min_coverage
+        self.workers = workers
+        if exposure is None:
+            self.exposure = np.ones(self.counts.shape, dtype=np.float32)
+        else:
+            exposure = np.asarray(exposure, dtype=np.float32)
+            self.exposure = exposure / np.median(exposure[exposure > 0])
+        self.valid = self.exposure > 0
+        self.rate = np.where(self.valid, self.counts / np.where(self.valid, self.exposure, 1), 0).astype(np.float32)
+
+        # margem de zeros maior que o alcance dos filtros: a convolução circular não dá a volta na imagem
+        ny, nx = self.counts.shape
+        margin = int(np.ceil(4 * max(max(self.scales), self.background_scale)))
+        self._fft_shape = (scipy.fft.next_fast_len(ny + margin, real=True),
+                           scipy.fft.next_fast_len(nx + margin, real=True))
+        fy = scipy.fft.fftfreq(self._fft_shape[0]).astype(np.float32)
+        fx = scipy.fft.rfftfreq(self._fft_shape[1]).astype(np.float32)
+        self._k2 = fy[:, np.newaxis]**2 + fx[np.newaxis, :]**2
+        self._rate_spectrum = self._forward(self.rate)
+        self._valid_spectrum = self._forward(self.valid.astype(np.float32))
+        self._inverse_exposure_spectrum = None
+        if exposure is not None:
+            self._inverse_exposure_spectrum = self._forward(np.where(self.valid, 1 / np.where(self.valid, self.exposure, 1),
+                                                                     0).astype(np.float32))
+        self._normalized = None
+        self.background_rate = None
+
+    @classmethod
+    def from_images(cls, counts_path, expmap_path=None, **kwargs):
+        counts, header = load_image(counts_path)
+        exposure = load_image(expmap_path)[0] if expmap_path else None
+        return cls(counts, physical_transform(header), exposure, **kwargs)
+
+    @classmethod
+    def from_events(cls, evt_path, center, half_size, energy_range=None, **kwargs):
+        """
+        Bins the events (sky x/y, optionally within an energy range in eV)
+        of a square of side ``2 * half_size`` physical pixels around
+        ``center`` into a counts image with the CIAO ``sky=1`` grid.
+        """
+        size = int(np.ceil(2 * half_size))
+        # pixel i (base 0) cobre as coordenadas físicas [x0 + i, x0 + i + 1)
+        x0, y0 = np.floor(center[0] - half_size) + 0.5, np.floor(center[1] - half_size) + 0.5
+        with fits.open(evt_path, memmap=True) as hdulist:
+            events = hdulist['EVENTS'].data
+            keep = slice(None)
+            if energy_range is not None:
+                keep = (events['energy'] >= energy_range[0]) & (events['energy'] < energy_range[1])
+            column = np.floor(np.asarray(events['x'][keep], dtype=float) - x0).astype(np.intp)
+            row = np.floor(np.asarray(events['y'][keep], dtype=float) - y0).astype(np.intp)
+        inside = (column >= 0) & (column < size) & (row >= 0) & (row < size)
+        counts = np.bincount(row[inside] * size + column[inside], minlength=size * size).reshape(size, size)
+        # centro do pixel i em x0 + i + 0.5 = (i + 1 - LTV1), logo LTV1 = 0.5 - x0
+        return cls(counts, (1.0, 0.5 - x0, 1.0, 0.5 - y0), **kwargs)
+
+    def _forward(self, image):
+        return scipy.fft.rfft2(image, s=self._fft_shape, workers=self.workers)
+
+    def _inverse(self, spectrum):
+        ny, nx = self.counts.shape
+        return scipy.fft.irfft2(spectrum, s=self._fft_shape, workers=self.workers)[:ny, :nx]
+
+    def _gaussian(self, scale):
+        # espectro da gaussiana de soma 1 e largura ``scale``
+        return np.exp(np.float32(-2 * np.pi**2 * scale**2) * self._k2)
+
+    def _wavelet(self, scale):
+        # chapéu mexicano (2 - r^2/s^2) exp(-r^2/2s^2) = -s^2 laplaciano da gaussiana não normalizada:
+        # espectro 4 pi^2 s^2 k^2 * 2 pi s^2 exp(-2 pi^2 s^2 k^2), nulo em k = 0
+        return np.float32(8 * np.pi**3 * scale**4) * self._k2 * self._gaussian(scale)
+
+    @instrument('wavelet_coefficients')
+    def _normalized_coefficients(self):
+        """
+        Wavelet coefficient of the rate over its noise for a unit
+        background rate, per scale; zero where the footprint is not exposed.
+        """
+        if self._normalized is None:
+            self._normalized = []
+            for scale in self.scales:
+                coefficient = self._inverse(self._rate_spectrum * self._wavelet(scale))
+                coverage = self._inverse(self._valid_spectrum * self._gaussian(2 * scale))
+                # variância: b * sum W^2 <1/e> na área do filtro, com sum W^2 = 2 pi s^2
+                variance = np.float32(2 * np.pi * scale**2)
+                if self._inverse_exposure_spectrum is not None:
+                    variance = variance * self._inverse(self._inverse_exposure_spectrum * self._gaussian(scale)) / \
+                        np.maximum(self._inverse(self._valid_spectrum * self._gaussian(scale)), 1e-6)
+                normalized = coefficient / np.sqrt(np.maximum(variance, 1e-12))
+                normalized[(coverage < self.min_coverage) | ~self.valid] = 0
+                self._normalized.append(normalized.astype(np.float32))
+        return self._normalized
+
+    def _background(self, mask):
+        """
+        Local background rate: Gaussian smoothing of the rate over the
+        unmasked pixels, at least about one count per smoothing area.
+        """
+        smoothing = self._gaussian(self.background_scale)
+        if mask is self.valid:
+            rate_spectrum, mask_spectrum = self._rate_spectrum, self._valid_spectrum
+        else:
+            rate_spectrum = self._forward(np.where(mask, self.rate, 0).astype(np.float32))
+            mask_spectrum = self._forward(mask.astype(np.float32))
+        weight = self._inverse(mask_spectrum * smoothing)
+        background = self._inverse(rate_spectrum * smoothing) / np.maximum(weight, 1e-6)
+        floor = 1 / (2 * np.pi * self.background_scale**2)
+        return np.maximum(np.where(weight > 1e-3, background, floor), floor).astype(np.float32)
+
+    def _candidates(self, background):
+        # máximos locais (vizinhança 3x3) acima do limiar em cada escala
+        ny, nx = self.counts.shape
+        inverse_sigma = 1 / np.sqrt(background)
+        rows, columns, significance, scales = [], [], [], []
+        for scale, normalized in zip(self.scales, self._normalized_coefficients()):
+            significance_map = normalized * inverse_sigma
+            index = np.flatnonzero(significance_map > self.threshold)
+            row, column = np.divmod(index, nx)
+            value = significance_map.ravel()[index]
+            peak = np.ones(index.size, dtype=bool)
+            for dr in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    if dr or dc:
+                        peak &= value >= significance_map[np.clip(row + dr, 0, ny - 1), np.clip(column + dc, 0, nx - 1)]
+            rows.append(row[peak])
+            columns.append(column[peak])
+            significance.append(value[peak])
+            scales.append(np.full(peak.sum(), scale))
+        return np.concatenate(rows), np.concatenate(columns), np.concatenate(significance), np.concatenate(scales)
+
+    def _pass(self, background, counts_integral, exposure_integral):
+        rows, columns, significance, scales = self._candidates(background)
+        # contagens líquidas numa caixa de meia largura 2 escalas; raio de exclusão onde a gaussiana da fonte
+        # cai a 10% do fundo local, no mínimo 3 escalas
+        half_width = np.ceil(2 * scales).astype(np.intp)
+        bkg = background[rows, columns]
+        counts = _box_sums(counts_integral, rows, columns, half_width)
+        expected = bkg * _box_sums(exposure_integral, rows, columns, half_width)
+        net = counts - expected
+        exposure = np.maximum(self.exposure[rows, columns], 1e-6)
+        peak = np.maximum(net, 0) / (2 * np.pi * scales**2 * exposure)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            growth = np.sqrt(2 * np.log(np.maximum(peak / (0.1 * bkg), 1.0)))
+        radius = scales * np.maximum(growth, 3.0)
+        # com fundo de poucas contagens a aproximação gaussiana falha: exige também a probabilidade
+        # poissoniana P(N >= contagens | fundo) abaixo da do limiar
+        keep = (net >= self.min_counts) & \
+            (scipy.special.gammainc(np.maximum(counts, 1), expected) < scipy.stats.norm.sf(self.threshold))
+        rows, columns, significance, scales, net, radius = (a[keep] for a in (rows, columns, significance, scales,
+                                                                               net, radius))
+
+        # uma fonte por região: o candidato mais significativo absorve os que caem no seu raio de exclusão
+        order = np.argsort(-significance)
+        accepted = []
+        for i in order:
+            if accepted:
+                previous = np.array(accepted)
+                distance = np.hypot(rows[previous] - rows[i], columns[previous] - columns[i])
+                if np.any(distance < np.maximum(radius[previous], radius[i])):
+                    continue
+            accepted.append(i)
+        accepted = np.array(accepted, dtype=np.intp)
+        return rows[accepted], columns[accepted], significance[accepted], scales[accepted], net[accepted], \
+            radius[accepted]
+
+    @instrument('source_detection')
+    def detect(self, n_passes=2):
+        """
+        Detects the sources; each pass after the first re-estimates the
+        background with the sources of the previous one masked.
+
+        Returns:
+        --------
+        DetectedSources
+        """
+        counts_integral = _integral_image(np.where(self.valid, self.counts, 0))
+        exposure_integral = _integral_image(np.where(self.valid, self.exposure, 0))
+        mask = self.valid
+        for _ in range(n_passes):
+            with stage('source_background'):
+                background = self._background(mask)
+            rows, columns, significance, scales, net, radius = self._pass(background, counts_integral,
+                                                                          exposure_integral)
+            circles = [Circle(c, r, rad) for r, c, rad in zip(rows, columns, radius)]
+            # máscara na grade de pixels (coordenadas = índices)
+            mask = self.valid & ~exclusion_mask(self.counts.shape, (1.0, 1.0, 1.0, 1.0), circles)
+        self.background_rate = background
+
+        x, y = physical_grid(self.counts.shape, self.transform)
+        pixel_size = 1 / abs(self.transform[0])
+        sources = DetectedSources(x[columns], y[rows], radius * pixel_size, net, significance, scales)
+        return sources.select(np.argsort(-significance))
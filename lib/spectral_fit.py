@@ -0,0 +1,777 @@
+import os
+import copy
+import logging
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import astropy.io.fits as fits
+from scipy.optimize import minimize, brentq
+
+from lib.fit_results import FitResultTable, load_start_values
+from lib.response import load_response
+from lib.instrumentation import instrument, stage
+
+logger = logging.getLogger(__name__)
+
+# falhas esperadas de um anel: leitura do PHA/resposta (arquivo, coluna ou palavra-chave ausente) e ajuste
+# (brentq sem troca de sinal ou sem convergência, limites inválidos); qualquer outra exceção é um erro do código
+_FIT_ERRORS = (OSError, KeyError, ValueError, RuntimeError, FloatingPointError)
+
+# Seção de choque fotoelétrica de Morrison & McCammon (1983), o modelo wabs:
+# sigma(E) = (c0 + c1 E + c2 E^2) E^-3 * 1e-24 cm^2 por átomo de H, E em keV
+_MM83_EDGES = np.array([0.030, 0.100, 0.284, 0.400, 0.532, 0.707, 0.867, 1.303, 1.840, 2.471, 3.210, 4.038,
+                        7.111, 8.331, 10.000])
+_MM83_COEFFICIENTS = np.array([
+    [17.3, 608.1, -2150.0], [34.6, 267.9, -476.1], [78.1, 18.8, 4.3], [71.4, 66.8, -51.4],
+    [95.5, 145.8, -61.1], [308.9, -380.6, 294.0], [120.6, 169.3, -47.7], [141.3, 146.8, -31.5],
+    [202.7, 104.7, -17.0], [342.7, 18.7, 0.0], [352.2, 18.7, 0.0], [433.9, -2.4, 0.75],
+    [629.0, 30.9, 0.0], [701.2, 25.2, 0.0],
+])
+
+
+def photoelectric_cross_section(energy):
+    """
+    Cross-section per hydrogen atom (cm^2) at ``energy`` (keV).
+    """
+    energy = np.asarray(energy, dtype=float)
+    index = np.clip(np.searchsorted(_MM83_EDGES, energy, side='right') - 1, 0, len(_MM83_COEFFICIENTS) - 1)
+    c0, c1, c2 = _MM83_COEFFICIENTS[index].T
+    return (c0 + c1 * energy + c2 * energy**2) * energy**-3 * 1e-24
+
+
+def absorption(energy, nH):
+    """
+    Transmission of a column ``nH`` (10^22 cm^-2), as the phabs/wabs component.
+    """
+    return np.exp(-nH * 1e22 * photoelectric_cross_section(energy))
+
+
+class TableModel:
+    """
+    Additive model tabulated on a (kT, abundance) grid, in the XSPEC
+    ``atable`` format (PARAMETERS, ENERGIES and SPECTRA extensions). The
+    spectra are photon fluxes per energy bin (photons/cm^2/s) for norm = 1,
+    in the rest frame.
+
+    A table of ``apec`` can be written once with XSPEC (e.g. ``wftbmd``) or
+    with ``TableModel.write``; the fits themselves never need XSPEC.
+    """
+
+    def __init__(self, kT, abundance, energ_lo, energ_hi, spectra, name='apec'):
+        self.kT = np.asarray(kT, dtype=float)
+        self.abundance = np.asarray(abundance, dtype=float)
+        self.energ_lo = np.asarray(energ_lo, dtype=float)
+        self.energ_hi = np.asarray(energ_hi, dtype=float)
+        self.spectra = np.asarray(spectra, dtype=float)
+        self.name = name
+
+    @classmethod
+    def read(cls, path):
+        with fits.open(path) as hdulist:
+            parameters = hdulist['PARAMETERS'].data
+            names = [name.strip().lower() for name in parameters['NAME']]
+            values = [np.array(parameters['VALUE'][i][:parameters['NUMBVALS'][i]], dtype=float)
+                      for i in range(len(names))]
+            kT = values[names.index('kt')]
+            abundance = values[names.index('abundanc')] if 'abundanc' in names else np.array([1.0])
+            energies = hdulist['ENERGIES'].data
+            spectra_table = hdulist['SPECTRA'].data
+            paramval = np.atleast_2d(np.array(spectra_table['PARAMVAL'], dtype=float))
+            if paramval.shape[0] != len(spectra_table):
+                paramval = paramval.T
+            spectra = np.zeros((kT.size, abundance.size, len(energies)))
+            # a ordem dos espectros no arquivo é resolvida pelos valores dos parâmetros de cada linha
+            i = np.searchsorted(kT, paramval[:, names.index('kt')])
+            j = np.searchsorted(abundance, paramval[:, names.index('abundanc')]) if 'abundanc' in names else 0
+            spectra[i, j] = np.array(spectra_table['INTPSPEC'], dtype=float)
+            name = hdulist[0].header.get('MODLNAME', 'apec')
+            return cls(kT, abundance, energies['ENERG_LO'], energies['ENERG_HI'], spectra, name)
+
+    def write(self, path):
+        """
+        Writes the table in the XSPEC ``atable`` format.
+        """
+        n_values = max(self.kT.size, self.abundance.size)
+        values = np.zeros((2, n_values))
+        values[0, :self.kT.size] = self.kT
+        values[1, :self.abundance.size] = self.abundance
+        parameters = fits.BinTableHDU.from_columns([
+            fits.Column(name='NAME', format='12A', array=['kT', 'Abundanc']),
+            fits.Column(name='METHOD', format='J', array=[1, 0]),
+            fits.Column(name='INITIAL', format='E', array=[3.0, 0.4]),
+            fits.Column(name='DELTA', format='E', array=[0.01, 0.01]),
+            fits.Column(name='MINIMUM', format='E', array=[self.kT[0], self.abundance[0]]),
+            fits.Column(name='BOTTOM', format='E', array=[self.kT[0], self.abundance[0]]),
+            fits.Column(name='TOP', format='E', array=[self.kT[-1], self.abundance[-1]]),
+            fits.Column(name='MAXIMUM', format='E', array=[self.kT[-1], self.abundance[-1]]),
+            fits.Column(name='NUMBVALS', format='J', array=[self.kT.size, self.abundance.size]),
+            fits.Column(name='VALUE', format=f'{n_values}E', array=values),
+        ], name='PARAMETERS')
+        parameters.header['NINTPARM'] = 2
+        parameters.header['NADDPARM'] = 0
+        energies = fits.BinTableHDU.from_columns([
+            fits.Column(name='ENERG_LO', format='E', array=self.energ_lo),
+            fits.Column(name='ENERG_HI', format='E', array=self.energ_hi),
+        ], name='ENERGIES')
+        kT, abundance = np.meshgrid(self.kT, self.abundance, indexing='ij')
+        spectra = fits.BinTableHDU.from_columns([
+            fits.Column(name='PARAMVAL', format='2E', array=np.column_stack([kT.ravel(), abundance.ravel()])),
+            fits.Column(name='INTPSPEC', format=f'{self.energ_lo.size}E',
+                        array=self.spectra.reshape(-1, self.energ_lo.size)),
+        ], name='SPECTRA')
+        primary = fits.PrimaryHDU()
+        for key, value in (('HDUCLASS', 'OGIP'), ('HDUCLAS1', 'XSPEC TABLE MODEL'), ('MODLNAME', self.name),
+                           ('MODLUNIT', 'photons/cm^2/s'), ('REDSHIFT', True), ('ADDMODEL', True)):
+            primary.header[key] = value
+        fits.HDUList([primary, parameters, energies, spectra]).writeto(path, overwrite=True)
+
+    def rebin(self, energ_lo, energ_hi, redshift=0.0):
+        """
+        Observed-frame photon flux of every grid spectrum on another energy
+        grid: the rest-frame cumulative flux is interpolated at the edges
+        times (1 + z), for all spectra at once.
+
+        Returns:
+        --------
+        numpy.ndarray
+            (n_kT, n_abundance, n_energy) photon flux per bin.
+        """
+        edges = np.concatenate([self.energ_lo[:1], self.energ_hi])
+        cumulative = np.concatenate([np.zeros(self.spectra.shape[:2] + (1,)), np.cumsum(self.spectra, axis=-1)],
+                                    axis=-1)
+        new_edges = np.concatenate([np.asarray(energ_lo[:1]), np.asarray(energ_hi)]) * (1 + redshift)
+        # pesos da interpolação linear calculados uma vez e aplicados a todos os espectros
+        index = np.clip(np.searchsorted(edges, new_edges) - 1, 0, edges.size - 2)
+        weight = np.clip((new_edges - edges[index]) / (edges[index + 1] - edges[index]), 0.0, 1.0)
+        at_edges = cumulative[..., index] * (1 - weight) + cumulative[..., index + 1] * weight
+        return np.diff(at_edges, axis=-1)
+
+
+class ModelGrid:
+    """
+    Absorbed table model at the cluster redshift folded through a response:
+    the count rate per channel for norm = 1 at every (kT, abundance) node,
+    evaluated between the nodes by bilinear interpolation (log kT, abundance).
+    """
+
+    def __init__(self, table, response, redshift, nH):
+        self.table = table
+        self.response = response
+        self.redshift = redshift
+        self.nH = nH
+        with stage('fold_model_grid'):
+            flux = table.rebin(response.energ_lo, response.energ_hi, redshift)
+            flux = flux * absorption(response.energy, nH)
+            self.rates = response.fold(flux)
+        self.log_kT = np.log(table.kT)
+        self.abundance = table.abundance
+
+    @staticmethod
+    def _weights(axis, values):
+        if axis.size == 1:
+            return np.zeros(np.shape(values), dtype=np.intp), np.zeros(np.shape(values))
+        index = np.clip(np.searchsorted(axis, values) - 1, 0, axis.size - 2)
+        weight = np.clip((values - axis[index]) / (axis[index + 1] - axis[index]), 0.0, 1.0)
+        return index, weight
+
+    def interpolate(self, rates, kT, abundance):
+        """
+        Bilinear interpolation of ``rates`` (n_kT, n_abundance, n) at arrays
+        of kT and abundance (broadcast together).
+        """
+        i, w = self._weights(self.log_kT, np.log(kT))
+        j, v = self._weights(self.abundance, np.asarray(abundance, dtype=float))
+        j1 = np.minimum(j + 1, self.abundance.size - 1)
+        w, v = w[..., np.newaxis], v[..., np.newaxis]
+        return ((1 - w) * (1 - v) * rates[i, j] + w * (1 - v) * rates[i + 1, j] +
+                (1 - w) * v * rates[i, j1] + w * v * rates[i + 1, j1])
+
+    def evaluate(self, kT, abundance):
+        return self.interpolate(self.rates, kT, abundance)
+
+    def for_response(self, response):
+        """
+        The same table, redshift and nH folded through another response
+        (e.g. the spectrum of another ObsID in a joint fit), cached per
+        process like ``model_grid``.
+        """
+        if response is self.response:
+            return self
+        key = (id(self.table), id(response), self.redshift, self.nH)
+        if key not in _grid_cache:
+            _grid_cache[key] = ModelGrid(self.table, response, self.redshift, self.nH)
+        return _grid_cache[key]
+
+    def axes_only(self):
+        """
+        Copy holding only the (kT, abundance) axes: enough to interpolate the
+        rates of a prepared spectrum and cheap to send to other processes.
+        """
+        grid = copy.copy(self)
+        grid.table = grid.response = grid.rates = None
+        return grid
+
+
+class Spectrum:
+    """
+    PI spectrum of one region (OGIP PHA type I), with its background.
+
+    Attributes:
+    ----------
+    counts : numpy.ndarray
+        Counts per channel.
+    channel : numpy.ndarray
+        Channel numbers.
+    exposure, backscal : float
+        Exposure time (s) and area scaling of the spectrum.
+    grouping, quality : numpy.ndarray
+        OGIP grouping (1 starts a group, -1 continues it, 0 ungrouped channel)
+        and quality (0 good) flags.
+    background : Spectrum, optional
+        Background spectrum.
+    respfile, ancrfile : str
+        Response files named in the header (absolute paths).
+    """
+
+    def __init__(self, counts, exposure, backscal=1.0, channel=None, grouping=None, quality=None, background=None,
+                 respfile=None, ancrfile=None, path=None):
+        self.counts = np.asarray(counts, dtype=float)
+        self.exposure = float(exposure)
+        self.backscal = float(backscal)
+        n = self.counts.size
+        self.channel = np.arange(1, n + 1) if channel is None else np.asarray(channel)
+        self.grouping = np.ones(n, dtype=int) if grouping is None else np.asarray(grouping, dtype=int)
+        self.quality = np.zeros(n, dtype=int) if quality is None else np.asarray(quality, dtype=int)
+        self.background = background
+        self.respfile = respfile
+        self.ancrfile = ancrfile
+        self.path = path
+
+    @classmethod
+    def from_pha(cls, path, read_background=True):
+        directory = os.path.dirname(os.path.abspath(path))
+
+        def resolve(name):
+            if name is None or str(name).strip().lower() in ('', 'none'):
+                return None
+            name = str(name).strip().split('[')[0]
+            return name if os.path.isabs(name) else os.path.join(directory, name)
+
+        with fits.open(path) as hdulist:
+            hdu = hdulist['SPECTRUM']
+            data, header = hdu.data, hdu.header
+            names = [name.upper() for name in data.columns.names]
+            exposure = header.get('EXPOSURE', 1.0)
+            counts = data['COUNTS'] if 'COUNTS' in names else data['RATE'] * exposure
+            column = lambda name, default: np.array(data[name]) if name in names else header.get(name, default)
+            grouping = column('GROUPING', 1)
+            quality = column('QUALITY', 0)
+            backscal = float(np.mean(data['BACKSCAL'])) if 'BACKSCAL' in names else header.get('BACKSCAL', 1.0)
+            n = len(data)
+            spectrum = cls(np.array(counts), exposure, backscal,
+                           np.array(data['CHANNEL']), np.broadcast_to(grouping, n), np.broadcast_to(quality, n),
+                           respfile=resolve(header.get('RESPFILE')), ancrfile=resolve(header.get('ANCRFILE')),
+                           path=path)
+            backfile = resolve(header.get('BACKFILE'))
+        if read_background and backfile is not None:
+            spectrum.background = cls.from_pha(backfile, read_background=False)
+        return spectrum
+
+    @property
+    def background_scale(self):
+        """
+        Factor that scales the background counts to the source spectrum.
+        """
+        background = self.background
+        return (self.exposure * self.backscal) / (background.exposure * background.backscal)
+
+
+class _FitData:
+    """
+    Channels of one spectrum used in a fit, already grouped, with the model
+    grid folded into the same groups.
+    """
+
+    def __init__(self, spectrum, grid, energy_range):
+        response = grid.response
+        index = spectrum.channel - response.first_channel
+        energy = 0.5 * (response.e_min[index] + response.e_max[index])
+        good = (spectrum.quality == 0) & (energy >= energy_range[0]) & (energy <= energy_range[1])
+        # GROUPING 0 (sem agrupamento) conta como um grupo de um canal
+        group = np.cumsum(spectrum.grouping != -1) - 1
+        # apenas grupos com canais bons; um grupo cruzando o limite de energia perde os canais de fora
+        groups, group_index = np.unique(group[good], return_inverse=True)
+        aggregation = np.zeros((response.e_min.size, groups.size))
+        aggregation[index[good], group_index] = 1.0
+        self.counts = np.bincount(group_index, weights=spectrum.counts[good], minlength=groups.size)
+        if spectrum.background is not None:
+            scale = spectrum.background_scale
+            background = np.bincount(group_index, weights=spectrum.background.counts[good], minlength=groups.size)
+            self.background = scale * background
+            self.variance = np.maximum(self.counts + scale**2 * background, 1.0)
+        else:
+            self.background = np.zeros(groups.size)
+            self.variance = np.maximum(self.counts, 1.0)
+        self.exposure = spectrum.exposure
+        self.rates = grid.rates @ aggregation
+        self.n_bins = groups.size
+
+
+class _JointFitData:
+    """
+    Spectra of several observations fitted with common parameters: the
+    groups of all spectra side by side, each with its exposure folded into
+    its rates, so the fitter treats them as one spectrum.
+    """
+
+    def __init__(self, datas):
+        self.counts = np.concatenate([data.counts for data in datas])
+        self.background = np.concatenate([data.background for data in datas])
+        self.variance = np.concatenate([data.variance for data in datas])
+        self.rates = np.concatenate([data.exposure * data.rates for data in datas], axis=-1)
+        self.exposure = 1.0
+        self.n_bins = self.counts.size
+
+
+class SpectralFitter:
+    """
+    XSPEC-free fit of an absorbed thermal model (phabs*apec by default) to
+    PI spectra, using a ModelGrid folded through each region's response.
+
+    The free parameters are kT, abundance (unless frozen) and norm. The
+    starting point comes from a vectorized scan of the whole grid (with the
+    best norm of every node solved in closed form or by a few Newton steps)
+    and is refined with L-BFGS-B on the interpolated grid. Errors are found
+    where the profiled statistic rises by ``delta`` (1.0, as in
+    ``Fit.error("1. 2,3,5")``).
+
+    Parameters:
+    -----------
+    grid : ModelGrid
+    statistic : str
+        ``'cstat'`` (Cash, background subtracted as a fixed model) or ``'chi2'``.
+    energy_range : tuple
+        (min, max) energy of the channels used (keV).
+    abundance : float, optional
+        Fixed abundance; free when None.
+    """
+
+    def __init__(self, grid, statistic='cstat', energy_range=(0.5, 5.0), abundance=None):
+        if statistic not in ('cstat', 'chi2'):
+            raise ValueError("statistic must be 'cstat' or 'chi2'")
+        self.grid = grid
+        self.statistic = statistic
+        self.energy_range = energy_range
+        self.abundance = abundance
+
+    @property
+    def names(self):
+        return ['kT', 'norm'] if self.abundance is not None else ['kT', 'abundance', 'norm']
+
+    def prepare(self, spectrum):
+        if isinstance(spectrum, (list, tuple)):
+            # ajuste conjunto: cada espectro com a grade dobrada pela sua própria resposta
+            return _JointFitData([_FitData(item, self.grid.for_response(load_response(item.respfile, item.ancrfile)),
+                                           self.energy_range) for item in spectrum])
+        return _FitData(spectrum, self.grid, self.energy_range)
+
+    def stat(self, data, model):
+        """
+        Fit statistic of model counts with any leading dimensions.
+        """
+        counts = data.counts
+        if self.statistic == 'chi2':
+            return np.sum((counts - model)**2 / data.variance, axis=-1)
+        model = np.maximum(model, 1e-300)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_term = np.where(counts > 0, counts * np.log(counts / model), 0.0)
+        return 2 * np.sum(model - counts + log_term, axis=-1)
+
+    def _unpack(self, x):
+        kT = np.exp(x[..., 0])
+        if self.abundance is None:
+            return kT, x[..., 1], np.exp(x[..., 2])
+        return kT, np.full(np.shape(kT), self.abundance), np.exp(x[..., 1])
+
+    def model_counts(self, data, kT, abundance, norm):
+        rates = self.grid.interpolate(data.rates, kT, abundance)
+        return data.exposure * np.asarray(norm)[..., np.newaxis] * rates + data.background
+
+    def objective(self, data, x):
+        return float(self.stat(data, self.model_counts(data, *self._unpack(np.asarray(x)))))
+
+    def best_norm(self, data, rates, iterations=8):
+        """
+        Norm minimizing the statistic for each row of ``rates`` (count rate
+        per unit norm): closed form for chi2, Newton steps for C-stat.
+        """
+        a = data.exposure * rates
+        if self.statistic == 'chi2':
+            numerator = np.sum(a * (data.counts - data.background) / data.variance, axis=-1)
+            return np.maximum(numerator / np.sum(a**2 / data.variance, axis=-1), 1e-12)
+        total = np.sum(a, axis=-1)
+        norm = np.maximum((data.counts.sum() - data.background.sum()) / total, 1e-12)
+        for _ in range(iterations):
+            model = norm[..., np.newaxis] * a + data.background
+            gradient = total - np.sum(data.counts * a / model, axis=-1)
+            curvature = np.sum(data.counts * a**2 / model**2, axis=-1)
+            norm = np.maximum(norm - gradient / np.maximum(curvature, 1e-300), 0.1 * norm)
+        return norm
+
+    def grid_start(self, data):
+        """
+        Best (kT, abundance, norm) among the grid nodes.
+        """
+        rates = data.rates
+        if self.abundance is not None:
+            kT_nodes = self.grid.table.kT
+            rates = self.grid.interpolate(rates, kT_nodes, np.full(kT_nodes.size, self.abundance))
+            abundance_nodes = np.full(kT_nodes.size, self.abundance)
+        else:
+            kT_nodes, abundance_nodes = (a.ravel() for a in np.meshgrid(self.grid.table.kT, self.grid.abundance,
+                                                                         indexing='ij'))
+            rates = rates.reshape(-1, rates.shape[-1])
+        norm = self.best_norm(data, rates)
+        model = data.exposure * norm[:, np.newaxis] * rates + data.background
+        best = np.argmin(self.stat(data, model))
+        return kT_nodes[best], abundance_nodes[best], norm[best]
+
+    def _pack(self, kT, abundance, norm):
+        if self.abundance is None:
+            return np.array([np.log(kT), abundance, np.log(norm)])
+        return np.array([np.log(kT), np.log(norm)])
+
+    def _bounds(self):
+        log_kT = (self.grid.log_kT[0], self.grid.log_kT[-1])
+        norm = (np.log(1e-12), np.log(1e3))
+        if self.abundance is None:
+            return [log_kT, (self.grid.abundance[0], self.grid.abundance[-1]), norm]
+        return [log_kT, norm]
+
+    def _minimize(self, data, x0, fixed=None):
+        """
+        Minimizes the statistic from ``x0``; ``fixed`` = (index, value) holds
+        one parameter (in the internal log scale) constant.
+        """
+        bounds = self._bounds()
+        if fixed is not None:
+            index, value = fixed
+            free = [k for k in range(len(x0)) if k != index]
+
+            def objective(y):
+                x = np.empty(len(x0))
+                x[free] = y
+                x[index] = value
+                return self.objective(data, x)
+            result = minimize(objective, np.asarray(x0)[free], method='L-BFGS-B', bounds=[bounds[k] for k in free])
+            return result.fun
+        result = minimize(lambda x: self.objective(data, x), x0, method='L-BFGS-B', bounds=bounds)
+        return result.x, result.fun
+
+    @instrument('native_spectral_fit')
+    def fit(self, spectrum, start=None, errors=True, delta=1.0, steps=None, executor=None):
+        """
+        Fits one spectrum.
+
+        Parameters:
+        -----------
+        spectrum : Spectrum or list of Spectrum
+            A list is fitted jointly (e.g. one spectrum per ObsID of the
+            same annulus): common kT, abundance and norm, each spectrum
+            folded through its own response.
+        start : tuple, optional
+            Initial (kT, abundance, norm); the best grid node by default. A
+            norm of None is solved for the given kT and abundance (e.g. when
+            seeding from another annulus, whose norm scales with its area).
+        errors : bool
+            Compute the confidence intervals.
+        steps : dict, optional
+            First step of the interval search of each parameter (see
+            ``error_steps``); 0.05 in the internal scale by default.
+        executor : concurrent.futures.Executor, optional
+            Searches the interval of every parameter in its own worker.
+
+        Returns:
+        --------
+        dict
+            ``kT``, ``abundance`` and ``norm`` as ``[value, +err, -err]``
+            rows (errors NaN when ``errors`` is False), plus ``statistic``
+            and ``dof``.
+        """
+        data = self.prepare(spectrum)
+        if start is None:
+            start = self.grid_start(data)
+        kT0, abundance0, norm0 = start
+        abundance0 = abundance0 if self.abundance is None else self.abundance
+        kT0 = np.clip(kT0, self.grid.table.kT[0], self.grid.table.kT[-1])
+        abundance0 = np.clip(abundance0, self.grid.abundance[0], self.grid.abundance[-1])
+        if norm0 is None or not np.isfinite(norm0) or norm0 <= 0:
+            norm0 = float(self.best_norm(data, self.grid.interpolate(data.rates, kT0, abundance0)))
+        x, best = self._minimize(data, self._pack(kT0, abundance0, norm0))
+        kT, abundance, norm = (float(value) for value in self._unpack(x))
+        if errors:
+            intervals = self.confidence(data, x, best, delta, steps, executor)
+        else:
+            intervals = {name: (np.nan, np.nan) for name in self.names}
+        values = {'kT': kT, 'abundance': abundance, 'norm': norm}
+        result = {name: [values[name], *(float(error) for error in intervals.get(name, (np.nan, np.nan)))]
+                  for name in values}
+        if self.abundance is not None:
+            result['abundance'] = [abundance, 0.0, 0.0]
+        result['statistic'] = best
+        result['dof'] = data.n_bins - len(self.names)
+        return result
+
+    def error_steps(self, rows):
+        """
+        First steps of the interval search, in the internal scale, from the
+        ``[value, +err, -err]`` rows of kT, abundance and norm of a similar
+        fit (the neighbouring annulus or a previous run).
+        """
+        steps = {}
+        for name, row in zip(('kT', 'abundance', 'norm'), rows):
+            value, error = row[0], 0.5 * (abs(row[1]) + abs(row[2]))
+            if name != 'abundance' and value:
+                error = np.log1p(error / value)
+            # 1.5 erro: o primeiro passo da busca já costuma cruzar best + delta
+            if name in self.names and np.isfinite(error) and error > 0:
+                steps[name] = float(1.5 * error)
+        return steps
+
+    def confidence(self, data, x, best, delta=1.0, steps=None, executor=None):
+        """
+        ``(+err, -err)`` of every free parameter where the statistic,
+        minimized over the others, reaches ``best + delta``.
+
+        The searches are independent (each starts from the best fit ``x``),
+        so with an ``executor`` every parameter runs in its own worker.
+        """
+        steps = steps or {}
+        tasks = [(data, x, best, index, delta, steps.get(name, 0.05)) for index, name in enumerate(self.names)]
+        if executor is None:
+            intervals = [self.parameter_interval(*task) for task in tasks]
+        else:
+            # só os eixos da grade vão para os processos: as taxas do espectro já estão em data
+            fitter = copy.copy(self)
+            fitter.grid = self.grid.axes_only()
+            intervals = list(executor.map(_parameter_interval_task, [(fitter, *task) for task in tasks]))
+        return dict(zip(self.names, intervals))
+
+    def parameter_interval(self, data, x, best, index, delta=1.0, step=0.05):
+        """
+        Confidence interval of one parameter (its index in ``names``); the
+        bracket starts ``step`` away from the best fit and doubles until
+        the statistic crosses ``best + delta``.
+        """
+        bounds = self._bounds()[index]
+        target = best + delta
+        profile = lambda value: self._minimize(data, x, fixed=(index, value)) - target
+        first_step = step
+        limits = []
+        for direction, bound in ((1.0, bounds[1]), (-1.0, bounds[0])):
+            step = first_step
+            inner, outer = x[index], x[index]
+            found = False
+            while direction * (bound - outer) > 0:
+                outer = np.clip(inner + direction * step, *bounds)
+                if profile(outer) > 0:
+                    found = True
+                    break
+                inner, step = outer, 2 * step
+            limits.append(brentq(profile, inner, outer, xtol=1e-4) if found else bound)
+        upper, lower = limits
+        value = x[index]
+        if self.names[index] == 'abundance':
+            return upper - value, lower - value
+        # kT e norm são ajustados em log
+        return np.exp(upper) - np.exp(value), np.exp(lower) - np.exp(value)
+
+
+def _parameter_interval_task(arguments):
+    fitter, *task = arguments
+    return fitter.parameter_interval(*task)
+
+
+_grid_cache = {}
+
+
+def model_grid(table_path, rmf_path, arf_path, redshift, nH):
+    """
+    ModelGrid of a table and response, cached per process: regions that
+    share a response (same RMF/ARF contents, see ``lib.response``) fold the
+    table only once.
+    """
+    response = load_response(rmf_path, arf_path)
+    table_path = os.path.abspath(table_path)
+    key = (table_path, id(response), redshift, nH)
+    if key not in _grid_cache:
+        if table_path not in _grid_cache:
+            _grid_cache[table_path] = TableModel.read(table_path)
+        _grid_cache[key] = ModelGrid(_grid_cache[table_path], response, redshift, nH)
+    return _grid_cache[key]
+
+
+def fit_spectrum_file(spec_path, table_path, redshift, nH, abundance=None, statistic='cstat',
+                      energy_range=(0.5, 5.0), start=None, neighbour=None, executor=None):
+    """
+    Fits one PHA file with the responses named in its header. Returns the
+    ``[value, +err, -err]`` rows of kT, abundance and norm, or None when the
+    spectrum cannot be read or the fit fails (as the XSPEC loop does); the
+    cause is logged as a warning.
+
+    Parameters:
+    -----------
+    spec_path : str or list of str
+        A list of files (the same annulus in several ObsIDs) is fitted jointly.
+    start : tuple, optional
+        Initial (kT, abundance, norm), e.g. the previous run of this annulus.
+    neighbour : tuple, optional
+        Result rows of the neighbouring annulus: its kT and abundance seed
+        the fit when ``start`` is not given and its errors set the first
+        steps of the error search.
+    executor : concurrent.futures.Executor, optional
+        Runs the confidence search of each parameter in its own worker.
+    """
+    try:
+        if isinstance(spec_path, (list, tuple)):
+            spectrum = [Spectrum.from_pha(path) for path in spec_path]
+            first = spectrum[0]
+        else:
+            spectrum = first = Spectrum.from_pha(spec_path)
+        grid = model_grid(table_path, first.respfile, first.ancrfile, redshift, nH)
+        fitter = SpectralFitter(grid, statistic, energy_range, abundance)
+        steps = None
+        if neighbour is not None:
+            steps = fitter.error_steps(neighbour)
+            if start is None:
+                start = (neighbour[0][0], neighbour[1][0], None)
+        result = fitter.fit(spectrum, start=start, steps=steps, executor=executor)
+        return result['kT'], result['abundance'], result['norm']
+    except BrokenProcessPool:
+        # o pool da busca de erros morreu: não é uma falha deste anel
+        raise
+    except _FIT_ERRORS as e:
+        logger.warning("Error processing %s in the native fit: %s: %s", spec_path, type(e).__name__, e)
+        return None
+
+
+def fit_spectrum_chain(spec_paths, table_path, redshift, nH, abundance=None, statistic='cstat',
+                       energy_range=(0.5, 5.0), starts=None, warm_start=True, executor=None):
+    """
+    Fits spectra one after the other in the given (radial) order. With
+    ``warm_start`` every fit is seeded from the converged parameters and
+    errors of the previous annulus; ``starts`` (one (kT, abundance, norm)
+    per spectrum, NaN when unknown) takes precedence as the starting point.
+    With an ``executor`` the confidence search of each parameter runs in
+    its own worker; the caller owns it and shares it between chains.
+    """
+    results = []
+    neighbour = None
+    for i, path in enumerate(spec_paths):
+        start = None if starts is None else tuple(starts[i])
+        if start is not None and not np.all(np.isfinite(start)):
+            start = None
+        result = fit_spectrum_file(path, table_path, redshift, nH, abundance, statistic, energy_range, start,
+                                   neighbour if warm_start else None, executor)
+        # um anel que falhou não serve de semente: mantém o último que convergiu
+        if result is not None and np.all(np.isfinite(np.array(result, dtype=float))):
+            neighbour = result
+        results.append(result)
+    return results
+
+
+def _fit_chain_task(arguments):
+    return fit_spectrum_chain(*arguments)
+
+
+def fit_spectra(spec_paths, table_path, redshift, nH, abundance=None, statistic='cstat', energy_range=(0.5, 5.0),
+                max_workers=None, provenance=None, warm_start=False, starts=None, error_workers=None):
+    """
+    Fits many spectra in a process pool and returns a FitResultTable.
+
+    Parameters:
+    -----------
+    spec_paths : list
+        PHA files in radial order; an item that is a list of files (one
+        per ObsID) is fitted jointly.
+    abundance : float, optional
+        Fixed abundance; free when None.
+    max_workers : int, optional
+        Number of processes; 1 fits in this process.
+    warm_start : bool
+        Seed each fit from its inner neighbour (``fit_spectrum_chain``).
+        In the pool the spectra are split into contiguous radial chunks,
+        one chain per chunk, so neighbours stay in the same worker.
+    starts : numpy.ndarray, optional
+        (n, 3) starting (kT, abundance, norm) of every spectrum, e.g. from
+        ``FitResultTable.start_values`` of a previous run.
+    error_workers : int, optional
+        Processes for the per-parameter confidence searches, one pool
+        shared by every fit (see ``fit_spectrum_chain``). Only used when the
+        spectra are fitted in this process (``max_workers=1``) and this
+        process is not itself a pool worker; otherwise the searches run
+        serially.
+    """
+    n_spectra = len(spec_paths)
+    if max_workers == 1:
+        chunks = [np.arange(n_spectra)]
+    elif warm_start:
+        n_chunks = min(n_spectra, max_workers or os.cpu_count() or 1)
+        chunks = np.array_split(np.arange(n_spectra), max(n_chunks, 1))
+    else:
+        chunks = [np.array([i]) for i in range(n_spectra)]
+    tasks = [([spec_paths[i] for i in chunk], table_path, redshift, nH, abundance, statistic, energy_range,
+              None if starts is None else np.asarray(starts)[chunk], warm_start) for chunk in chunks]
+    if max_workers == 1:
+        # um único pool de buscas de erro para todas as cadeias, e nenhum dentro de um worker (ex.: run_batch),
+        # onde ele se aninharia no pool de fora
+        parallel_errors = error_workers and error_workers > 1 and multiprocessing.parent_process() is None
+        with ProcessPoolExecutor(max_workers=error_workers) if parallel_errors else nullcontext() as executor:
+            chained = [fit_spectrum_chain(*task, executor=executor) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            chained = list(executor.map(_fit_chain_task, tasks))
+    results = [result for chunk in chained for result in chunk]
+    empty = [None, None, None]
+    temperature = [empty if result is None else result[0] for result in results]
+    abundances = [empty if result is None else result[1] for result in results]
+    norm = [empty if result is None else result[2] for result in results]
+    provenance = {'MODEL': 'phabs*apec', 'FITTER': 'native', 'STAT': statistic, 'NH': nH, 'REDSHIFT': redshift,
+                  'TABLE': os.path.basename(table_path), **(provenance or {})}
+    return FitResultTable.from_rows(temperature, norm, abundances, provenance=provenance)
+
+
+def ajuste_apec_nativo(spec_dir, reg_path, table_path, redshift=0.032, nH=0.04, abundance=0.4, output_dir=None,
+                       statistic='cstat', free_abundance=True, max_workers=None, warm_start=False,
+                       previous_results=None, error_workers=None):
+    """
+    Drop-in replacement of ``ajuste_apec_xspec`` without XSPEC: fits the
+    ``spec_espectro_{i}_grp.pi`` spectrum of every region of ``reg_path``
+    and writes ``ajuste_apec.fits`` in ``output_dir``. Returns its path.
+    ``spec_dir`` may be a list of directories (one per ObsID, same regions):
+    the spectra of each region are then fitted jointly.
+    ``abundance`` is only used when it is frozen (``free_abundance=False``).
+    With ``warm_start`` each annulus starts from its inner neighbour, and
+    ``previous_results`` (a fit result table of the same regions) seeds
+    every annulus from its previous fit. ``error_workers`` parallelizes the
+    error search of each fit over its parameters.
+    """
+    with open(reg_path, 'r') as file:
+        n_regions = len(file.readlines())
+    spec_dirs = [spec_dir] if isinstance(spec_dir, str) else list(spec_dir)
+    spec_paths = [[os.path.join(directory, f'spec_espectro_{i}_grp.pi') for directory in spec_dirs]
+                  for i in range(n_regions)]
+    if len(spec_dirs) == 1:
+        spec_paths = [paths[0] for paths in spec_paths]
+    table = fit_spectra(spec_paths, table_path, redshift, nH, None if free_abundance else abundance, statistic,
+                        max_workers=max_workers, warm_start=warm_start, error_workers=error_workers,
+                        starts=load_start_values(previous_results, n_regions),
+                        provenance={'SPECDIR': ','.join(os.path.basename(os.path.normpath(directory))
+                                                        for directory in spec_dirs),
+                                    'REGFILE': os.path.basename(reg_path)})
+    output_path = os.path.join(output_dir if output_dir is not None else spec_dirs[0], 'ajuste_apec.fits')
+    table.write(output_path)
+    return output_path
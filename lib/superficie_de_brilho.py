@@ -1,14 +1,11 @@
 import os
 import subprocess
 #from lib.superficie_de_brilho import *
-from sherpa.astro.data import Data1D
-from sherpa.astro.models import Beta1D 
-from sherpa.fit import Fit
 import matplotlib.pyplot as plt
 import astropy.io.fits as fits
 import numpy as np
-from sherpa.plot import DataPlot, ModelPlot
 import uncertainties as un
+from lib.instrumentation import instrument, stage
 #from lib import *
 
 class Create_rprofile:
@@ -88,7 +85,8 @@ class Create_rprofile:
         # Print the command for debugging purposes
         print("Running command:", dmextract_command)
         # Execute the command
-        subprocess.run(dmextract_command, shell=True, check=True)
+        with stage('dmextract'):
+            subprocess.run(dmextract_command, shell=True, check=True)
 
 
 class Make_surface_brightness_plot:
@@ -117,6 +115,8 @@ class Make_surface_brightness_plot:
         Errors from the fit.
     """
 
+    DEFAULT_START = (105, 4, 0.00993448)
+
     def __init__(self, r_profile_fits_path):
         self.r_profile_fits_path = r_profile_fits_path
         self.r0_val = 0
@@ -128,10 +128,33 @@ class Make_surface_brightness_plot:
         self.model = None
         self.errors = None
 
-    def plot_process(self):
+    @instrument('plot_process')
+    def plot_process(self, start=None, error_method='covariance', parallel_errors=False):
         """
         Processes the FITS file and fits a Beta1D model to the data.
+
+        Parameters:
+        -----------
+        start : tuple, optional
+            Initial (r0, beta, ampl), e.g. a previous fit of the same
+            profile (warm start). Default is ``DEFAULT_START``.
+        error_method : str, optional
+            Sherpa error estimator: ``'covariance'`` (default, symmetric
+            errors from the curvature at the best fit) or ``'confidence'``
+            (profile-likelihood intervals, asymmetric and slower).
+        parallel_errors : bool, optional
+            With ``'confidence'``, search the interval of each free parameter
+            in its own process. The covariance errors come from a single
+            matrix, so there is nothing to parallelize and it is ignored.
         """
+        if error_method not in ('covariance', 'confidence'):
+            raise ValueError("error_method must be 'covariance' or 'confidence'")
+        # o sherpa só é importado aqui: o resto de lib (e os benchmarks) funciona sem ele
+        from sherpa.astro.data import Data1D
+        from sherpa.astro.models import Beta1D
+        from sherpa.fit import Fit
+        from sherpa.estmethods import Confidence
+
         # Open the FITS file and extract data
         hdulist = fits.open(self.r_profile_fits_path)
         data_table = hdulist[1].data
@@ -149,15 +172,21 @@ class Make_surface_brightness_plot:
 
         # Create Beta1D model
         src = Beta1D()
-        src.r0 = 105
-        src.beta = 4
-        src.ampl = 0.00993448
+        if start is None or not np.all(np.isfinite(start)):
+            start = self.DEFAULT_START
+        src.r0, src.beta, src.ampl = (float(value) for value in start)
 
         # Freeze the xpos parameter
         src.xpos.frozen = True
 
         # Create fitting object and fit the model
         fit = Fit(data, src)
+        if error_method == 'confidence':
+            fit.estmethod = Confidence()
+            # cada busca parte do melhor ajuste, então r0, beta e ampl podem rodar em processos separados
+            fit.estmethod.config['parallel'] = bool(parallel_errors)
+            if parallel_errors:
+                fit.estmethod.config['numcores'] = len(src.thawedpars)
         results = fit.fit()
 
         # Get fitted parameter values
@@ -169,7 +198,8 @@ class Make_surface_brightness_plot:
         self.model = src(self.x)
 
         # Estimate errors
-        self.errors = fit.est_errors()
+        with stage('est_errors'):
+            self.errors = fit.est_errors()
 
     def surface_brightness_plot(self):
         """
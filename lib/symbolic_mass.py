@@ -0,0 +1,143 @@
+import functools
+
+import numpy as np
+import sympy as sp
+from astropy import units as u
+from astropy import constants as const
+
+from lib.instrumentation import instrument
+
+# os símbolos (r, a, b, ..., beta) ficam de fora: ``from lib import *`` os espalharia sobre nomes comuns
+__all__ = ['TEMPERATURE_MODELS', 'DENSITY_MODELS', 'log_slope', 'compile_expression', 'SymbolicMassModel']
+
+
+r = sp.Symbol('r', positive=True)
+a, b, c, d, T0 = sp.symbols('a b c d T0', real=True)
+n0, rc, beta, n02, rc2, beta2 = sp.symbols('n0 rc beta n02 rc2 beta2', positive=True)
+
+# Perfis disponíveis por nome; novos modelos só precisam da expressão em r (kpc), T em keV
+TEMPERATURE_MODELS = {
+    'exponential': a + b * sp.exp(-c * r) - d * r,  # modelo de CurveFitter
+    'isothermal': T0,
+}
+DENSITY_MODELS = {
+    'beta': n0 * (1 + (r / rc)**2)**(-3 * beta / 2),
+    'double_beta': n0 * (1 + (r / rc)**2)**(-3 * beta / 2) + n02 * (1 + (r / rc2)**2)**(-3 * beta2 / 2),
+}
+
+# k_B T r / (G m_p) em M_sun para T em keV e r em kpc
+_MASS_UNIT = (u.keV * u.kpc / (const.G * const.m_p)).to(u.solMass).value
+
+
+def log_slope(expression, radius=r):
+    """
+    Logarithmic derivative d ln f / d ln r of a sympy expression.
+    """
+    return sp.powsimp(sp.diff(expression, radius) * radius / expression)
+
+
+@functools.lru_cache(maxsize=None)
+def _derive(temperature, density, radius):
+    # derivação simbólica feita uma vez por par de modelos (expressões sympy são hasháveis)
+    temperature_slope = log_slope(temperature, radius)
+    density_slope = log_slope(density, radius)
+    mass = -_MASS_UNIT * temperature * radius * (temperature_slope + density_slope)
+    return temperature_slope, density_slope, mass
+
+
+@functools.lru_cache(maxsize=None)
+def compile_expression(expression, parameters, radius=r):
+    """
+    Vectorized NumPy function ``f(r, *parameters)`` of a sympy expression,
+    generated once with ``lambdify`` (common subexpressions eliminated) and
+    cached by expression.
+
+    Parameters:
+    -----------
+    parameters : tuple of sympy.Symbol
+        Order of the arguments after the radius.
+    """
+    return sp.lambdify((radius, *parameters), expression, modules='numpy', cse=True)
+
+
+class SymbolicMassModel:
+    """
+    Hydrostatic mass of a cluster from sympy expressions of T(r) and n(r):
+
+        M(<r) = -k_B T r / (G mu m_p) (d ln T / d ln r + d ln n / d ln r)
+
+    The logarithmic slopes are derived symbolically and the profiles, the
+    slopes and M(r) are compiled once into cached NumPy kernels, so a new
+    model form only needs its expressions. Evaluation broadcasts the radii
+    against the parameters: pass parameter arrays of shape (n, 1) to get
+    (n, n_radii) profiles for n Monte Carlo samples at once.
+
+    Parameters:
+    -----------
+    temperature : sympy.Expr
+        T(r) in keV, r in kpc.
+    density : sympy.Expr
+        n(r) in any unit (only its logarithmic slope enters the mass).
+    parameters : list of sympy.Symbol, optional
+        Parameters of both expressions; every free symbol other than the
+        radius, sorted by name, by default.
+    radius : sympy.Symbol
+        Radius symbol of the expressions.
+    """
+
+    def __init__(self, temperature, density, parameters=None, radius=r):
+        self.temperature = sp.sympify(temperature)
+        self.density = sp.sympify(density)
+        self.radius = radius
+        if parameters is None:
+            parameters = sorted((self.temperature.free_symbols | self.density.free_symbols) - {radius}, key=str)
+        self.parameters = tuple(parameters)
+        self.temperature_slope, self.density_slope, self.mass = _derive(self.temperature, self.density, radius)
+
+    @classmethod
+    def from_names(cls, temperature='exponential', density='beta'):
+        """
+        Model from the forms of ``TEMPERATURE_MODELS`` and ``DENSITY_MODELS``.
+        """
+        return cls(TEMPERATURE_MODELS[temperature], DENSITY_MODELS[density])
+
+    @property
+    def parameter_names(self):
+        return [str(parameter) for parameter in self.parameters]
+
+    def _evaluate(self, expression, R, params):
+        missing = [name for name in self.parameter_names if name not in params]
+        if missing:
+            raise ValueError(f"Missing model parameters: {missing}")
+        arguments = [np.asarray(R, dtype=float)] + [np.asarray(params[name], dtype=float)
+                                                    for name in self.parameter_names]
+        values = compile_expression(expression, self.parameters, self.radius)(*arguments)
+        # expressões sem r (ex.: isotérmico) devolvem escalares: ajusta ao formato dos argumentos
+        return np.broadcast_to(values, np.broadcast(*arguments).shape)
+
+    def temperature_profile(self, R, **params):
+        """
+        T(R) in keV.
+        """
+        return self._evaluate(self.temperature, R, params)
+
+    def density_profile(self, R, **params):
+        return self._evaluate(self.density, R, params)
+
+    def slopes(self, R, **params):
+        """
+        (d ln T / d ln r, d ln n / d ln r) at ``R``.
+        """
+        return self._evaluate(self.temperature_slope, R, params), self._evaluate(self.density_slope, R, params)
+
+    @instrument('symbolic_mass')
+    def mass_profile(self, R, mu=0.6, **params):
+        """
+        Hydrostatic mass (M_sun) within ``R`` (kpc).
+
+        Parameters:
+        -----------
+        mu : float
+            Mean molecular weight.
+        """
+        return self._evaluate(self.mass, R, params) / mu
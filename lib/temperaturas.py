@@ -6,6 +6,8 @@ import pickle
 
 from scipy.optimize import curve_fit
 import matplotlib.pyplot as plt
+from lib.instrumentation import instrument
+from lib.fit_results import load_fit_rows
 
 
 class Temperature_Processor:
@@ -14,12 +16,13 @@ class Temperature_Processor:
         self.pkl_temp_path = pkl_temp_path
         self.temperature = []
         self.erro = []
+        self.temperature_carregado = None
         
     def open_file(self):
-        '''Abre o arquivo'''
-        with open(self.pkl_temp_path, 'rb') as arquivo1:
-            temperature_carregado = pickle.load(arquivo1)
-            return temperature_carregado
+        '''Abre o arquivo uma única vez (tabela FITS de resultados mapeada em memória ou pickle antigo)'''
+        if self.temperature_carregado is None:
+            self.temperature_carregado = load_fit_rows(self.pkl_temp_path, 'kT')
+        return self.temperature_carregado
 
     def error_estimator(self):  
         temperature_carregado = self.open_file()
@@ -40,6 +43,8 @@ class Temperature_Processor:
             self.temperature.append(i)
         
 class CurveFitter:
+    DEFAULT_GUESS = [6.503, -4.626, 0.014, 0.002]#[75464226.11512351, -53682532.67854243, 4.536616979909268e-24, 7.520755026681788e-18]
+
     def __init__(self, radius, temperature, error_radius, error_temperature):
         self.radius = radius
         self.temperature = temperature
@@ -50,9 +55,11 @@ class CurveFitter:
     def model_function(R, a, b, c, d):
         return a + b * np.exp(-c * R) - d * R
 
-    def fit_curve(self):
-        # Initial guess for the parameters
-        initial_guess = [6.503, -4.626, 0.014, 0.002]#[75464226.11512351, -53682532.67854243, 4.536616979909268e-24, 7.520755026681788e-18]
+    @instrument('fit_curve')
+    def fit_curve(self, initial_guess=None):
+        # Initial guess for the parameters: a previous fit of the same cluster (warm start) converges in far fewer evaluations
+        if initial_guess is None or not np.all(np.isfinite(initial_guess)):
+            initial_guess = self.DEFAULT_GUESS
 
         # Define parameter bounds
         param_bounds = ([-np.inf, -np.inf, -np.inf, -np.inf], [np.inf, np.inf, np.inf, np.inf])
@@ -18,35 +18,37 @@ class Mass_Calculator:
         except TypeError as e:
             print(f"TypeError: {e}")
     
-    def calculate_mass(self):
+    def calculate_mass(self, R=None):
+        # M(R) numérico (vetorizado); por padrão nos raios da instância
+        R = self.R if R is None else np.asarray(R, dtype=float)
+
         # Definindo a função de temperatura T(R)
-        T_R = (self.a + self.b * np.exp(-self.c * self.R) - self.d * self.R) * 11604525.00617
+        T_R = (self.a + self.b * np.exp(-self.c * R) - self.d * R) * 11604525.00617
 
         cooling_function = 1e-23 * np.sqrt(T_R)
         
         # Definindo a função de densidade n(R)
-        n_R = self.calcula_n0(cooling_function) * (1 + (self.R / self.rc)**2)**(-3 * self.beta / 2)
+        n_R = self.calcula_n0(cooling_function) * (1 + (R / self.rc)**2)**(-3 * self.beta / 2)
         
         # Definindo a função da massa M(R)
-        M_R = (self.k / (self.G * self.mu * self.mp)) * (self.R**2 * (self.b * self.c * np.exp(-self.c * self.R) + self.d) + (3 * self.R * T_R) / 2)
+        M_R = (self.k / (self.G * self.mu * self.mp)) * (R**2 * (self.b * self.c * np.exp(-self.c * R) + self.d) + (3 * R * T_R) / 2)
         return M_R
     
     def set_parameters(self, params):
-        # Configurar os parâmetros da equação
+        # Configurar os parâmetros da equação (nomes dos argumentos do construtor) e recalcular M(R)
+        aliases = {'gamma1': 'gamma_1', 'gamma2': 'gamma_2'}
+        for name, value in params.items():
+            setattr(self, aliases.get(name, name), value)
         self.params = params
+        self.M_R = self.calculate_mass()
     
     def calculate(self, R_value):
-        # Substituir os valores de R e outros parâmetros na equação
-        M_R_value = self.M_R.subs(self.params).subs(self.R, R_value)
-        return M_R_value.evalf()
+        # M_R é numérico: avalia a fórmula diretamente em R (sem subs/evalf do sympy)
+        return self.calculate_mass(R_value)
     
     def calculate_array(self, R_values):
-        # Calcular a massa para uma matriz de valores de R
-        M_values = []
-        for R_value in R_values:
-            M_value = self.calculate(R_value)
-            M_values.append(M_value)
-        return np.array(M_values)
+        # Calcular a massa para uma matriz de valores de R, de uma vez (NumPy)
+        return self.calculate_mass(np.asarray(R_values, dtype=float))
     
 
 
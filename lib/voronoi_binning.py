@@ -0,0 +1,411 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import astropy.io.fits as fits
+from scipy.spatial import cKDTree
+
+from lib.converte import UnitConverter
+from lib.image_profile import load_image, physical_transform, physical_grid, exclusion_mask
+from lib.fit_results import FitResultTable
+from lib.instrumentation import instrument, stage
+
+
+def _signal_to_noise(signal, variance):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(variance > 0, signal / np.sqrt(variance), 0.0)
+
+
+class BinMap:
+    """
+    Result of a 2D adaptive binning: the bin index of every pixel of an image.
+
+    Attributes:
+    ----------
+    labels : numpy.ndarray
+        (ny, nx) int32 map with the bin of each pixel (-1 outside the mask).
+    transform : tuple
+        (LTM1_1, LTV1, LTM2_2, LTV2) of the binned image.
+    snr, area : numpy.ndarray
+        Signal-to-noise ratio and number of pixels of each bin.
+    generators : numpy.ndarray
+        (n_bins, 2) geometric centroids of the bins, in physical coordinates.
+    """
+
+    def __init__(self, labels, transform, snr, area, generators):
+        self.labels = labels
+        self.transform = transform
+        self.snr = snr
+        self.area = area
+        self.generators = generators
+        self._groups = None
+
+    @property
+    def n_bins(self):
+        return self.snr.size
+
+    def _pixel_groups(self):
+        # pixels ordenados por bin: os pixels do bin i são order[offsets[i]:offsets[i + 1]]
+        if self._groups is None:
+            flat = self.labels.ravel()
+            inside = np.flatnonzero(flat >= 0)
+            order = inside[np.argsort(flat[inside], kind='stable')]
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(flat[inside], minlength=self.n_bins))])
+            self._groups = (order, offsets)
+        return self._groups
+
+    def pixels(self, index):
+        """
+        Flat pixel indices of one bin.
+        """
+        order, offsets = self._pixel_groups()
+        return order[offsets[index]:offsets[index + 1]]
+
+    def mask(self, index):
+        """
+        Boolean mask image of one bin.
+        """
+        mask = np.zeros(self.labels.size, dtype=bool)
+        mask[self.pixels(index)] = True
+        return mask.reshape(self.labels.shape)
+
+    def to_map(self, values):
+        """
+        Paints one value per bin onto the image grid (NaN outside the bins).
+        """
+        values = np.concatenate([np.asarray(values, dtype=float), [np.nan]])
+        # -1 (fora da máscara) indexa o NaN do final
+        return values[self.labels]
+
+    def event_bins(self, x, y):
+        """
+        Bin of each event from its physical coordinates (-1 outside).
+        """
+        ltm1, ltv1, ltm2, ltv2 = self.transform
+        # o pixel i (base 0) cobre as coordenadas de imagem [i + 0.5, i + 1.5)
+        column = np.floor(ltm1 * np.asarray(x) + ltv1 - 0.5).astype(np.intp)
+        row = np.floor(ltm2 * np.asarray(y) + ltv2 - 0.5).astype(np.intp)
+        ny, nx = self.labels.shape
+        inside = (column >= 0) & (column < nx) & (row >= 0) & (row < ny)
+        bins = np.full(column.shape, -1, dtype=np.intp)
+        bins[inside] = self.labels[row[inside], column[inside]]
+        return bins
+
+    @instrument('extract_bin_spectra')
+    def extract_spectra(self, evt_path, n_channels=1024, channel_column='pi', first_channel=1):
+        """
+        Spectra of every bin in one pass over the events (no specextract).
+
+        Returns:
+        --------
+        numpy.ndarray
+            (n_bins, n_channels) counts per channel.
+        """
+        with fits.open(evt_path, memmap=True) as hdulist:
+            events = hdulist['EVENTS'].data
+            bins = self.event_bins(events['x'], events['y'])
+            channel = np.asarray(events[channel_column], dtype=np.intp) - first_channel
+        keep = (bins >= 0) & (channel >= 0) & (channel < n_channels)
+        counts = np.bincount(bins[keep] * n_channels + channel[keep], minlength=self.n_bins * n_channels)
+        return counts.reshape(self.n_bins, n_channels)
+
+    def write_spectra(self, directory, spectra, exposure, respfile='none', ancrfile='none', bkg_spectra=None,
+                      bkg_exposure=None, first_channel=1):
+        """
+        Writes one OGIP PHA file per bin (``spec_espectro_{i}_grp.pi`` and,
+        with ``bkg_spectra``, ``spec_espectro_{i}_bkg.pi``), the names read by
+        ``ajuste_apec_nativo`` and the XSPEC loop. Every bin shares the
+        response of the observation, so large bins far from the aimpoint
+        should use responses weighted for their own position.
+
+        Returns:
+        --------
+        list of str
+            Paths of the source spectra.
+        """
+        os.makedirs(directory, exist_ok=True)
+        # BACKSCAL como no CIAO: área da região em pixels / 8192^2
+        backscal = self.area / 8192.0**2
+        channels = np.arange(first_channel, first_channel + spectra.shape[1])
+        paths = []
+        for i in range(self.n_bins):
+            path = os.path.join(directory, f'spec_espectro_{i}_grp.pi')
+            backfile = 'none'
+            if bkg_spectra is not None:
+                backfile = f'spec_espectro_{i}_bkg.pi'
+                _write_pha(os.path.join(directory, backfile), channels, bkg_spectra[i],
+                           bkg_exposure or exposure, backscal[i], respfile, ancrfile, 'none')
+            _write_pha(path, channels, spectra[i], exposure, backscal[i], respfile, ancrfile, backfile)
+            paths.append(path)
+        return paths
+
+    def write(self, path):
+        """
+        Saves the bin map as a FITS image with the physical transform.
+        """
+        header = fits.Header()
+        for key, value in zip(('LTM1_1', 'LTV1', 'LTM2_2', 'LTV2'), self.transform):
+            header[key] = value
+        hdulist = fits.HDUList([fits.PrimaryHDU(self.labels, header=header)])
+        columns = [fits.Column(name='BIN', format='J', array=np.arange(self.n_bins)),
+                   fits.Column(name='SNR', format='D', array=self.snr),
+                   fits.Column(name='AREA', format='D', array=self.area),
+                   fits.Column(name='X', format='D', array=self.generators[:, 0]),
+                   fits.Column(name='Y', format='D', array=self.generators[:, 1])]
+        hdulist.append(fits.BinTableHDU.from_columns(columns, name='BINS'))
+        hdulist.writeto(path, overwrite=True)
+
+    @classmethod
+    def read(cls, path):
+        with fits.open(path) as hdulist:
+            labels = np.array(hdulist[0].data, dtype=np.int32)
+            bins = hdulist['BINS'].data
+            return cls(labels, physical_transform(hdulist[0].header), np.array(bins['SNR']),
+                       np.array(bins['AREA']), np.column_stack([bins['X'], bins['Y']]))
+
+
+def _write_pha(path, channels, counts, exposure, backscal, respfile, ancrfile, backfile):
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name='CHANNEL', format='J', array=channels),
+                                         fits.Column(name='COUNTS', format='J', array=counts)], name='SPECTRUM')
+    for key, value in (('HDUCLASS', 'OGIP'), ('HDUCLAS1', 'SPECTRUM'), ('HDUVERS', '1.2.1'), ('HDUCLAS2', 'TOTAL'),
+                       ('HDUCLAS3', 'COUNT'), ('TELESCOP', 'CHANDRA'), ('INSTRUME', 'ACIS'), ('CHANTYPE', 'PI'),
+                       ('DETCHANS', len(channels)), ('EXPOSURE', float(exposure)), ('BACKSCAL', float(backscal)),
+                       ('AREASCAL', 1.0), ('CORRSCAL', 1.0), ('POISSERR', True), ('RESPFILE', respfile),
+                       ('ANCRFILE', ancrfile), ('BACKFILE', backfile), ('CORRFILE', 'none')):
+        hdu.header[key] = value
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+
+
+class VoronoiBinning:
+    """
+    Weighted Voronoi tessellation (WVT) of a counts image to a target
+    signal-to-noise ratio.
+
+    The initial generators come from a quadtree: the image is summed in
+    2x2 blocks level by level (vectorized) and a tile is split while its S/N
+    is at least twice the target, i.e. while its four children would reach
+    the target on average. The generators are then moved with
+    WVT iterations (Diehl & Statler 2006): every pixel goes to the generator
+    that minimizes ``distance / scale``, found among the nearest generators
+    of a KD-tree, and the scales are updated from the area and S/N of each
+    bin. Every step is a whole-array operation, so megapixel images with
+    thousands of bins are binned in seconds.
+
+    Parameters:
+    -----------
+    counts : numpy.ndarray
+        Counts image.
+    transform : tuple
+        (LTM1_1, LTV1, LTM2_2, LTV2) of the image.
+    background : numpy.ndarray, optional
+        Background counts image on the same grid.
+    bkg_scale : float
+        Factor applied to the background counts.
+    mask : numpy.ndarray, optional
+        True for the pixels to bin (e.g. the chip area without point sources).
+    """
+
+    def __init__(self, counts, transform, background=None, bkg_scale=1.0, mask=None):
+        counts = np.asarray(counts, dtype=float)
+        self.transform = transform
+        self.mask = np.ones(counts.shape, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+        if background is not None:
+            background = np.asarray(background, dtype=float)
+            self.signal = np.where(self.mask, counts - bkg_scale * background, 0.0)
+            self.variance = np.where(self.mask, counts + bkg_scale**2 * background, 0.0)
+        else:
+            self.signal = np.where(self.mask, counts, 0.0)
+            self.variance = self.signal.copy()
+
+    @classmethod
+    def from_images(cls, counts_path, bkg_path=None, bkg_scale=1.0, expmap_path=None, exclusions=()):
+        """
+        Reads the counts (and background) images; with an exposure map, the
+        pixels without exposure are masked, and so are the pixels inside the
+        ``exclusions`` circles (point sources).
+        """
+        counts, header = load_image(counts_path)
+        transform = physical_transform(header)
+        background = load_image(bkg_path)[0] if bkg_path else None
+        mask = load_image(expmap_path)[0] > 0 if expmap_path else None
+        if exclusions:
+            outside = ~exclusion_mask(counts.shape, transform, exclusions)
+            mask = outside if mask is None else mask & outside
+        return cls(counts, transform, background, bkg_scale, mask)
+
+    @instrument('quadtree_generators')
+    def initial_generators(self, target_snr):
+        """
+        Centers (image pixel coordinates) of the quadtree tiles used as the
+        first WVT generators.
+        """
+        ny, nx = self.signal.shape
+        levels = int(np.ceil(np.log2(max(ny, nx))))
+        size = 2**levels
+        pyramid = []
+        signal = np.zeros((size, size))
+        variance = np.zeros((size, size))
+        area = np.zeros((size, size))
+        signal[:ny, :nx] = self.signal
+        variance[:ny, :nx] = self.variance
+        area[:ny, :nx] = self.mask
+        for _ in range(levels + 1):
+            pyramid.append((signal, variance, area))
+            n = signal.shape[0] // 2
+            if n == 0:
+                break
+            signal, variance, area = (a.reshape(n, 2, n, 2).sum(axis=(1, 3)) for a in (signal, variance, area))
+
+        centers = []
+        active = np.ones((1, 1), dtype=bool)
+        for level in range(len(pyramid) - 1, -1, -1):
+            signal, variance, area = pyramid[level]
+            tile = 2**level
+            # quatro filhos com o S/N alvo somam ~2x o alvo: divide enquanto o ladrilho tiver esse S/N
+            split = active & (_signal_to_noise(signal, variance) >= 2 * target_snr) if level > 0 else \
+                np.zeros_like(active)
+            final = active & ~split & (area > 0)
+            rows, columns = np.nonzero(final)
+            centers.append(np.column_stack([(columns + 0.5) * tile - 0.5, (rows + 0.5) * tile - 0.5]))
+            active = np.repeat(np.repeat(split, 2, axis=0), 2, axis=1)
+        return np.concatenate(centers)
+
+    @instrument('voronoi_binning')
+    def bin(self, target_snr, max_iterations=30, tolerance=0.01, neighbours=8):
+        """
+        Bins the image.
+
+        Parameters:
+        -----------
+        target_snr : float
+            Target signal-to-noise ratio of each bin.
+        max_iterations : int
+            Maximum number of WVT iterations.
+        tolerance : float
+            Stops when fewer than this fraction of pixels change bin.
+        neighbours : int
+            Nearest generators examined for the weighted assignment.
+
+        Returns:
+        --------
+        BinMap
+        """
+        rows, columns = np.nonzero(self.mask)
+        pixels = np.column_stack([columns, rows]).astype(float)
+        signal = self.signal[rows, columns]
+        variance = self.variance[rows, columns]
+        generators = self.initial_generators(target_snr)
+        scale = np.ones(len(generators))
+        labels = None
+
+        for _ in range(max_iterations):
+            k = min(neighbours, len(generators))
+            distance, candidates = cKDTree(generators).query(pixels, k=k, workers=-1)
+            if k == 1:
+                new_labels = candidates
+            else:
+                weighted = distance / scale[candidates]
+                new_labels = candidates[np.arange(len(pixels)), np.argmin(weighted, axis=1)]
+            changed = len(pixels) if labels is None else np.count_nonzero(new_labels != labels)
+
+            area = np.bincount(new_labels, minlength=len(generators))
+            used = area > 0
+            # renumera removendo geradores que ficaram sem pixels
+            renumber = np.cumsum(used) - 1
+            labels = renumber[new_labels]
+            area = area[used]
+            n_bins = area.size
+            bin_signal = np.bincount(labels, weights=signal, minlength=n_bins)
+            bin_variance = np.bincount(labels, weights=variance, minlength=n_bins)
+            generators = np.column_stack([np.bincount(labels, weights=pixels[:, 0], minlength=n_bins),
+                                          np.bincount(labels, weights=pixels[:, 1], minlength=n_bins)]) / area[:, None]
+            snr = _signal_to_noise(bin_signal, bin_variance)
+            scale = np.sqrt(area * target_snr / np.clip(snr, 1e-3 * target_snr, None))
+            if changed < tolerance * len(pixels):
+                break
+
+        label_map = np.full(self.signal.shape, -1, dtype=np.int32)
+        label_map[rows, columns] = labels
+        x, y = physical_grid(self.signal.shape, self.transform)
+        ltm1, _, ltm2, _ = self.transform
+        # centroides em coordenadas físicas (interpolação linear da grade de pixels)
+        physical = np.column_stack([x[0] + generators[:, 0] / ltm1, y[0] + generators[:, 1] / ltm2])
+        return BinMap(label_map, self.transform, snr, area.astype(float), physical)
+
+
+def fit_bins(fit_function, spectra_paths, max_workers=None, provenance=None):
+    """
+    Fits the spectra of every bin in parallel.
+
+    Parameters:
+    -----------
+    fit_function : callable
+        Picklable function of one spectrum path returning the
+        ``(kT, abundance, norm)`` ``[value, +err, -err]`` rows, or None when
+        the fit fails.
+    spectra_paths : list of str
+        Spectra of the bins, in bin order.
+
+    Returns:
+    --------
+    FitResultTable
+    """
+    workers = max_workers or os.cpu_count() or 1
+    # blocos de bins por tarefa: milhares de ajustes curtos não pagam uma comunicação cada
+    chunksize = max(1, len(spectra_paths) // (4 * workers))
+    with stage('fit_bins'), ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(fit_function, spectra_paths, chunksize=chunksize))
+    empty = [None, None, None]
+    temperature = [empty if result is None else result[0] for result in results]
+    abundance = [empty if result is None else result[1] for result in results]
+    norm = [empty if result is None else result[2] for result in results]
+    return FitResultTable.from_rows(temperature, norm, abundance, provenance=provenance)
+
+
+def thermodynamic_maps(bin_map, table):
+    """
+    Temperature, pseudo-pressure and pseudo-entropy maps.
+
+    Without the line-of-sight depth of each bin only projected quantities
+    are available: with the normalization per unit area (arcsec^2),
+    ``n ~ sqrt(norm / area)`` up to the unknown depth, so the maps follow
+    ``P = kT * sqrt(norm / area)`` and ``K = kT * (norm / area)^(-1/3)``.
+
+    Returns:
+    --------
+    dict
+        2D maps of ``temperature``, ``temperature_err``, ``norm_per_area``,
+        ``pseudo_pressure`` and ``pseudo_entropy`` (NaN outside the bins and
+        in failed fits).
+    """
+    temperature = np.where(table.valid, table.value('kT'), np.nan)
+    norm = np.where(table.valid, table.value('norm'), np.nan)
+    ltm1, _, ltm2, _ = bin_map.transform
+    area_arcsec = bin_map.area * UnitConverter.pixel_to_arcsec(1.0)**2 / abs(ltm1 * ltm2)
+    surface_norm = norm / area_arcsec
+    with np.errstate(invalid='ignore', divide='ignore'):
+        maps = {'temperature': temperature, 'temperature_err': table.mean_error('kT'),
+                'norm_per_area': surface_norm, 'pseudo_pressure': temperature * np.sqrt(surface_norm),
+                'pseudo_entropy': temperature * surface_norm**(-1 / 3)}
+    return {name: bin_map.to_map(values) for name, values in maps.items()}
+
+
+def write_maps(bin_map, maps, directory):
+    """
+    Writes every map of ``thermodynamic_maps`` to ``directory/<name>.fits``,
+    with the physical transform of the bin map.
+
+    Returns:
+    --------
+    dict
+        Map name -> path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    header = fits.Header()
+    for key, value in zip(('LTM1_1', 'LTV1', 'LTM2_2', 'LTV2'), bin_map.transform):
+        header[key] = value
+    paths = {}
+    for name, values in maps.items():
+        paths[name] = os.path.join(directory, f'{name}.fits')
+        fits.PrimaryHDU(np.asarray(values, dtype=np.float32), header=header).writeto(paths[name], overwrite=True)
+    return paths
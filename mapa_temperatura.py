@@ -0,0 +1,40 @@
+import sys
+import os
+from functools import partial
+from lib.voronoi_binning import VoronoiBinning, fit_bins, thermodynamic_maps, write_maps
+from lib.spectral_fit import fit_spectrum_file
+from variables import redshift
+
+# Binagem de Voronoi (WVT) da imagem, extração dos espectros de cada bin (sem specextract), ajuste apec
+# nativo dos bins em paralelo e mapas de temperatura, pseudo-pressão e pseudo-entropia
+# Uso: python mapa_temperatura.py imagem.img evt.fits bkg_evt.fits exposicao resp.rmf resp.arf S/N diretorio_saida
+#      tabela_apec.fits [nH] [processos]
+image_path, evt_path, bkg_evt_path = sys.argv[1:4]
+exposure = float(sys.argv[4])
+# caminhos absolutos no cabeçalho dos espectros: o ajuste resolve os relativos pelo diretório do espectro
+respfile, ancrfile = (os.path.abspath(path) for path in sys.argv[5:7])
+target_snr = float(sys.argv[7])
+output_dir = sys.argv[8]
+table_path = sys.argv[9]
+nH = float(sys.argv[10]) if len(sys.argv) > 10 else 0.04
+processos = int(sys.argv[11]) if len(sys.argv) > 11 else None
+
+binning = VoronoiBinning.from_images(image_path)
+bin_map = binning.bin(target_snr)
+os.makedirs(output_dir, exist_ok=True)
+bin_map.write(os.path.join(output_dir, 'binmap.fits'))
+
+spectra = bin_map.extract_spectra(evt_path)
+bkg_spectra = bin_map.extract_spectra(bkg_evt_path)
+paths = bin_map.write_spectra(output_dir, spectra, exposure, respfile, ancrfile, bkg_spectra=bkg_spectra)
+print(f"{bin_map.n_bins} bins (S/N mínimo {bin_map.snr.min():.1f}); espectros em {output_dir}")
+
+tabela = fit_bins(partial(fit_spectrum_file, table_path=table_path, redshift=redshift, nH=nH), paths,
+                  max_workers=processos, provenance={'MODEL': 'phabs*apec', 'FITTER': 'native', 'NH': nH,
+                                                     'REDSHIFT': redshift, 'TABLE': os.path.basename(table_path)})
+tabela.write(os.path.join(output_dir, 'ajuste_apec.fits'))
+print(f"{int(tabela.valid.sum())} de {len(tabela)} bins ajustados")
+
+mapas = write_maps(bin_map, thermodynamic_maps(bin_map, tabela), output_dir)
+for nome, caminho in mapas.items():
+    print(f"{caminho} escrito")
@@ -11,20 +11,14 @@ u.def_unit(
     doc="Kiloparsec: 1000 parsecs."
 )
 
-processor = Temperature_Processor(pkl_temp_path)
-processor.Temp_estimator()
-temperature = np.array(processor.temperature[:-2])
-temperature = np.delete(temperature, 11)
-Raio = np.array(RegionProcessor(reg_path).kpc_Radius(redshift)[:-2])
-Raio = np.delete(Raio, 11)
-mean_errors = np.array(processor.erro[:-2])
-mean_errors = np.delete(mean_errors, 11)
-
-processor_2 = RegionProcessor(reg_path)
-processor_2.erro_region()
-erro_region = np.array(processor_2.list_erro_region[:-2])
-erro_region = np.delete(erro_region, 11)
-erro_region = (UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(erro_region),0.032))/2
+# Perfil com todos os anéis; os anéis ruins são mascarados de uma vez em todas as colunas
+perfil = Profile.from_fit_results(reg_path, pkl_temp_path, pkl_norm_path, redshift, mu)
+perfil.exclude([11, -2, -1])
+perfil = perfil.compress()
+temperature = perfil.value('temperature')
+Raio = perfil.radius
+mean_errors = perfil.error('temperature')
+erro_region = perfil.half_width
 
 r_profile_fits_path = '/home/vitorfermiano/Documentos/teste_2/surface_brighness.fits'
 plotter = Make_surface_brightness_plot(r_profile_fits_path)
@@ -47,7 +41,7 @@ mp = const.m_p.value
 c = params[2]
 d = params[3]
 beta = (plotter.get_beta())
-rc = UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(plotter.get_r0()),0.032)
+rc = UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(plotter.get_r0()),redshift)
 a  = params[0]
 b = params[1]
 S0 = plotter.get_ampl()
@@ -0,0 +1,25 @@
+import sys
+import numpy as np
+from lib.sector_profiles import SectorProfiles
+from variables import reg_path, pkl_temp_path, pkl_norm_path, redshift, mu, cooling_function
+
+# Perfis de densidade, temperatura, pressão e entropia em setores (regiões pie do region.reg)
+# Uso: python perfis_setores.py [evt.fits] > setores.csv
+setores = SectorProfiles.from_fit_results(reg_path, pkl_temp_path, pkl_norm_path, redshift, mu)
+setores.add_thermodynamics(cooling_function)
+if len(sys.argv) > 1:
+    setores.count_events(sys.argv[1], energy_range=(500, 7000))
+
+tabela = setores.to_dataframe()
+for nome in ('temperature', 'density', 'pressure', 'entropy'):
+    desvio, significancia = setores.deviation(nome)
+    tabela[f'{nome}_desvio'] = desvio.ravel()
+    tabela[f'{nome}_sigma'] = significancia.ravel()
+tabela.to_csv(sys.stdout, index=False)
+
+# Bins que se desviam mais de 3 sigma da média azimutal (frentes frias, assimetrias)
+for nome in ('temperature', 'density'):
+    setor, raio = np.nonzero(np.abs(setores.deviation(nome)[1]) > 3)
+    for s, r in zip(setor, raio):
+        print(f"{nome}: setor {s} ({setores.angles[s, 0]:.0f}-{setores.angles[s, 1]:.0f} graus), "
+              f"anel {setores.r_in[r]:.0f}-{setores.r_out[r]:.0f} pixel", file=sys.stderr)
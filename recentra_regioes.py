@@ -0,0 +1,35 @@
+import sys
+import astropy.io.fits as fits
+from lib.regions import RegionProcessor, recenter_region_file
+from lib.centroid import CentroidFinder
+from variables import redshift
+
+# Refina o centro do aglomerado e reescreve o arquivo de regiões em torno dele
+# Uso: python recentra_regioes.py evt.fits|imagem.fits region.reg region_recentrada.reg [pico]
+data_path, reg_path, output_path = sys.argv[1:4]
+use_peak = len(sys.argv) > 4 and sys.argv[4] == 'pico'
+
+processor = RegionProcessor(reg_path)
+processor.parse_file()
+first = processor.regions[0]
+r_max = max(region.outer_radius for region in processor.regions)
+
+# o tipo da entrada vem do conteúdo do FITS: tabela EVENTS (eventos) ou HDU de imagem
+with fits.open(data_path, memmap=True) as hdulist:
+    is_events = any(isinstance(hdu, fits.BinTableHDU) and hdu.name == 'EVENTS' for hdu in hdulist)
+
+if is_events:
+    finder = CentroidFinder.from_events(data_path, energy_range=(500, 7000))
+else:
+    finder = CentroidFinder.from_image(data_path)
+
+# aberturas decrescentes: do raio externo até ~10 pixels
+radii = [r for r in (r_max, r_max / 2, r_max / 4, r_max / 8, 10.0) if r >= 10.0]
+result = finder.compare(radii, start=(first.x_center, first.y_center), redshift=redshift)
+print(f"Pico:     ({result['peak'][0]:.2f}, {result['peak'][1]:.2f})")
+print(f"Centroide: ({result['centroid'][0]:.2f}, {result['centroid'][1]:.2f})")
+print(f"Separação: {result['offset_pixel']:.2f} pixel = {result['offset_arcsec']:.2f} arcsec = {result['offset_kpc']:.2f} kpc")
+
+center = result['peak'] if use_peak else result['centroid']
+recenter_region_file(reg_path, center[0], center[1], output_path)
+print(f"{output_path} escrito")
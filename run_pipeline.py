@@ -0,0 +1,17 @@
+import sys
+import os
+from lib.batch import load_catalogue
+from lib.pipeline import build_cluster_pipeline
+
+# Uso: python run_pipeline.py catalogo.yaml diretorio_trabalho [aglomerado ...]
+# Reexecuta apenas as etapas cujas entradas mudaram desde a última execução.
+catalogue_path = sys.argv[1]
+work_root = sys.argv[2]
+names = sys.argv[3:]
+
+for config in load_catalogue(catalogue_path):
+    if names and config.name not in names:
+        continue
+    pipeline = build_cluster_pipeline(config, os.path.join(work_root, config.name))
+    status = pipeline.run()
+    print(config.name, status)
@@ -14,7 +14,7 @@ mean_errors = processor.erro
 processor_2 = RegionProcessor(reg_path)
 processor_2.erro_region()
 erro_region = np.array(processor_2.list_erro_region)
-erro_region = (UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(erro_region),0.032))/2
+erro_region = (UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(erro_region),redshift))/2
 
 # Plotagem do gráfico com barras de erro
 plt.errorbar(Raio, temperature, yerr=mean_errors, xerr=erro_region, fmt='.', capsize=3)
@@ -7,3 +7,5 @@ pkl_norm_path = "/home/vitorfermiano/Documentos/4976/repro/extract/normalizacao_
 redshift = 0.032
 mu = 1.2
 cooling_function = 3*(10**(-23)) 
+nH = 0.04
+abundance = 0.4
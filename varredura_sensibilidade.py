@@ -0,0 +1,31 @@
+import sys
+import numpy as np
+from lib.superficie_de_brilho import Make_surface_brightness_plot
+from lib.sensitivity_sweep import SensitivitySweep
+from lib.converte import UnitConverter
+from variables import reg_path, pkl_temp_path, pkl_norm_path, redshift, mu, cooling_function
+
+# Varredura das entradas escalares (mu, mu da massa, função de resfriamento, cosmologia) em uma grade
+# Uso: python varredura_sensibilidade.py surface_brighness.fits [saida.csv]
+# Escreve a elasticidade e a fração da variância de densidade, pressão, entropia, t_cool e massa devida a cada entrada
+r_profile_fits_path = sys.argv[1]
+saida = sys.argv[2] if len(sys.argv) > 2 else 'sensibilidade.csv'
+
+plotter = Make_surface_brightness_plot(r_profile_fits_path)
+plotter.plot_process()
+rc = UnitConverter.arcsec_to_kpc(UnitConverter.pixel_to_arcsec(plotter.get_r0()), redshift)
+
+varredura = SensitivitySweep.from_fit_results(reg_path, pkl_temp_path, pkl_norm_path, redshift, rc, plotter.get_beta(),
+                                              mu=mu, cooling_function=cooling_function)
+eixos = {
+    'mu': np.linspace(0.9 * mu, 1.1 * mu, 11),
+    'mu_mass': np.linspace(0.58, 0.62, 11),
+    'cooling_function': np.geomspace(0.5 * cooling_function, 2 * cooling_function, 11),
+    'H0': np.linspace(67, 74, 8),
+    'Om0': np.linspace(0.28, 0.34, 7),
+}
+resultado = varredura.run(eixos)
+tabela = resultado.sensitivity_table()
+print(tabela.to_string(index=False))
+tabela.to_csv(saida, index=False)
+print(f"{saida} escrito")